@@ -17,21 +17,20 @@
 
 package org.gem.calc;
 
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
 import java.rmi.RemoteException;
-import java.text.DecimalFormat;
-import java.text.DecimalFormatSymbols;
+import java.util.ArrayList;
 import java.util.HashMap;
+import java.util.Iterator;
 import java.util.List;
-import java.util.ListIterator;
-import java.util.Locale;
 import java.util.Map;
+import java.util.NoSuchElementException;
 import java.util.Random;
-import java.util.Set;
 
 import org.apache.commons.logging.Log;
 import org.apache.commons.logging.LogFactory;
 import org.gem.JsonSerializer;
-import org.gem.engine.hazard.redis.Cache;
 import org.opensha.commons.data.Site;
 import org.opensha.commons.data.function.ArbitrarilyDiscretizedFunc;
 import org.opensha.commons.data.function.DiscretizedFuncAPI;
@@ -41,8 +40,6 @@ import org.opensha.sha.earthquake.EqkRupture;
 import org.opensha.sha.imr.ScalarIntensityMeasureRelationshipAPI;
 import org.opensha.sha.util.TectonicRegionType;
 
-import com.google.gson.Gson;
-
 /**
  * This class provides methods for hazard calculations.
  *
@@ -204,31 +201,89 @@ public class HazardCalculator {
         return groundMotionFields;
     }
 
+    /**
+     * Computes the ground motion fields of a stochastic event set in chunks
+     * of at most <code>chunkSize</code> ruptures, so that the caller never
+     * holds more than one chunk at a time.<br>
+     * Each chunk is a matrix of (natural logarithm of) ground motion values
+     * with one row per rupture and one column per site, flattened in
+     * row-major order and encoded as little-endian 32 bit floats. The
+     * ruptures are in the order in which they were sampled and the sites in
+     * the order of <code>siteList</code>; the random numbers are drawn in
+     * the same sequence as in {@link #getGroundMotionFields}, as long as
+     * the chunks are consumed before <code>rn</code> is used again.
+     *
+     * @param chunkSize
+     *            : maximum number of ruptures per chunk
+     * @return an iterator over the chunks
+     */
     public static
-            void
-            generateAndSaveGMFs(
-                    Cache cache,
-                    String key,
-                    String gmf_id,
-                    List<Site> siteList,
+            Iterator<byte[]>
+            getGroundMotionFieldChunks(
+                    final List<Site> siteList,
                     EqkRupForecastAPI erf,
-                    Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
-                    Random rn, boolean correlation) {
-        Map<EqkRupture, Map<Site, Double>> gmfs =
-                getGroundMotionFields(siteList, erf, gmpeMap, rn, correlation);
-
-        String[] site_ids = new String[siteList.size()];
-        ListIterator<Site> sites = siteList.listIterator();
-        while (sites.hasNext()) {
-            sites.next();
-            site_ids[sites.nextIndex() - 1] =
-                    Integer.toString(sites.nextIndex() - 1);
+                    final Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
+                    final Random rn, final boolean correlation,
+                    final int chunkSize) {
+        validateInput(siteList, erf, gmpeMap);
+        if (rn == null) {
+            String msg = "Random number generator cannot be null";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
         }
-        String[] rupture_ids = new String[gmfs.keySet().size()];
-        for (int x = 0; x < gmfs.keySet().size(); x++) {
-            rupture_ids[x] = Integer.toString(x);
+        if (chunkSize < 1) {
+            String msg = "Chunk size must be positive";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
         }
-        gmfToMemcache(cache, key, gmf_id, rupture_ids, site_ids, gmfs);
+        final Iterator<EqkRupture> ruptures =
+                StochasticEventSetGenerator
+                        .getStochasticEventSetFromPoissonianERF(erf, rn)
+                        .iterator();
+        final int numSites = siteList.size();
+        return new Iterator<byte[]>() {
+
+            @Override
+            public boolean hasNext() {
+                return ruptures.hasNext();
+            }
+
+            @Override
+            public byte[] next() {
+                if (!ruptures.hasNext()) {
+                    throw new NoSuchElementException();
+                }
+                List<Map<Site, Double>> rows =
+                        new ArrayList<Map<Site, Double>>();
+                while (rows.size() < chunkSize && ruptures.hasNext()) {
+                    EqkRupture rup = ruptures.next();
+                    GroundMotionFieldCalculator gmfCalc =
+                        new GroundMotionFieldCalculator(
+                                gmpeMap.get(rup.getTectRegType()),rup,siteList);
+                    if (correlation == true) {
+                        rows.add(gmfCalc
+                                .getCorrelatedGroundMotionField_JB2009(rn));
+                    } else {
+                        rows.add(gmfCalc.getUncorrelatedGroundMotionField(rn));
+                    }
+                }
+                ByteBuffer chunk =
+                        ByteBuffer.allocate(rows.size() * numSites * 4)
+                                .order(ByteOrder.LITTLE_ENDIAN);
+                for (Map<Site, Double> groundMotionField : rows) {
+                    for (Site site : siteList) {
+                        chunk.putFloat(
+                                groundMotionField.get(site).floatValue());
+                    }
+                }
+                return chunk.array();
+            }
+
+            @Override
+            public void remove() {
+                throw new UnsupportedOperationException();
+            }
+        };
     }
 
     public static
@@ -264,117 +319,4 @@ public class HazardCalculator {
         }
         return true;
     }
-
-    /**
-     * From a ground motion field this method serializes only the data that is
-     * needed to a json string.<br>
-     * The suggested format for a jsonized GMF is<br>
-     * {'gmf_id' : { 'eqkrupture_id' : { 'site_id' : {'lat' : lat_val, 'lon' :
-     * lon_val, 'mag' : double_val}}, { 'site_id' : { ...}} , {...} }}
-     *
-     * From identifiers.py, these are what the expected keys look like (this
-     * makes no expectation of the values), the keys are after the colon.
-     *
-     * sites: job_id!block_id!!sites gmf: job_id!block_id!!gmf gmf:
-     * job_id!block_id!site!gmf
-     *
-     * @return
-     */
-    protected static String gmfToJson(String gmfId, String[] eqkRuptureIds,
-            String[] siteIds,
-            Map<EqkRupture, Map<Site, Double>> groundMotionFields) {
-        StringBuilder result = new StringBuilder();
-        Gson gson = new Gson();
-        result.append("{");
-        result.append(gson.toJson(gmfId));
-        result.append(":{");
-        // TODO:
-        // The EqkRupture memcache keys must be known here.
-        // For now behave, as if the map object is ordered.
-        //
-        Set<EqkRupture> groundMotionFieldsKeys = groundMotionFields.keySet();
-        int indexEqkRupture = 0;
-        for (EqkRupture eqkRupture : groundMotionFieldsKeys) {
-            if (indexEqkRupture > 0) {
-                result.append(",");
-            }
-            result.append(gson.toJson(eqkRuptureIds[indexEqkRupture++]));
-            // start the eqk json object
-            result.append(":");
-            Map<Site, Double> groundMotionField =
-                    groundMotionFields.get(eqkRupture);
-            // TODO:
-            // The sites' memcache keys must be known here.
-            // For now behave, as if the map object is ordered.
-            Set<Site> groundMotionFieldKeys = groundMotionField.keySet();
-            int indexSite = 0;
-            StringBuilder siteListString = new StringBuilder();
-            siteListString.append("{");
-            // must instantiate the DecimalFormat object with a locale
-            // that uses the dot as decimal separator (such as the US locale)
-            DecimalFormatSymbols dfs = new DecimalFormatSymbols(Locale.US);
-            DecimalFormat df = new DecimalFormat("0.########E0", dfs);
-            for (Site s : groundMotionFieldKeys) {
-                if (indexSite > 0) {
-                    siteListString.append(",");
-                }
-                StringBuilder siteString = new StringBuilder();
-                siteString.append(gson.toJson(siteIds[indexSite++]));
-                // start the json site's value object
-                siteString.append(":{");
-                siteString.append(gson.toJson("lat") + ":"
-                        + df.format(s.getLocation().getLatitude()));
-                siteString.append(",");
-                siteString.append(gson.toJson("lon") + ":"
-                        + df.format(s.getLocation().getLongitude()));
-                siteString.append(",");
-                siteString.append(gson.toJson("mag") + ":"
-                        + df.format(groundMotionField.get(s)));
-                // close the the json site's value object and the site json
-                // object
-                siteString.append("}");
-                siteListString.append(siteString);
-            } // for
-            siteListString.append("}");
-            // close the eqk json object
-            result.append(siteListString);
-        } // for
-        result.append("}}");
-        return result.toString();
-    }
-
-    /**
-     * Saves a ground motion map to a Cache object.<br>
-     * <br>
-     * 1) Converts the <code>groundMotionFields</code> into json format.<br>
-     * E.g.<br>
-     * {"gmf_id":<br>
-     * {"eqkRupture_id_0":<br>
-     * {"site_id_0":{"lat":35.0,"lon":37.6,"mag":-4.7}},
-     * {"site_id_1":{"lat":37.5,"lon":35.6,"mag":-2.8}},...
-     *
-     * 2) Saves the json string to memCache.
-     *
-     * @param memCacheKey
-     * @param gmfId
-     *            The "json key" for the GMF (ground motion field)
-     * @param eqkRuptureIds
-     *            The "json key" for the the ruptures contained in
-     *            groundMotionFields
-     * @param siteIds
-     *            The "json key" for all the sites contained in
-     *            groundMotionFields
-     * @param groundMotionFields
-     *            The GMF to be saved to memcache
-     * @param cache
-     *            The memcache
-     */
-    protected static void gmfToMemcache(Cache cache, String memCacheKey,
-            String gmfId, String[] eqkRuptureIds, String[] siteIds,
-            Map<EqkRupture, Map<Site, Double>> groundMotionFields) {
-        String json =
-                gmfToJson(gmfId, eqkRuptureIds, siteIds, groundMotionFields);
-        logger.debug("Saving GMF to " + memCacheKey);
-        cache.set(memCacheKey, json);
-    }
 }
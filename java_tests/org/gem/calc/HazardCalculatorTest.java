@@ -17,24 +17,19 @@
 
 package org.gem.calc;
 
-import static org.junit.Assert.assertNotNull;
 import static org.junit.Assert.assertTrue;
 import static org.junit.Assert.assertEquals;
 
-import java.io.IOException;
 import java.util.ArrayList;
 import java.util.HashMap;
 import java.util.Hashtable;
+import java.util.Iterator;
 import java.util.List;
-import java.util.Locale;
 import java.util.Map;
 import java.util.Random;
 
-import junit.framework.Assert;
-
 import org.apache.commons.logging.Log;
 import org.apache.commons.logging.LogFactory;
-import org.gem.engine.hazard.redis.Cache;
 import org.junit.After;
 import org.junit.Before;
 import org.junit.Test;
@@ -78,23 +73,13 @@ public class HazardCalculatorTest {
     private static double integrationDistance = 200.0;
     private static Random rn = new Random();
     private static Boolean correlationFlag = false;
-    // for memcache tests:
-    private static final int PORT = 6379;
-    private static final String LOCALHOST = "localhost";
-    private Cache cache;
 
     @Before
-    public void setUp() throws IOException {
+    public void setUp() {
         setUpSites();
         setUpErf();
         setUpGmpeMap();
         setUpImlValues();
-        try {
-            setUpMemcache();
-        } catch (IOException e) {
-            tearDown();
-            throw e;
-        }
     }
 
     @After
@@ -103,10 +88,6 @@ public class HazardCalculatorTest {
         erf = null;
         gmpeMap = null;
         imlVals = null;
-        if (cache != null) {
-            cache.flush();
-            cache = null;
-        }
     }
 
     /**
@@ -268,144 +249,40 @@ public class HazardCalculatorTest {
                 correlationFlag);
     }
 
-    private Map<EqkRupture, Map<Site, Double>> createGroundMotionFields()
-    {
-        int maxTries = 111;
-        Map<EqkRupture, Map<Site, Double>> groundMotionFields = null;
-        while (maxTries > 0 && groundMotionFields == null
-                || groundMotionFields.values().size() == 0) {
-            --maxTries;
-            // HazardCalculator does not return ground motion fields in more
-            // than 50% of the runs. Is it possible that this
-            // has to do with the random seed? (That is the parameter that
-            // changes for each call.)
-            groundMotionFields =
-                    HazardCalculator.getGroundMotionFields(siteList, erf,
-                            gmpeMap, rn, correlationFlag);
-
-        }
-        if (groundMotionFields == null
-                || groundMotionFields.values().size() == 0) {
-            Assert.fail("HazardCalculator did not return ground motion fields after "
-                    + maxTries + " runs." + groundMotionFields.toString());
-
-        }
-
-        return groundMotionFields;
-    }
-
-    private String[] getRuptureIds(Map<EqkRupture, Map<Site, Double>> groundMotionFields)
-    {
-        String[] eqkRuptureIds = new String[groundMotionFields.values().size()];
-        for (int i = 0; i < eqkRuptureIds.length; ++i) {
-            eqkRuptureIds[i] = "eqkRupture_id_" + i;
-        }
-
-        return eqkRuptureIds;
-    }
-
-    private String[] getSiteIds(Map<EqkRupture, Map<Site, Double>> groundMotionFields)
-    {
-        Map<Site, Double> firstGmf =
-                groundMotionFields.values().iterator().next();
-        String[] siteIds = new String[firstGmf.size()];
-        for (int i = 0; i < siteIds.length; ++i) {
-            siteIds[i] = "site_id_" + i;
-        }
-
-        return siteIds;
-    }
-
-    @Test
-    public void gmfToJsonTest() {
-        Map<EqkRupture, Map<Site, Double>> groundMotionFields = createGroundMotionFields();
-        String[] eqkRuptureIds = getRuptureIds(groundMotionFields);
-        String[] siteIds = getSiteIds(groundMotionFields);
-
-        String jsonString =
-                HazardCalculator.gmfToJson("gmf_id", eqkRuptureIds, siteIds,
-                        groundMotionFields);
-        assertNotNull("jsonString is expected to not to be null", jsonString);
-    }
-
     /**
-     * Test that gmfToJson output is not locale-dependent
+     * Check that the ground motion field chunks hold, in order, the ground
+     * motion values of the ruptures sampled with the same random seed
      */
     @Test
-    public void gmfToJsonLocale() {
-        Map<EqkRupture, Map<Site, Double>> groundMotionFields = createGroundMotionFields();
-        String[] eqkRuptureIds = getRuptureIds(groundMotionFields);
-        String[] siteIds = getSiteIds(groundMotionFields);
-
-        String jsonString =
-                HazardCalculator.gmfToJson("gmf_id", eqkRuptureIds, siteIds,
-                        groundMotionFields);
-
-        Locale currentDefault = Locale.getDefault();
-
-        try {
-            // test all locales
-            for (Locale l : Locale.getAvailableLocales())
-            {
-                Locale.setDefault(l);
-
-                String jsonStringL =
-                        HazardCalculator.gmfToJson("gmf_id", eqkRuptureIds, siteIds,
-                            groundMotionFields);
-
-                assertEquals("gmfToJson is locale-independent for locale " + l.toString(), jsonString, jsonStringL);
-            }
-        }
-        finally {
-            Locale.setDefault(currentDefault);
+    public void getGroundMotionFieldChunks() {
+        long seed = 42;
+        int chunkSize = 3;
+        Map<EqkRupture, Map<Site, Double>> groundMotionFields =
+                HazardCalculator.getGroundMotionFields(siteList, erf,
+                        gmpeMap, new Random(seed), correlationFlag);
+        Iterator<byte[]> chunks =
+                HazardCalculator.getGroundMotionFieldChunks(siteList, erf,
+                        gmpeMap, new Random(seed), correlationFlag,
+                        chunkSize);
+        int ruptures = 0;
+        while (chunks.hasNext()) {
+            byte[] chunk = chunks.next();
+            int rows = chunk.length / (4 * siteList.size());
+            assertEquals(rows * 4 * siteList.size(), chunk.length);
+            assertTrue(rows > 0 && rows <= chunkSize);
+            ruptures += rows;
         }
+        assertEquals(groundMotionFields.size(), ruptures);
     }
 
-    @Test
-    public void gmfToMemcacheTest() {
-        int maxTries = 111;
-        Map<EqkRupture, Map<Site, Double>> groundMotionFields = null;
-        while (maxTries > 0 && groundMotionFields == null
-                || groundMotionFields.values().size() == 0) {
-            --maxTries;
-            // HazardCalculator does not return ground motion fields in more
-            // than 50% of the runs. Is it possible that this
-            // has to do with the random seed? (That is the parameter that
-            // changes for each call.)
-            groundMotionFields =
-                    HazardCalculator.getGroundMotionFields(siteList, erf,
-                            gmpeMap, rn, correlationFlag);
-
-        }
-        if (groundMotionFields == null
-                || groundMotionFields.values().size() == 0) {
-            Assert.fail("HazardCalculator did not return ground motion fields after "
-                    + maxTries + " runs." + groundMotionFields.toString());
-
-        }
-        Map<Site, Double> firstGmf =
-                groundMotionFields.values().iterator().next();
-        String[] eqkRuptureIds = new String[groundMotionFields.values().size()];
-        for (int i = 0; i < eqkRuptureIds.length; ++i) {
-            eqkRuptureIds[i] = "eqkRupture_id_" + i;
-        }
-        String[] siteIds = new String[firstGmf.size()];
-        for (int i = 0; i < siteIds.length; ++i) {
-            siteIds[i] = "site_id_" + i;
-        }
-        String gmfsId = "gmfs_id";
-        String memCacheKey = "memCache_key";
-        // this is what we expect to find in memcache later
-        String jsonFromGmf =
-                HazardCalculator.gmfToJson("gmf_id", eqkRuptureIds, siteIds,
-                        groundMotionFields);
-        // converts the groundmotion fields to json and stores them in the cache
-        HazardCalculator.gmfToMemcache(cache, memCacheKey, gmfsId,
-                eqkRuptureIds, siteIds, groundMotionFields);
-        String jsonFromMemcache = (String) cache.get(memCacheKey);
-        assertNotNull("test gmfToMemcacheTest: no value returned from cache",
-                jsonFromMemcache);
-        assertTrue(jsonFromGmf.compareTo(jsonFromGmf) == 0);
+    /**
+     * Test getGroundMotionFieldChunks when a non positive chunk size is
+     * passed
+     */
+    @Test(expected = IllegalArgumentException.class)
+    public void getGroundMotionFieldChunksInvalidChunkSize() {
+        HazardCalculator.getGroundMotionFieldChunks(siteList, erf, gmpeMap,
+                rn, correlationFlag, 0);
     }
 
     /**
@@ -494,15 +371,6 @@ public class HazardCalculatorTest {
             0.397, 0.556, 0.778, 1.09});
     }
 
-    /**
-     * Set up the cache to access the same host/port.
-     * 
-     * @throws IOException
-     */
-    private void setUpMemcache() throws IOException {
-        cache = new Cache(LOCALHOST, PORT);
-    }
-
     /**
      * Defines fault source (data taken from Turkey model)
      * 
@@ -16,16 +16,43 @@
 
 """Base code for calculator classes."""
 
+from openquake.db import models
+
 
 class Calculator(object):
     """Base abstract class for all calculators."""
 
+    # The units of work completed by earlier runs of the job (cached
+    # result of unit_completed()).
+    _completed_units = None
+
     def __init__(self, job_ctxt):
         """
         :param job_ctxt: :class:`openquake.engine.JobContext` instance.
         """
         self.job_ctxt = job_ctxt
 
+    def unit_completed(self, unit):
+        """True if the given unit of work was completed (see
+        :meth:`record_unit`) by an earlier run of the job, i.e. if the job
+        is being resumed and the unit can be skipped.
+
+        :param str unit: identifies the unit of work, e.g. a block of sites
+        """
+        if self._completed_units is None:
+            self._completed_units = models.checkpoints4job(
+                self.job_ctxt.job_id)
+        return unit in self._completed_units
+
+    def record_unit(self, unit):
+        """Record the completion of a unit of work in the database. The
+        results of the unit must be serialized at this point.
+
+        :param str unit: identifies the unit of work, e.g. a block of sites
+        """
+        models.JobCheckpoint.objects.get_or_create(
+            oq_job_id=self.job_ctxt.job_id, unit=unit)
+
     def initialize(self):
         """Implement this method in subclasses to record pre-execution stats,
         estimate the calculation size, etc."""
@@ -24,12 +24,14 @@ import time
 
 from collections import namedtuple
 from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 from celery.task import task
 
 from openquake import java
 from openquake import kvs
 from openquake import logs
+from openquake import shapes
 from openquake import xml
 from openquake.output import hazard as hazard_output
 from openquake.utils import config
@@ -67,11 +69,13 @@ def unwrap_validation_error(jpype, runtime_exception, path=None):
 @task(ignore_result=True)
 @java.unpack_exception
 @stats.progress_indicator("h")
+@utils_tasks.retrying
 def compute_hazard_curve(job_id, sites, realization):
     """ Generate hazard curve for the given site list."""
 
     calculator = utils_tasks.calculator_for_task(job_id, 'hazard')
     keys = calculator.compute_hazard_curve(sites, realization)
+    stats.record_units(job_id, "h", len(sites))
     return keys
 
 
@@ -95,8 +99,13 @@ def compute_mgm_intensity(job_id, block_id, site_id):
 @task(ignore_result=True)
 @java.unpack_exception
 @stats.progress_indicator("h")
-def compute_mean_curves(job_id, sites, realizations):
-    """Compute the mean hazard curve for each site given."""
+@utils_tasks.retrying
+def compute_mean_curves(job_id, sites, realizations, imls=None,
+                        map_poes=None):
+    """Compute the mean hazard curve for each site given.
+
+    If `map_poes` are passed the mean hazard map values at these PoEs
+    are computed from the curves as well."""
 
     # We don't actually need the JobContext returned by this function
     # (yet) but this does check if the calculation is still in progress.
@@ -105,14 +114,20 @@ def compute_mean_curves(job_id, sites, realizations):
     HAZARD_LOG.info("Computing MEAN curves for %s sites (job_id %s)"
                     % (len(sites), job_id))
 
-    return general.compute_mean_hazard_curves(job_id, sites, realizations)
+    return general.compute_mean_hazard_curves(job_id, sites, realizations,
+                                              imls=imls, map_poes=map_poes)
 
 
 @task(ignore_result=True)
 @java.unpack_exception
 @stats.progress_indicator("h")
-def compute_quantile_curves(job_id, sites, realizations, quantiles):
-    """Compute the quantile hazard curve for each site given."""
+@utils_tasks.retrying
+def compute_quantile_curves(job_id, sites, realizations, quantiles,
+                            imls=None, map_poes=None):
+    """Compute the quantile hazard curve for each site given.
+
+    If `map_poes` are passed the quantile hazard map values at these PoEs
+    are computed from the curves as well."""
 
     # We don't actually need the JobContext returned by this function
     # (yet) but this does check if the calculation is still in progress.
@@ -122,17 +137,21 @@ def compute_quantile_curves(job_id, sites, realizations, quantiles):
                     % (len(sites), job_id))
 
     return general.compute_quantile_hazard_curves(job_id, sites, realizations,
-                                                  quantiles)
+                                                  quantiles, imls=imls,
+                                                  map_poes=map_poes)
 
 
 def release_data_from_kvs(job_id, sites, realizations, quantiles, poes,
-                          kvs_keys_purged):
+                          kvs_keys_purged, client=None):
     """Purge the hazard curve data for the given `sites` from the kvs.
 
     The parameters below will be used to construct kvs keys for
         - hazard curves (including means and quantiles)
         - hazard maps (including means)
 
+    The keys are deleted in bounded batches, see
+    :func:`openquake.kvs.delete_keys`.
+
     :param int job_id: the identifier of the job at hand
     :param list sites: the sites for which to purge content from the kvs
     :param int sites: the number of logic tree passes for this calculation
@@ -141,39 +160,42 @@ def release_data_from_kvs(job_id, sites, realizations, quantiles, poes,
         calculation
     :param kvs_keys_purged: a list only passed by tests who check the
         kvs keys used/purged in the course of the job.
+    :param client: the redis client to use, needed when the data is
+        released from a thread other than the main one
     """
+    site_array = shapes.SiteArray.from_sites(sites)
+    keys = []
+
     for realization in xrange(0, realizations):
         template = kvs.tokens.hazard_curve_poes_key_template(
             job_id, realization)
-        keys = [template % hash(site) for site in sites]
-        kvs.get_client().delete(*keys)
-        if kvs_keys_purged is not None:
-            kvs_keys_purged.extend(keys)
+        keys.extend(site_array.keys(template))
 
     template = kvs.tokens.mean_hazard_curve_key_template(job_id)
-    keys = [template % hash(site) for site in sites]
-    kvs.get_client().delete(*keys)
-    if kvs_keys_purged is not None:
-        kvs_keys_purged.extend(keys)
+    keys.extend(site_array.keys(template))
 
     for quantile in quantiles:
         template = kvs.tokens.quantile_hazard_curve_key_template(
             job_id, quantile)
-        keys = [template % hash(site) for site in sites]
+        keys.extend(site_array.keys(template))
         for poe in poes:
             template = kvs.tokens.quantile_hazard_map_key_template(
                 job_id, poe, quantile)
-            keys.extend([template % hash(site) for site in sites])
-        kvs.get_client().delete(*keys)
-        if kvs_keys_purged is not None:
-            kvs_keys_purged.extend(keys)
+            keys.extend(site_array.keys(template))
 
     for poe in poes:
         template = kvs.tokens.mean_hazard_map_key_template(job_id, poe)
-        keys = [template % hash(site) for site in sites]
-        kvs.get_client().delete(*keys)
-        if kvs_keys_purged is not None:
-            kvs_keys_purged.extend(keys)
+        keys.extend(site_array.keys(template))
+
+    kvs.delete_keys(keys, client=client)
+    if kvs_keys_purged is not None:
+        kvs_keys_purged.extend(keys)
+
+
+# The tasks whose records of completed invocations (see
+# openquake.utils.tasks.retrying) are purged with each block.
+COMPLETED_TASK_RECORDS = (
+    "compute_hazard_curve", "compute_mean_curves", "compute_quantile_curves")
 
 
 # pylint: disable=R0904
@@ -253,7 +275,9 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
                 * job ID
                 * the sites for which to calculate the hazard curves
         :type curve_task: function(string, [:py:class:`openquake.shapes.Site`])
-        :param map_func: A function that computes mean hazard maps.
+        :param map_func: A function that computes mean hazard maps. Not
+            needed when the maps are computed by the curve tasks (see
+            :py:attr:`maps_in_curve_tasks`).
         :type map_func: function(:py:class:`openquake.engine.JobContext`)
         :returns: `None`
         """
@@ -263,22 +287,29 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
         # Compute and serialize the mean curves.
         LOG.info("Computing mean hazard curves")
 
+        poes = self.poes_hazard_maps
+        maps_in_curve_tasks = bool(poes) and self.maps_in_curve_tasks
+
         tf_args = dict(job_id=self.job_ctxt.job_id,
                        realizations=realizations)
+        if maps_in_curve_tasks:
+            tf_args.update(imls=self.job_ctxt.imls, map_poes=poes)
         ath_args = dict(sites=sites)
         utils_tasks.distribute(
             curve_task, ("sites", [[s] for s in sites]), tf_args=tf_args,
             ath=curve_serializer, ath_args=ath_args)
 
-        if self.poes_hazard_maps:
-            assert map_func, "No calculation function for mean hazard maps set"
+        if poes:
+            assert maps_in_curve_tasks or map_func, \
+                "No calculation function for mean hazard maps set"
             assert map_serializer, "No serializer for the mean hazard maps set"
 
-            LOG.info("Computing/serializing mean hazard maps")
-            map_func(self.job_ctxt.job_id, sites, self.job_ctxt.imls,
-                     self.poes_hazard_maps)
+            if not maps_in_curve_tasks:
+                LOG.info("Computing/serializing mean hazard maps")
+                map_func(self.job_ctxt.job_id, sites, self.job_ctxt.imls,
+                         poes)
             LOG.debug(">> mean maps!")
-            map_serializer(sites, self.poes_hazard_maps)
+            map_serializer(sites, poes)
 
     # pylint: disable=R0913
     def do_quantiles(
@@ -309,7 +340,9 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
                 * job ID
                 * the sites for which to calculate the hazard curves
         :type curve_task: function(string, [:py:class:`openquake.shapes.Site`])
-        :param map_func: A function that computes quantile hazard maps.
+        :param map_func: A function that computes quantile hazard maps. Not
+            needed when the maps are computed by the curve tasks (see
+            :py:attr:`maps_in_curve_tasks`).
         :type map_func: function(:py:class:`openquake.engine.JobContext`)
         :returns: `None`
         """
@@ -319,27 +352,34 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
         # compute and serialize quantile hazard curves
         LOG.info("Computing quantile hazard curves")
 
+        poes = self.poes_hazard_maps
+        maps_in_curve_tasks = bool(poes) and self.maps_in_curve_tasks
+
         tf_args = dict(job_id=self.job_ctxt.job_id,
                        realizations=realizations, quantiles=quantiles)
+        if maps_in_curve_tasks:
+            tf_args.update(imls=self.job_ctxt.imls, map_poes=poes)
         ath_args = dict(sites=sites, quantiles=quantiles)
         utils_tasks.distribute(
             curve_task, ("sites", [[s] for s in sites]), tf_args=tf_args,
             ath=curve_serializer, ath_args=ath_args)
 
-        if self.poes_hazard_maps:
-            assert map_func, "No calculation function for quantile maps set."
+        if poes:
+            assert maps_in_curve_tasks or map_func, \
+                "No calculation function for quantile maps set."
             assert map_serializer, "No serializer for the quantile maps set."
 
-            # quantile maps
-            LOG.info("Computing quantile hazard maps")
-            map_func(self.job_ctxt.job_id, sites, quantiles,
-                     self.job_ctxt.imls, self.poes_hazard_maps)
+            if not maps_in_curve_tasks:
+                # quantile maps
+                LOG.info("Computing quantile hazard maps")
+                map_func(self.job_ctxt.job_id, sites, quantiles,
+                         self.job_ctxt.imls, poes)
 
             LOG.info("Serializing quantile maps for %s values"
                      % len(quantiles))
             for quantile in quantiles:
                 LOG.debug(">> quantile maps!")
-                map_serializer(sites, self.poes_hazard_maps, quantile)
+                map_serializer(sites, poes, quantile)
 
     @java.unpack_exception
     @general.create_java_cache
@@ -363,44 +403,83 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
         stats.pk_set(self.job_ctxt.job_id, "hcls_realizations",
                      realizations)
 
-        block_size = config.hazard_block_size()
+        block_size = self.block_size
         stats.pk_set(self.job_ctxt.job_id, "block_size", block_size)
 
         blocks = range(0, len(sites), block_size)
         stats.pk_set(self.job_ctxt.job_id, "blocks", len(blocks))
         stats.pk_set(self.job_ctxt.job_id, "cblock", 0)
+        # The units of work are the (site, realization) pairs of the curves.
+        stats.set_units_total(
+            self.job_ctxt.job_id, "h", len(sites) * realizations)
+
+        # The XML artifacts are assembled in memory across all blocks,
+        # completed blocks can only be skipped if they are not needed.
+        resumable = 'xml' not in self.job_ctxt.serialize_results_to
+
+        # The intermediate results of a block are purged from the kvs in
+        # the background, while the next block is being computed.
+        releaser = ThreadPool(1)
+        release_client = kvs.get_dedicated_client()
+        pending_release = None
+
+        try:
+            for start in blocks:
+                stats.pk_inc(self.job_ctxt.job_id, "cblock")
+                unit = "hazard:block:%s" % start
+                end = start + block_size
+                data = sites[start:end]
+                if resumable and self.unit_completed(unit):
+                    LOG.info("Block starting at site %s already completed"
+                             % start)
+                    stats.record_units(
+                        self.job_ctxt.job_id, "h", len(data) * realizations)
+                    continue
 
-        for start in blocks:
-            stats.pk_inc(self.job_ctxt.job_id, "cblock")
-            end = start + block_size
-            data = sites[start:end]
-
-            LOG.debug("> curves!")
-            self.do_curves(
-                data, realizations,
-                serializer=self.serialize_hazard_curve_of_realization)
-
-            LOG.debug("> means!")
-            # mean curves
-            self.do_means(
-                data, realizations,
-                curve_serializer=self.serialize_mean_hazard_curves,
-                map_func=general.compute_mean_hazard_maps,
-                map_serializer=self.serialize_mean_hazard_map)
-
-            LOG.debug("> quantiles!")
-            # quantile curves
-            quantiles = self.quantile_levels
-            self.do_quantiles(
-                data, realizations, quantiles,
-                curve_serializer=self.serialize_quantile_hazard_curves,
-                map_func=general.compute_quantile_hazard_maps,
-                map_serializer=self.serialize_quantile_hazard_map)
-
-            # Done with this block, purge intermediate results from kvs.
-            release_data_from_kvs(self.job_ctxt.job_id, data, realizations,
-                                  quantiles, self.poes_hazard_maps,
-                                  kvs_keys_purged)
+                LOG.debug("> curves!")
+                self.do_curves(
+                    data, realizations,
+                    serializer=self.serialize_hazard_curve_of_realization)
+
+                LOG.debug("> means!")
+                # mean curves
+                self.do_means(
+                    data, realizations,
+                    curve_serializer=self.serialize_mean_hazard_curves,
+                    map_func=general.compute_mean_hazard_maps,
+                    map_serializer=self.serialize_mean_hazard_map)
+
+                LOG.debug("> quantiles!")
+                # quantile curves
+                quantiles = self.quantile_levels
+                self.do_quantiles(
+                    data, realizations, quantiles,
+                    curve_serializer=self.serialize_quantile_hazard_curves,
+                    map_func=general.compute_quantile_hazard_maps,
+                    map_serializer=self.serialize_quantile_hazard_map)
+
+                # The records of the block's completed task invocations
+                # are purged right away, the next block's tasks add their
+                # own while the intermediate results are being released.
+                utils_tasks.forget_completed(
+                    self.job_ctxt.job_id, COMPLETED_TASK_RECORDS)
+
+                # Done with this block, purge intermediate results from kvs
+                # once the release of the previous block has completed.
+                if pending_release is not None:
+                    pending_release.get()
+                pending_release = releaser.apply_async(
+                    release_data_from_kvs,
+                    (self.job_ctxt.job_id, data, realizations, quantiles,
+                     self.poes_hazard_maps, kvs_keys_purged),
+                    dict(client=release_client))
+                self.record_unit(unit)
+
+            if pending_release is not None:
+                pending_release.get()
+        finally:
+            releaser.close()
+            releaser.join()
 
     def serialize_hazard_curve_of_realization(self, sites, realization):
         """
@@ -621,15 +700,17 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
             nrml_path)
         hm_data = []
 
-        for site in sites:
-            key = key_template % hash(site)
-            # use hazard map IML values from KVS
+        # use hazard map IML values from KVS, read with a single MGET
+        imls = general.mget_decoded(
+            shapes.SiteArray.from_sites(sites).keys(key_template))
+
+        for site, iml in izip(sites, imls):
             hm_attrib = {
                 'investigationTimeSpan':
                     self.job_ctxt['INVESTIGATION_TIME'],
                 'IMT': self.job_ctxt['INTENSITY_MEASURE_TYPE'],
                 'vs30': self.job_ctxt['REFERENCE_VS30_VALUE'],
-                'IML': kvs.get_value_json_decoded(key),
+                'IML': iml,
                 'poE': poe}
 
             hm_attrib.update(hm_attrib_update)
@@ -733,6 +814,16 @@ class ClassicalHazardCalculator(general.BaseHazardCalculator):
             general.QUANTILE_PARAM_NAME,
             check_value=lambda v: v >= 0.0 and v <= 1.0)
 
+    @property
+    def maps_in_curve_tasks(self):
+        """
+        True if the mean/quantile hazard map values are to be computed by
+        the tasks producing the respective curves (`maps_in_curve_tasks`
+        in the `hazard` section of openquake.cfg) instead of in a separate
+        pass reading the curves back from the KVS.
+        """
+        return config.flag_set("hazard", "maps_in_curve_tasks")
+
     @property
     def poes_hazard_maps(self):
         """
@@ -31,6 +31,7 @@ from openquake.java import list_to_jdouble_array
 from openquake.job import config as job_cfg
 from openquake.output import hazard_disagg as hazard_output
 from openquake.utils import config
+from openquake.utils import tasks as utils_tasks
 from openquake.utils.tasks import get_running_job
 from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
 from openquake.calculators.hazard.disagg import subsets
@@ -74,9 +75,7 @@ def compute_disagg_matrix(job_ctxt, site, poe, result_dir):
         jd(lat_bin_lims), jd(lon_bin_lims),
         jd(mag_bin_lims), jd(eps_bin_lims))
 
-    cache = java.jclass('KVS')(
-        config.get('kvs', 'host'),
-        int(config.get('kvs', 'port')))
+    cache = general.java_cache()
 
     erf = general.generate_erf(job_ctxt.job_id, cache)
     gmpe_map = general.generate_gmpe_map(job_ctxt.job_id, cache)
@@ -355,34 +354,49 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
             for poe in poes:
                 task_site_pairs = []
                 for site in sites:
-                    a_task = compute_disagg_matrix_task.delay(
-                        self.job_ctxt.job_id, site, rlz, poe, result_dir)
+                    a_task = utils_tasks.submit(
+                        compute_disagg_matrix_task, self.job_ctxt.job_id,
+                        site, rlz, poe, result_dir)
 
                     task_site_pairs.append((a_task, site))
 
                 task_data.append((rlz, poe, task_site_pairs))
 
-        for rlz, poe, task_site_pairs in task_data:
-
-            # accumulates all data for a given (realization, poe) pair
-            rlz_poe_data = []
-            for a_task, site in task_site_pairs:
-                a_task.wait()
-                if not a_task.successful():
-                    msg = (
-                        "Full Disaggregation matrix computation task"
-                        " for job %s with task_id=%s, realization=%s, PoE=%s,"
-                        " site=%s has failed with the following error: %s")
-                    msg %= (
-                        self.job_ctxt.job_id, a_task.task_id, rlz, poe,
-                        site, a_task.result)
-                    LOG.critical(msg)
-                    raise RuntimeError(msg)
-                else:
-                    gmv, matrix_path = a_task.result
-                    rlz_poe_data.append((site, gmv, matrix_path))
-
-            full_da_results.append((rlz, poe, rlz_poe_data))
+        # maps task ids to (realization/poe index, site index) pairs
+        task_slots = dict()
+        for i, (_rlz, _poe, task_site_pairs) in enumerate(task_data):
+            for j, (a_task, _site) in enumerate(task_site_pairs):
+                task_slots[a_task.task_id] = (i, j)
+
+        # accumulates all data for the (realization, poe) pairs, results are
+        # slotted in the order in which the tasks were submitted
+        rlz_poe_data = [[None] * len(task_site_pairs)
+                        for _rlz, _poe, task_site_pairs in task_data]
+
+        all_tasks = [a_task for _rlz, _poe, task_site_pairs in task_data
+                     for a_task, _site in task_site_pairs]
+
+        for a_task in utils_tasks.as_completed(
+                all_tasks, timeout=utils_tasks.task_timeout()):
+            i, j = task_slots[a_task.task_id]
+            rlz, poe, task_site_pairs = task_data[i]
+            site = task_site_pairs[j][1]
+            if not a_task.successful():
+                msg = (
+                    "Full Disaggregation matrix computation task"
+                    " for job %s with task_id=%s, realization=%s, PoE=%s,"
+                    " site=%s has failed with the following error: %s")
+                msg %= (
+                    self.job_ctxt.job_id, a_task.task_id, rlz, poe,
+                    site, a_task.result)
+                LOG.critical(msg)
+                raise RuntimeError(msg)
+            else:
+                gmv, matrix_path = a_task.result
+                rlz_poe_data[i][j] = (site, gmv, matrix_path)
+
+        for (rlz, poe, _), data in zip(task_data, rlz_poe_data):
+            full_da_results.append((rlz, poe, data))
 
         return full_da_results
 
@@ -441,38 +455,54 @@ class DisaggHazardCalculator(general.BaseHazardCalculator):
                 subset_file %= (rlz, gmv, site.latitude, site.longitude)
                 target_file = os.path.join(target_dir, subset_file)
 
-                a_task = subsets.extract_subsets.delay(
-                    self.job_ctxt.job_id, site, matrix_path, lat_bin_lims,
-                    lon_bin_lims, mag_bin_lims, eps_bin_lims, dist_bin_lims,
-                    target_file, subset_types)
+                a_task = utils_tasks.submit(
+                    subsets.extract_subsets, self.job_ctxt.job_id, site,
+                    matrix_path, lat_bin_lims, lon_bin_lims, mag_bin_lims,
+                    eps_bin_lims, dist_bin_lims, target_file, subset_types)
 
                 task_data.append((a_task, site, gmv, matrix_path, target_file))
 
             rlz_poe_task_data.append((rlz, poe, task_data))
 
-        final_results = []
-
-        for rlz, poe, task_data in rlz_poe_task_data:
-            rlz_poe_results = []  # list of data/results per (rlz, poe) pair
-            for a_task, site, gmv, matrix_path, target_file in task_data:
-
-                a_task.wait()
-                if not a_task.successful():
-                    msg = (
-                        "Matrix subset extraction task for job %s with"
-                        " task_id=%s, realization=%s, PoE=%s, target_file=%s"
-                        " has failed with the following error: %s")
-                    msg %= (self.job_ctxt.job_id, a_task.task_id, poe,
-                            target_file, a_task.result)
-                    LOG.critical(msg)
-                    raise RuntimeError(msg)
-                else:
-                    rlz_poe_results.append((site, gmv, target_file))
-
-                # We don't need the full matrix file anymore.
-                os.unlink(matrix_path)
-
-            final_results.append((rlz, poe, rlz_poe_results))
+        # maps task ids to (realization/poe index, task index) pairs
+        task_slots = dict()
+        for i, (_rlz, _poe, task_data) in enumerate(rlz_poe_task_data):
+            for j, task_datum in enumerate(task_data):
+                task_slots[task_datum[0].task_id] = (i, j)
+
+        # list of data/results per (rlz, poe) pair, results are slotted in
+        # the order in which the tasks were submitted
+        rlz_poe_results = [[None] * len(task_data)
+                           for _rlz, _poe, task_data in rlz_poe_task_data]
+
+        all_tasks = [task_datum[0]
+                     for _rlz, _poe, task_data in rlz_poe_task_data
+                     for task_datum in task_data]
+
+        for a_task in utils_tasks.as_completed(
+                all_tasks, timeout=utils_tasks.task_timeout()):
+            i, j = task_slots[a_task.task_id]
+            rlz, poe, task_data = rlz_poe_task_data[i]
+            _, site, gmv, matrix_path, target_file = task_data[j]
+
+            if not a_task.successful():
+                msg = (
+                    "Matrix subset extraction task for job %s with"
+                    " task_id=%s, realization=%s, PoE=%s, target_file=%s"
+                    " has failed with the following error: %s")
+                msg %= (self.job_ctxt.job_id, a_task.task_id, rlz, poe,
+                        target_file, a_task.result)
+                LOG.critical(msg)
+                raise RuntimeError(msg)
+            else:
+                rlz_poe_results[i][j] = (site, gmv, target_file)
+
+            # We don't need the full matrix file anymore.
+            os.unlink(matrix_path)
+
+        final_results = [
+            (rlz, poe, results) for (rlz, poe, _), results
+            in zip(rlz_poe_task_data, rlz_poe_results)]
 
         return final_results
 
@@ -23,6 +23,7 @@ from celery.task import task
 import h5py
 
 from openquake.shapes import hdistance
+from openquake.utils import memory
 from openquake.calculators.hazard.disagg import FULL_DISAGG_MATRIX
 
 # Disabling pylint checks: too many local vars, too many arguments,
@@ -274,6 +275,9 @@ def extract_subsets(
         Corresponds to ``DISTANCE_BIN_LIMITS`` job parameter.
     :param target_path: Path to the file where the result should be saved.
     :param subsets: A list of PMF extractor names.
+
+    The full matrix is spilled to a memory-mapped temporary file if it
+    exceeds the task memory budget (see :mod:`openquake.utils.memory`).
     """
     nlat = len(lat_bin_edges)
     nlon = len(lon_bin_edges)
@@ -285,7 +289,8 @@ def extract_subsets(
     assert not subsets - set(SUBSET_EXTRACTORS)
     assert subsets
     with h5py.File(full_matrix_path, 'r') as source:
-        full_matrix = source[FULL_DISAGG_MATRIX].value
+        full_matrix = memory.load(
+            source[FULL_DISAGG_MATRIX], "full disaggregation matrix")
     with h5py.File(target_path, 'w') as target:
         for subset_type in subsets:
             extractor = SUBSET_EXTRACTORS[subset_type]
@@ -15,33 +15,142 @@
 
 """Core functionality for Event-Based hazard calculations."""
 
-import math
+import functools
+import json
 import os
 import random
 
+import numpy
+
 from celery.task import task
 
 from openquake import java
 from openquake import kvs
 from openquake import logs
-from openquake import shapes
 from openquake.output import hazard as hazard_output
+from openquake.utils import config
 from openquake.utils import stats
 from openquake.utils import tasks as utils_tasks
 from openquake.calculators.hazard import general
 
 LOG = logs.LOG
 
+# The default maximum number of GMF tasks in flight.
+DEFAULT_MAX_PENDING_TASKS = 64
+
+
+def max_pending_tasks():
+    """Return the maximum number of GMF tasks in flight, as configured in
+    the `hazard` section of openquake.cfg (`max_pending_gmf_tasks`)."""
+    return config.positive_int(
+        "hazard", "max_pending_gmf_tasks", DEFAULT_MAX_PENDING_TASKS)
+
+
+# The default maximum number of ruptures per stored chunk of a GMF matrix.
+DEFAULT_GMF_CHUNK_SIZE = 1024
+
+
+def gmf_chunk_size():
+    """Return the maximum number of ruptures per stored chunk of a GMF
+    matrix, as configured in the `hazard` section of openquake.cfg
+    (`gmf_chunk_size`)."""
+    return config.positive_int(
+        "hazard", "gmf_chunk_size", DEFAULT_GMF_CHUNK_SIZE)
+
+
+def store_gmf_chunks(job_id, history, realization, sites, chunks):
+    """Store the GMF matrix of a stochastic event set one chunk of rows at a
+    time, as the chunks are produced.
+
+    Each chunk is written as raw float32 data; a small JSON header under the
+    stochastic set key, written last, records the shape of the matrix and
+    the number of chunks.
+
+    :param int sites: the number of columns of the matrix
+    :param chunks: iterable of 2-dimensional numpy arrays with the (natural
+        logarithm of the) ground motion values, with one row per rupture and
+        one column per site of the job's site index (see
+        :func:`openquake.calculators.hazard.general.store_site_index`)
+    :returns: the number of ruptures stored
+    """
+    client = kvs.get_client()
+    ruptures = 0
+    count = 0
+    for count, chunk in enumerate(chunks, 1):
+        chunk = numpy.asarray(chunk, dtype=numpy.float32)
+        client.set(
+            kvs.tokens.gmf_chunk_key(job_id, history, realization, count - 1),
+            chunk.tostring())
+        ruptures += len(chunk)
+    client.set(kvs.tokens.stochastic_set_key(job_id, history, realization),
+               json.dumps(dict(ruptures=ruptures, sites=sites, chunks=count)))
+    return ruptures
+
+
+def store_gmf_matrix(job_id, history, realization, gmvs, chunk_size=None):
+    """Store the whole GMF matrix of a stochastic event set, see
+    :func:`store_gmf_chunks`.
+
+    :type gmvs: 2-dimensional numpy array
+    :param chunk_size: the maximum number of rows per chunk, defaults to
+        :func:`gmf_chunk_size`
+    """
+    gmvs = numpy.asarray(gmvs, dtype=numpy.float32)
+    chunk_size = chunk_size or gmf_chunk_size()
+    return store_gmf_chunks(
+        job_id, history, realization, gmvs.shape[1],
+        (gmvs[start:start + chunk_size]
+         for start in xrange(0, len(gmvs), chunk_size)))
+
+
+def _java_bytes(jarray):
+    """Return the content of a Java `byte[]` as a string."""
+    data = jarray[:]
+    if not isinstance(data, str):
+        # a list of ints with JPype versions that do not special-case byte
+        # arrays
+        data = numpy.array(data, dtype=numpy.int8).tostring()
+    return data
+
+
+def load_gmf_matrix(job_id, history, realization):
+    """Load the GMF matrix stored by :func:`store_gmf_chunks`.
+
+    :returns: a (ruptures, sites) float32 array or `None` if no matrix was
+        stored for the given stochastic event set
+    """
+    header = kvs.get_value_json_decoded(
+        kvs.tokens.stochastic_set_key(job_id, history, realization))
+    if not header:
+        return None
+
+    gmvs = numpy.zeros((0, header["sites"]), dtype=numpy.float32)
+    if header["chunks"]:
+        keys = [kvs.tokens.gmf_chunk_key(job_id, history, realization, chunk)
+                for chunk in xrange(header["chunks"])]
+        gmvs = numpy.frombuffer(
+            "".join(kvs.get_client().mget(keys)),
+            dtype=numpy.float32).reshape(-1, header["sites"])
+    return gmvs
+
 
 @task
 @java.unpack_exception
 @stats.progress_indicator("h")
-def compute_ground_motion_fields(job_id, sites, history, realization, seed):
-    """ Generate ground motion fields """
+@utils_tasks.retrying
+def compute_ground_motion_fields(job_id, site_block, history, realization,
+                                 seed):
+    """ Generate ground motion fields
+
+    :param tuple site_block: the (start, length) of the block of the job's
+        site index to compute
+    """
     calculator = utils_tasks.calculator_for_task(job_id, 'hazard')
+    sites = general.load_site_block(job_id, *site_block)
 
     calculator.compute_ground_motion_fields(
         sites, history, realization, seed)
+    stats.record_units(job_id, "h", 1)
 
 
 class EventBasedHazardCalculator(general.BaseHazardCalculator):
@@ -53,7 +162,62 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         """Main hazard processing block.
 
         Loops through various random realizations, spawning tasks to compute
-        GMFs."""
+        GMFs. The tasks of all the seismicity histories are submitted
+        through a bounded window (see :func:`max_pending_tasks`) and the
+        stochastic event set of each task is serialized as soon as the task
+        completes."""
+        histories = self.job_ctxt['NUMBER_OF_SEISMICITY_HISTORIES']
+        realizations = self.job_ctxt['NUMBER_OF_LOGIC_TREE_SAMPLES']
+        LOG.info(
+            "Going to run hazard for %s histories of %s realizations each."
+            % (histories, realizations))
+
+        sites = self.job_ctxt.sites_to_compute()
+        general.store_site_index(self.job_ctxt.job_id, sites)
+        site_block = (0, len(sites))
+
+        # The stochastic event sets serialized by an earlier run of the job
+        # are skipped.
+        seeds = [seed for seed in self.task_seeds(histories, realizations)
+                 if not self.unit_completed(self._ses_unit(*seed[:2]))]
+
+        # The units of work are the stochastic event sets.
+        stats.set_units_total(
+            self.job_ctxt.job_id, "h", histories * realizations)
+        stats.record_units(self.job_ctxt.job_id, "h",
+                           histories * realizations - len(seeds))
+
+        completed = utils_tasks.as_completed_bounded(
+            functools.partial(self._submit_gmf_task, site_block),
+            seeds, max_pending_tasks(), timeout=utils_tasks.task_timeout())
+
+        for (history, realization, _, _, _), each_task in completed:
+            self._release_models((history, realization))
+            if each_task.status != 'SUCCESS':
+                raise Exception(each_task.result)
+
+            LOG.info("Writing output for ses %s!%s" % (history, realization))
+            gmvs = load_gmf_matrix(self.job_ctxt.job_id, history, realization)
+            if gmvs is not None:
+                self.serialize_gmf(history, realization, gmvs, sites)
+            self.record_unit(self._ses_unit(history, realization))
+
+    @staticmethod
+    def _ses_unit(history, realization):
+        """The unit of work of a stochastic event set, see
+        :meth:`openquake.calculators.base.Calculator.record_unit`."""
+        return "hazard:ses:%s!%s" % (history, realization)
+
+    def task_seeds(self, histories, realizations):
+        """Draw the random seeds of all the (history, realization) tasks.
+
+        The seeds are drawn from the job's source model, GMPE and GMF
+        generators in submission order, so they do not depend on the order
+        in which the tasks complete.
+
+        :returns: a list of (history, realization, source model seed,
+            GMPE seed, GMF seed) tuples
+        """
         source_model_generator = random.Random()
         source_model_generator.seed(
             self.job_ctxt['SOURCE_MODEL_LT_RANDOM_SEED'])
@@ -64,39 +228,43 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         gmf_generator = random.Random()
         gmf_generator.seed(self.job_ctxt['GMF_RANDOM_SEED'])
 
-        histories = self.job_ctxt['NUMBER_OF_SEISMICITY_HISTORIES']
-        realizations = self.job_ctxt['NUMBER_OF_LOGIC_TREE_SAMPLES']
-        LOG.info(
-            "Going to run hazard for %s histories of %s realizations each."
-            % (histories, realizations))
+        seeds = []
+        for i in xrange(histories):
+            for j in xrange(realizations):
+                seeds.append((i, j, source_model_generator.getrandbits(32),
+                              gmpe_generator.getrandbits(32),
+                              gmf_generator.getrandbits(32)))
+        return seeds
+
+    def _submit_gmf_task(self, site_block, history, realization,
+                         source_model_seed, gmpe_seed, gmf_seed):
+        """Sample the logic trees for a (history, realization) pair and
+        submit the task computing its GMFs.
+
+        The sampled source model and GMPE map are stored under keys of
+        their own, so that tasks in flight do not see each other's. The
+        task is passed a (start, length) reference to the sites in the
+        job's site index instead of the sites themselves."""
+        key_parts = (history, realization)
+        self.store_source_model(source_model_seed, key_parts)
+        self.store_gmpe_map(gmpe_seed, key_parts)
+        return utils_tasks.submit(
+            compute_ground_motion_fields, self.job_ctxt.job_id, site_block,
+            history, realization, gmf_seed)
+
+    def _release_models(self, key_parts):
+        """Purge the source model and GMPE map of a completed task."""
+        kvs.get_client().delete(
+            kvs.tokens.source_model_key(self.job_ctxt.job_id, *key_parts),
+            kvs.tokens.gmpe_key(self.job_ctxt.job_id, *key_parts))
 
-        for i in range(0, histories):
-            pending_tasks = []
-            for j in range(0, realizations):
-                self.store_source_model(source_model_generator.getrandbits(32))
-                self.store_gmpe_map(gmpe_generator.getrandbits(32))
-                pending_tasks.append(
-                    compute_ground_motion_fields.delay(
-                        self.job_ctxt.job_id,
-                        self.job_ctxt.sites_to_compute(),
-                        i, j, gmf_generator.getrandbits(32)))
-
-            for each_task in pending_tasks:
-                each_task.wait()
-                if each_task.status != 'SUCCESS':
-                    raise Exception(each_task.result)
-
-            for j in range(0, realizations):
-                stochastic_set_key = kvs.tokens.stochastic_set_key(
-                    self.job_ctxt.job_id, i, j)
-                LOG.info("Writing output for ses %s" % stochastic_set_key)
-                ses = kvs.get_value_json_decoded(stochastic_set_key)
-                if ses:
-                    self.serialize_gmf(ses)
-
-    def serialize_gmf(self, ses):
+    def serialize_gmf(self, history, realization, gmvs, sites):
         """
         Write each GMF to an NRML file or to DB depending on job configuration.
+
+        :param gmvs: the GMF matrix of the stochastic event set, as returned
+            by :func:`load_gmf_matrix`
+        :param sites: the sites of the matrix columns
         """
         iml_list = self.job_ctxt['INTENSITY_MEASURE_LEVELS']
 
@@ -105,29 +273,24 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
 
         nrml_path = ''
 
-        for event_set in ses:
-            for rupture in ses[event_set]:
-
-                if self.job_ctxt['SAVE_GMFS']:
-                    common_path = os.path.join(
-                        self.job_ctxt.base_path, self.job_ctxt['OUTPUT_DIR'],
-                        "gmf-%s-%s" % (str(event_set.replace("!", "_")),
-                        str(rupture.replace("!", "_"))))
-                    nrml_path = "%s.xml" % common_path
-
-                gmf_writer = hazard_output.create_gmf_writer(
-                    self.job_ctxt.job_id,
-                    self.job_ctxt.serialize_results_to,
-                    nrml_path)
-                gmf_data = {}
-                for site_key in ses[event_set][rupture]:
-                    site = ses[event_set][rupture][site_key]
-                    site_obj = shapes.Site(site['lon'], site['lat'])
-                    gmf_data[site_obj] = \
-                        {'groundMotion': math.exp(float(site['mag']))}
-
-                gmf_writer.serialize(gmf_data)
-                files.append(nrml_path)
+        for rupture, row in enumerate(numpy.exp(gmvs)):
+
+            if self.job_ctxt['SAVE_GMFS']:
+                common_path = os.path.join(
+                    self.job_ctxt.base_path, self.job_ctxt['OUTPUT_DIR'],
+                    "gmf-%s_%s-%s" % (history, realization, rupture))
+                nrml_path = "%s.xml" % common_path
+
+            gmf_writer = hazard_output.create_gmf_writer(
+                self.job_ctxt.job_id,
+                self.job_ctxt.serialize_results_to,
+                nrml_path)
+            gmf_data = dict(
+                (site, {'groundMotion': float(gmv)})
+                for site, gmv in zip(sites, row))
+
+            gmf_writer.serialize(gmf_data)
+            files.append(nrml_path)
         return files
 
     @general.create_java_cache
@@ -137,13 +300,22 @@ class EventBasedHazardCalculator(general.BaseHazardCalculator):
         jpype = java.jvm()
 
         jsite_list = self.parameterize_sites(site_list)
-        key = kvs.tokens.stochastic_set_key(self.job_ctxt.job_id, history,
-                                            realization)
         correlate = self.job_ctxt['GROUND_MOTION_CORRELATION']
-        stochastic_set_id = "%s!%s" % (history, realization)
-        java.jclass("HazardCalculator").generateAndSaveGMFs(
-                self.cache, key, stochastic_set_id, jsite_list,
-                self.generate_erf(),
-                self.generate_gmpe_map(),
+        jchunks = java.jclass("HazardCalculator").getGroundMotionFieldChunks(
+                jsite_list,
+                self.generate_erf((history, realization)),
+                self.generate_gmpe_map((history, realization)),
                 java.jclass("Random")(seed),
-                jpype.JBoolean(correlate))
+                jpype.JBoolean(correlate),
+                gmf_chunk_size())
+
+        def chunks():
+            """The GMF matrix chunks, computed lazily by the JVM."""
+            while jchunks.hasNext():
+                yield numpy.frombuffer(
+                    _java_bytes(jchunks.next()), dtype="<f4").reshape(
+                        -1, len(site_list))
+
+        ruptures = store_gmf_chunks(self.job_ctxt.job_id, history,
+                                    realization, len(site_list), chunks())
+        stats.incr_counter(self.job_ctxt.job_id, "h", "ruptures", ruptures)
@@ -33,6 +33,7 @@ from shapely import geometry
 
 from openquake import java
 from openquake import kvs
+from openquake import shapes
 from openquake.calculators.base import Calculator
 from openquake.db import models
 from openquake.input import logictree
@@ -42,11 +43,17 @@ from openquake.job.config import ValidationException
 from openquake.logs import LOG
 from openquake.nrml import parsers as nrml_parsers
 from openquake.utils import config
+from openquake.utils import memory
+from openquake.utils import tasks as utils_tasks
 
 
 QUANTILE_PARAM_NAME = "QUANTILE_LEVELS"
 POES_PARAM_NAME = "POES"
 
+# The estimated number of kvs bytes per hazard curve ordinate (the curves
+# are stored as JSON).
+CURVE_ORDINATE_BYTES = 24
+
 
 # NOTE: this refers to how the values are stored in KVS. In the config
 # file, values are stored untransformed (i.e., the list of IMLs is
@@ -64,6 +71,23 @@ IML_SCALING = {
 # Module-private kvs connection cache, to be used by create_java_cache().
 __KVS_CONN_CACHE = {}
 
+# Module-private cache of the site index of the current job, to be used by
+# load_site_index().
+__SITE_INDEX_CACHE = {}
+
+
+def java_cache():
+    """Return a new Java-side kvs client.
+
+    :raises RuntimeError: if the kvs is not the redis server, the Java
+        code cannot access any other kvs backend.
+    """
+    if kvs.backend() != "redis":
+        raise RuntimeError(
+            "The hazard calculators require the redis kvs backend")
+    return java.jclass("KVS")(
+        config.get("kvs", "host"), int(config.get("kvs", "port")))
+
 
 def create_java_cache(fn):
     """A decorator for creating java cache object"""
@@ -75,10 +99,10 @@ def create_java_cache(fn):
         if kvs.cache_connections():
             key = hashlib.md5(repr(kvs_data)).hexdigest()
             if key not in __KVS_CONN_CACHE:
-                __KVS_CONN_CACHE[key] = java.jclass("KVS")(*kvs_data)
+                __KVS_CONN_CACHE[key] = java_cache()
             self.cache = __KVS_CONN_CACHE[key]
         else:
-            self.cache = java.jclass("KVS")(*kvs_data)
+            self.cache = java_cache()
 
         return fn(self, *args, **kwargs)
 
@@ -109,16 +133,18 @@ def preload(fn):
 
 
 @java.unpack_exception
-def generate_erf(job_id, cache):
+def generate_erf(job_id, cache, key_parts=()):
     """ Generate the Earthquake Rupture Forecast from the source model data
     stored in the KVS.
 
     :param int job_id: id of the job
     :param cache: jpype instance of `org.gem.engine.hazard.redis.Cache`
+    :param tuple key_parts: identify the source model, see
+        :func:`openquake.kvs.tokens.source_model_key`
     :returns: jpype instance of
         `org.opensha.sha.earthquake.rupForecastImpl.GEM1.GEM1ERF`
     """
-    src_key = kvs.tokens.source_model_key(job_id)
+    src_key = kvs.tokens.source_model_key(job_id, *key_parts)
     job_key = kvs.tokens.generate_job_key(job_id)
 
     sources = java.jclass("JsonSerializer").getSourceListFromCache(
@@ -132,22 +158,24 @@ def generate_erf(job_id, cache):
     return erf
 
 
-def generate_gmpe_map(job_id, cache):
+def generate_gmpe_map(job_id, cache, key_parts=()):
     """ Generate the GMPE map from the GMPE data stored in the KVS.
 
     :param int job_id: id of the job
     :param cache: jpype instance of `org.gem.engine.hazard.redis.Cache`
+    :param tuple key_parts: identify the GMPE map, see
+        :func:`openquake.kvs.tokens.gmpe_key`
     :returns: jpype instace of
         `HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>`
     """
-    gmpe_key = kvs.tokens.gmpe_key(job_id)
+    gmpe_key = kvs.tokens.gmpe_key(job_id, *key_parts)
 
     gmpe_map = java.jclass(
         "JsonSerializer").getGmpeMapFromCache(cache, gmpe_key)
     return gmpe_map
 
 
-def store_source_model(job_id, seed, params, calc):
+def store_source_model(job_id, seed, params, calc, key_parts=()):
     """Generate source model from the source model logic tree and store it in
     the KVS.
 
@@ -156,15 +184,17 @@ def store_source_model(job_id, seed, params, calc):
     :param dict params: the config parameters as (dict)
     :param calc: logic tree processor
     :type calc: :class:`openquake.input.logictree.LogicTreeProcessor` instance
+    :param tuple key_parts: identify the source model, see
+        :func:`openquake.kvs.tokens.source_model_key`
     """
     LOG.info("Storing source model from job config")
-    key = kvs.tokens.source_model_key(job_id)
+    key = kvs.tokens.source_model_key(job_id, *key_parts)
     mfd_bin_width = float(params.get('WIDTH_OF_MFD_BIN'))
     calc.sample_and_save_source_model_logictree(
         kvs.get_client(), key, seed, mfd_bin_width)
 
 
-def store_gmpe_map(job_id, seed, calc):
+def store_gmpe_map(job_id, seed, calc, key_parts=()):
     """Generate a hash map of GMPEs (keyed by Tectonic Region Type) and store
     it in the KVS.
 
@@ -172,12 +202,63 @@ def store_gmpe_map(job_id, seed, calc):
     :param int seed: seed for random logic tree sampling
     :param calc: logic tree processor
     :type calc: :class:`openquake.input.logictree.LogicTreeProcessor` instance
+    :param tuple key_parts: identify the GMPE map, see
+        :func:`openquake.kvs.tokens.gmpe_key`
     """
     LOG.info("Storing GMPE map from job config")
-    key = kvs.tokens.gmpe_key(job_id)
+    key = kvs.tokens.gmpe_key(job_id, *key_parts)
     calc.sample_and_save_gmpe_logictree(kvs.get_client(), key, seed)
 
 
+def store_site_index(job_id, sites):
+    """Store the sites to compute of a job in the KVS, once, as an array of
+    coordinates.
+
+    Tasks are then passed (start, length) references to blocks of the site
+    index (see :func:`load_site_block`) instead of lists of sites.
+
+    :param int job_id: numeric ID of the job
+    :param sites: the sites to compute
+    :type sites: list of :class:`openquake.shapes.Site`
+    """
+    coords = numpy.array(
+        [(site.longitude, site.latitude, site.depth) for site in sites],
+        dtype=numpy.float64)
+    kvs.get_client().set(kvs.tokens.site_index_key(job_id), coords.tostring())
+
+
+def load_site_index(job_id):
+    """Load the site index stored by :func:`store_site_index`.
+
+    The decoded index is cached in the process, for the most recent job.
+
+    :param int job_id: numeric ID of the job
+    :returns: a (sites, 3) array of (longitude, latitude, depth) rows or
+        `None` if no site index was stored for the job
+    """
+    coords = __SITE_INDEX_CACHE.get(job_id)
+    if coords is None:
+        data = kvs.get_client().get(kvs.tokens.site_index_key(job_id))
+        if data is None:
+            return None
+        coords = numpy.frombuffer(data, dtype=numpy.float64).reshape(-1, 3)
+        __SITE_INDEX_CACHE.clear()
+        __SITE_INDEX_CACHE[job_id] = coords
+    return coords
+
+
+def load_site_block(job_id, start, length):
+    """Return a block of the sites stored by :func:`store_site_index`.
+
+    :param int job_id: numeric ID of the job
+    :param int start: the index of the first site of the block
+    :param int length: the number of sites in the block
+    :returns: a list of :class:`openquake.shapes.Site`
+    """
+    coords = load_site_index(job_id)[start:start + length]
+    return [shapes.Site(lon, lat, depth) for lon, lat, depth in coords]
+
+
 def set_gmpe_params(gmpe_map, params):
     """Push parameters from the config file into the GMPE objects.
 
@@ -397,9 +478,12 @@ def set_java_site_parameters(jsite, sm_data):
 class BaseHazardCalculator(Calculator):
     """Contains common functionality for Hazard calculators"""
 
+    # The number of sites per block, see compute_block_size().
+    block_size = None
+
     def initialize(self):
         """Read the raw site model from the database and populate the
-        `uiapi.site_model`.
+        `uiapi.site_model`, then compute the block size.
         """
         site_model = get_site_model(self.job_ctxt.oq_job.id)
 
@@ -415,6 +499,8 @@ class BaseHazardCalculator(Calculator):
                 site_model_data, self.job_ctxt.sites_to_compute()
             )
 
+        self.compute_block_size()
+
     def pre_execute(self):
         basepath = self.job_ctxt.params.get('BASE_PATH')
         if not self.job_ctxt['CALCULATION_MODE'] in (
@@ -425,36 +511,61 @@ class BaseHazardCalculator(Calculator):
             self.calc = logictree.LogicTreeProcessor(
                 basepath, source_model_lt, gmpe_lt)
 
+    def compute_block_size(self):
+        """Set the number of sites per block (:attr:`block_size`).
+
+        The `block_size` configured in the `hazard` section of
+        openquake.cfg takes precedence. Otherwise a block holds as many
+        sites as the kvs memory budget (see
+        :func:`openquake.utils.memory.block_memory`) allows, given the
+        number of curves (realizations, mean and quantiles) and IMLs per
+        site. A block spawns a task per site and realization,
+        i.e. the largest block possible keeps the most workers busy.
+        """
+        sites = len(self.job_ctxt.sites_to_compute())
+        curves = (self.job_ctxt['NUMBER_OF_LOGIC_TREE_SAMPLES'] or 1) + 1
+        curves += len(self.job_ctxt.extract_values_from_config(
+            QUANTILE_PARAM_NAME))
+        site_cost = curves * len(self.job_ctxt.imls or [0])
+        site_cost *= CURVE_ORDINATE_BYTES
+
+        self.block_size = (
+            config.configured_block_size("hazard")
+            or utils_tasks.adaptive_block_size(
+                sites, site_cost, memory.block_memory("hazard")))
+        LOG.info("Hazard block size: %s sites" % self.block_size)
+
     def execute(self):
         """Calculation logic goes here; subclasses must implement this."""
         raise NotImplementedError()
 
-    def store_source_model(self, seed):
+    def store_source_model(self, seed, key_parts=()):
         """Generates a source model from the source model logic tree."""
         if getattr(self, "calc", None) is None:
             self.pre_execute()
         store_source_model(self.job_ctxt.job_id, seed,
-                           self.job_ctxt.params, self.calc)
+                           self.job_ctxt.params, self.calc, key_parts)
 
-    def store_gmpe_map(self, seed):
+    def store_gmpe_map(self, seed, key_parts=()):
         """Generates a hash of tectonic regions and GMPEs, using the logic tree
         specified in the job config file."""
         if getattr(self, "calc", None) is None:
             self.pre_execute()
-        store_gmpe_map(self.job_ctxt.job_id, seed, self.calc)
+        store_gmpe_map(self.job_ctxt.job_id, seed, self.calc, key_parts)
 
-    def generate_erf(self):
+    def generate_erf(self, key_parts=()):
         """Generate the Earthquake Rupture Forecast from the currently stored
         source model logic tree."""
-        return generate_erf(self.job_ctxt.job_id, self.cache)
+        return generate_erf(self.job_ctxt.job_id, self.cache, key_parts)
 
     def set_gmpe_params(self, gmpe_map):
         """Push parameters from configuration file into the GMPE objects"""
         set_gmpe_params(gmpe_map, self.job_ctxt.params)
 
-    def generate_gmpe_map(self):
+    def generate_gmpe_map(self, key_parts=()):
         """Generate the GMPE map from the stored GMPE logic tree."""
-        gmpe_map = generate_gmpe_map(self.job_ctxt.job_id, self.cache)
+        gmpe_map = generate_gmpe_map(self.job_ctxt.job_id, self.cache,
+                                     key_parts)
         self.set_gmpe_params(gmpe_map)
         return gmpe_map
 
@@ -542,11 +653,13 @@ def mget_decoded(keys):
     :param keys: keys to retrieve (the corresponding value must be a
         JSON string)
     :type keys: list
-    :returns: one value for each key in the list
+    :returns: one value for each key in the list, `None` for the keys
+        that are not in the KVS
     """
     decoder = json.JSONDecoder()
 
-    return [decoder.decode(value) for value in kvs.get_client().mget(keys)]
+    return [decoder.decode(value) if value is not None else None
+            for value in kvs.get_client().mget(keys)]
 
 
 def compute_mean_curve(curves):
@@ -593,9 +706,15 @@ def poes_at(job_id, site, realizations):
     return mget_decoded(keys)
 
 
-def compute_mean_hazard_curves(job_id, sites, realizations):
+def compute_mean_hazard_curves(job_id, sites, realizations, imls=None,
+                               map_poes=None):
     """Compute a mean hazard curve for each site in the list
-    using as input all the pre-computed curves for different realizations."""
+    using as input all the pre-computed curves for different realizations.
+
+    If `map_poes` are given, the mean hazard map values at these PoEs are
+    derived from the curves while they are still in memory and stored
+    as well (see :func:`compute_mean_hazard_maps`); `imls` must then be
+    the IMLs of the curves."""
     keys = []
     for site in sites:
         poes = poes_at(job_id, site, realizations)
@@ -607,12 +726,21 @@ def compute_mean_hazard_curves(job_id, sites, realizations):
 
         kvs.set_value_json_encoded(key, mean_poes)
 
+        if map_poes:
+            store_hazard_map_values(
+                mean_poes, imls, map_poes, site,
+                lambda poe: kvs.tokens.mean_hazard_map_key(job_id, site, poe))
+
     return keys
 
 
-def compute_quantile_hazard_curves(job_id, sites, realizations, quantiles):
+def compute_quantile_hazard_curves(job_id, sites, realizations, quantiles,
+                                   imls=None, map_poes=None):
     """Compute a quantile hazard curve for each site in the list
     using as input all the pre-computed curves for different realizations.
+
+    `imls` and `map_poes` have the same meaning as in
+    :func:`compute_mean_hazard_curves`.
     """
 
     LOG.debug("[QUANTILE_HAZARD_CURVES] List of quantiles is %s" % quantiles)
@@ -630,6 +758,12 @@ def compute_quantile_hazard_curves(job_id, sites, realizations, quantiles):
 
             kvs.set_value_json_encoded(key, quantile_poes)
 
+            if map_poes:
+                store_hazard_map_values(
+                    quantile_poes, imls, map_poes, site,
+                    lambda poe: kvs.tokens.quantile_hazard_map_key(
+                        job_id, site, poe, quantile))
+
     return keys
 
 
@@ -677,6 +811,29 @@ def build_interpolator(poes, imls, site=None):
     return safe_interpolator
 
 
+def store_hazard_map_values(curve_poes, imls, poes, site, key_for_poe):
+    """Interpolate the IMLs of a hazard curve at the given PoEs and store
+    them in the KVS.
+
+    :param curve_poes: the PoEs of the hazard curve
+    :param imls: the IMLs of the hazard curve
+    :param poes: the PoEs at which to compute the hazard map values
+    :param site: the site of the curve (used only for debugging purposes)
+    :param key_for_poe: a function returning the KVS key for a given PoE
+    :returns: the KVS keys of the stored map values
+    """
+    interpolate = build_interpolator(curve_poes, imls, site)
+
+    keys = []
+    for poe in poes:
+        key = key_for_poe(poe)
+        keys.append(key)
+
+        kvs.set_value_json_encoded(key, interpolate(poe))
+
+    return keys
+
+
 def compute_quantile_hazard_maps(job_id, sites, quantiles, imls, poes):
     """Compute quantile hazard maps using as input all the
     pre computed quantile hazard curves.
@@ -691,14 +848,10 @@ def compute_quantile_hazard_maps(job_id, sites, quantiles, imls, poes):
             quantile_poes = kvs.get_value_json_decoded(
                 kvs.tokens.quantile_hazard_curve_key(job_id, site, quantile))
 
-            interpolate = build_interpolator(quantile_poes, imls, site)
-
-            for poe in poes:
-                key = kvs.tokens.quantile_hazard_map_key(
-                        job_id, site, poe, quantile)
-                keys.append(key)
-
-                kvs.set_value_json_encoded(key, interpolate(poe))
+            keys.extend(store_hazard_map_values(
+                quantile_poes, imls, poes, site,
+                lambda poe: kvs.tokens.quantile_hazard_map_key(
+                    job_id, site, poe, quantile)))
 
     return keys
 
@@ -714,12 +867,9 @@ def compute_mean_hazard_maps(job_id, sites, imls, poes):
     for site in sites:
         mean_poes = kvs.get_value_json_decoded(
             kvs.tokens.mean_hazard_curve_key(job_id, site))
-        interpolate = build_interpolator(mean_poes, imls, site)
-
-        for poe in poes:
-            key = kvs.tokens.mean_hazard_map_key(job_id, site, poe)
-            keys.append(key)
 
-            kvs.set_value_json_encoded(key, interpolate(poe))
+        keys.extend(store_hazard_map_values(
+            mean_poes, imls, poes, site,
+            lambda poe: kvs.tokens.mean_hazard_map_key(job_id, site, poe)))
 
     return keys
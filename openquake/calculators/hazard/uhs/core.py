@@ -36,7 +36,6 @@ from openquake.export.uhs import export_uhs
 from openquake.input import logictree
 from openquake.java import list_to_jdouble_array
 from openquake.logs import LOG
-from openquake.utils import config
 from openquake.utils import stats
 from openquake.utils import tasks as utils_tasks
 from openquake.utils.general import block_splitter
@@ -47,6 +46,7 @@ from openquake.utils.general import block_splitter
 @task(ignore_results=True)
 @stats.progress_indicator('h')
 @java.unpack_exception
+@utils_tasks.retrying
 def compute_uhs_task(job_id, realization, site):
     """Compute Uniform Hazard Spectra for a given site of interest and 1 or
     more Probability of Exceedance values. The bulk of the computation will
@@ -73,6 +73,7 @@ def compute_uhs_task(job_id, realization, site):
     uhs_results = compute_uhs(job_ctxt, site)
 
     write_uhs_spectrum_data(job_ctxt, realization, site, uhs_results)
+    stats.record_units(job_id, 'h', 1)
 
 
 # Disabling 'Too many arguments'
@@ -95,9 +96,7 @@ def compute_uhs(the_job, site):
                                 the_job['INTENSITY_MEASURE_TYPE'])
     max_distance = the_job['MAXIMUM_DISTANCE']
 
-    cache = java.jclass('KVS')(
-        config.get('kvs', 'host'),
-        int(config.get('kvs', 'port')))
+    cache = general.java_cache()
 
     erf = general.generate_erf(the_job.job_id, cache)
     gmpe_map = general.generate_gmpe_map(the_job.job_id, cache)
@@ -278,12 +277,16 @@ class UHSCalculator(general.BaseHazardCalculator):
         """
         job_ctxt = self.job_ctxt
         all_sites = job_ctxt.sites_to_compute()
-        site_block_size = config.hazard_block_size()
+        site_block_size = self.block_size
         job_profile = job_ctxt.oq_job_profile
 
         src_model_rnd = random.Random(job_profile.source_model_lt_random_seed)
         gmpe_rnd = random.Random(job_profile.gmpe_lt_random_seed)
 
+        # The units of work are the (site, realization) pairs.
+        stats.set_units_total(job_ctxt.job_id, 'h',
+                              len(all_sites) * job_profile.realizations)
+
         for rlz in xrange(job_ctxt.oq_job_profile.realizations):
 
             # Sample the gmpe and source models:
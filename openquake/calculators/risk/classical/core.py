@@ -20,8 +20,6 @@
 
 import geohash
 
-from celery.exceptions import TimeoutError
-
 from numpy import empty, linspace
 from numpy import array, concatenate
 from numpy import subtract, mean
@@ -31,6 +29,7 @@ from openquake import logs
 from openquake.db import models
 from openquake.parser import vulnerability
 from openquake.shapes import Curve
+from openquake.utils import tasks as utils_tasks
 from openquake.utils.general import MemoizeMutable
 from openquake.calculators.risk import general
 from openquake.calculators.risk.general import collect
@@ -230,20 +229,17 @@ class ClassicalRiskCalculator(general.ProbabilisticRiskCalculator):
             LOGGER.debug("starting task block, block_id = %s of %s"
                         % (block_id, len(self.job_ctxt.blocks_keys)))
             celery_tasks.append(
-                general.compute_risk.delay(self.job_ctxt.job_id, block_id))
+                utils_tasks.submit(general.compute_risk,
+                                   self.job_ctxt.job_id, block_id))
 
         # task compute_risk has return value 'True' (writes its results to
-        # kvs).
+        # kvs). Failed blocks are re-queued by the workers (see
+        # openquake.utils.tasks.retrying), a block that exhausted its
+        # attempts fails the job.
         for task in celery_tasks:
-            try:
-                # TODO(chris): Figure out where to put that timeout.
-                task.wait()
-                if not task.successful():
-                    raise Exception(task.result)
-
-            except TimeoutError:
-                # TODO(jmc): Cancel and respawn this task
-                return
+            task.wait()
+            if not task.successful():
+                raise Exception(task.result)
 
         if self.is_benefit_cost_ratio_mode():
             self.write_output_bcr()
@@ -305,17 +301,24 @@ class ClassicalRiskCalculator(general.ProbabilisticRiskCalculator):
         hazard_curves = dict((point.site, self._get_db_curve(point.site))
                              for point in points)
 
-        def get_loss_curve(point, vuln_function, asset):
-            "Compute loss curve basing on hazard curve"
-            job_profile = self.job_ctxt.oq_job_profile
-            hazard_curve = hazard_curves[point.site]
-            loss_ratio_curve = compute_loss_ratio_curve(
-                    vuln_function, hazard_curve,
-                    job_profile.lrem_steps_per_interval)
-            return compute_loss_curve(loss_ratio_curve, asset.value)
+        mean_loss_ratios = {}
+
+        def get_mean_loss_ratio(point, vuln_function, _asset):
+            "Compute mean loss ratio basing on hazard curve"
+            # the loss ratio curve only depends on the vulnerability
+            # function and the hazard curve, so it is shared by all
+            # the assets of the same taxonomy at the point
+            key = (point.site, vuln_function)
+            if key not in mean_loss_ratios:
+                loss_ratio_curve = compute_loss_ratio_curve(
+                    vuln_function, hazard_curves[point.site],
+                    job_ctxt.oq_job_profile.lrem_steps_per_interval)
+                mean_loss_ratios[key] = general.compute_mean_loss(
+                    loss_ratio_curve)
+            return mean_loss_ratios[key]
 
         bcr = general.compute_bcr_for_block(job_ctxt.job_id, points,
-            get_loss_curve, float(job_ctxt.params['INTEREST_RATE']),
+            get_mean_loss_ratio, float(job_ctxt.params['INTEREST_RATE']),
             float(job_ctxt.params['ASSET_LIFE_EXPECTANCY'])
         )
         bcr_block_key = kvs.tokens.bcr_block_key(job_ctxt.job_id, block_id)
@@ -19,19 +19,25 @@
 
 """Core functionality for Event-Based Risk calculations."""
 
-from numpy import zeros
-
-from celery.exceptions import TimeoutError
+from numpy import exp
 
 from openquake import kvs
 from openquake import logs
 from openquake import shapes
 from openquake.db import models
 from openquake.parser import vulnerability
+from openquake.utils import memory
+from openquake.utils import tasks as utils_tasks
 from openquake.calculators.risk import general
+from openquake.calculators.hazard import general as hazard_general
+from openquake.calculators.hazard.event_based import core as hazard_core
 
 LOGGER = logs.LOG
 
+# The estimated memory footprint (in bytes) of a ground motion value in a
+# GMF slice: a float in a list and its JSON encoding.
+GMV_BYTES = 64
+
 
 # Too many public methods
 # pylint: disable=R0904
@@ -54,17 +60,16 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
             LOGGER.debug("Starting task block, block_id = %s of %s"
                     % (block_id, len(self.job_ctxt.blocks_keys)))
 
-            tasks.append(general.compute_risk.delay(self.job_ctxt.job_id,
-                                                    block_id))
+            tasks.append(utils_tasks.submit(
+                general.compute_risk, self.job_ctxt.job_id, block_id))
 
-        for task in tasks:
-            try:
-                task.wait()
-
-                aggregate_curve.append(task.result)
-            except TimeoutError:
-                # TODO(jmc): Cancel and respawn this task
-                return
+        # The blocks store their partial losses in the kvs, only one of
+        # them is loaded at a time. Failed blocks are re-queued by the
+        # workers (see openquake.utils.tasks.retrying), a block that
+        # exhausted its attempts fails the job.
+        for task in utils_tasks.as_completed(
+                tasks, timeout=utils_tasks.task_timeout()):
+            aggregate_curve.append_from_kvs(task.get())
 
         self.agg_curve = aggregate_curve.compute(
             self._tses(), self._time_span(),
@@ -133,10 +138,11 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
 
         return list(ids)
 
-    def _get_db_gmf(self, gmf_id):
-        """Returns a field for the given GMF"""
+    def _get_db_gmf(self, gmf_id, gmf_keys):
+        """Returns the ground motion values of the given GMF, keyed by
+        "row!col", for the grid cells in `gmf_keys` only."""
         grid = self.job_ctxt.region.grid
-        field = zeros((grid.rows, grid.columns))
+        values = dict()
 
         gmf_sites = models.GmfData.objects.filter(output=gmf_id)
 
@@ -145,9 +151,11 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
             site = shapes.Site(loc.x, loc.y)
             grid_point = grid.point_at(site)
 
-            field[grid_point.row][grid_point.column] = gmf_site.ground_motion
+            key = "%s!%s" % (grid_point.row, grid_point.column)
+            if key in gmf_keys:
+                values[key] = gmf_site.ground_motion
 
-        return shapes.Field(field)
+        return values
 
     def _sites_to_gmf_keys(self, sites):
         """Returns the GMF keys "row!col" for the given site list"""
@@ -162,16 +170,16 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
 
     def _get_db_gmfs(self, sites, job_id):
         """Aggregates GMF data from the DB by site"""
-        all_gmfs = self._gmf_db_list(job_id)
         gmf_keys = self._sites_to_gmf_keys(sites)
         gmfs = dict((k, []) for k in gmf_keys)
+        if not gmfs:
+            return gmfs
 
-        for gmf_id in all_gmfs:
-            field = self._get_db_gmf(gmf_id)
+        for gmf_id in self._gmf_db_list(job_id):
+            values = self._get_db_gmf(gmf_id, gmfs)
 
             for key in gmfs.keys():
-                (row, col) = key.split("!")
-                gmfs[key].append(field.get(int(row), int(col)))
+                gmfs[key].append(values.get(key, 0.0))
 
         return gmfs
 
@@ -180,25 +188,45 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         gmf_keys = self._sites_to_gmf_keys(sites)
         gmfs = dict((k, []) for k in gmf_keys)
 
+        # map the grid cells of the hazard site index to matrix columns
+        coords = hazard_general.load_site_index(self.job_ctxt.job_id)
+        if coords is None:
+            return gmfs
+        columns, rows = self.job_ctxt.region.grid.points_at(
+            coords[:, 0], coords[:, 1])
+        index = dict(("%s!%s" % (row, col), idx)
+                     for idx, (row, col) in enumerate(zip(rows, columns)))
+
         for i in range(0, histories):
             for j in range(0, realizations):
-                key = kvs.tokens.stochastic_set_key(
-                    self.job_ctxt.job_id, i, j)
-                fieldset = shapes.FieldSet.from_json(kvs.get(key),
-                    self.job_ctxt.region.grid)
+                gmvs = hazard_core.load_gmf_matrix(self.job_ctxt.job_id, i, j)
+                if gmvs is None:
+                    continue
 
-                for field in fieldset:
-                    for key in gmfs.keys():
-                        (row, col) = key.split("!")
-                        gmfs[key].append(field.get(int(row), int(col)))
+                for key in gmfs.keys():
+                    if key in index:
+                        gmfs[key].extend(exp(gmvs[:, index[key]]).tolist())
+                    else:
+                        gmfs[key].extend([0.0] * len(gmvs))
 
         return gmfs
 
     def slice_gmfs(self, block_id):
-        """Load and collate GMF values for all sites in this block. """
+        """Load and collate GMF values for all sites in this block.
+
+        The sites are processed in sub-chunks whose GMF slices fit the task
+        memory budget (see :mod:`openquake.utils.memory`)."""
         block = general.Block.from_kvs(self.job_ctxt.job_id, block_id)
-        gmfs = self._get_db_gmfs(block.sites, self.job_ctxt.job_id)
+        gmf_count = len(self._gmf_db_list(self.job_ctxt.job_id))
+        chunk_size = memory.rows_per_chunk(
+            gmf_count * GMV_BYTES, "GMF slices of block %s" % block_id)
+
+        for i in xrange(0, len(block.sites), chunk_size):
+            self._store_gmf_slices(self._get_db_gmfs(
+                block.sites[i:i + chunk_size], self.job_ctxt.job_id))
 
+    def _store_gmf_slices(self, gmfs):
+        """Store the GMF slices keyed by "row!col" in the KVS."""
         for key, gmf_slice in gmfs.items():
             (row, col) = key.split("!")
             key_gmf = kvs.tokens.gmf_set_key(self.job_ctxt.job_id, col, row)
@@ -259,7 +287,8 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
                                 self.job_ctxt.job_id, point.column,
                                 point.row, loss_curve, asset, loss_poe)
 
-        return aggregate_curve.losses
+        return general.store_partial_losses(
+            self.job_ctxt.job_id, block_id, aggregate_curve.losses)
 
     def _compute_bcr(self, block_id):
         """
@@ -285,8 +314,8 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         )
         epsilon_provider = general.EpsilonProvider(self.job_ctxt.params)
 
-        def get_loss_curve(point, vuln_function, asset):
-            "Compute loss curve basing on GMF data"
+        def get_mean_loss_ratio(point, vuln_function, asset):
+            "Compute mean loss ratio basing on GMF data"
             gmf_slice = gmf_slices[point.site]
             loss_ratios = general.compute_loss_ratios(
                 vuln_function, gmf_slice, epsilon_provider, asset)
@@ -296,11 +325,10 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
                 loss_ratios=loss_ratios)
 
             aggregate_curve.append(loss_ratios * asset.value)
-
-            return loss_ratio_curve.rescale_abscissae(asset.value)
+            return general.compute_mean_loss(loss_ratio_curve)
 
         result = general.compute_bcr_for_block(self.job_ctxt.job_id, points,
-            get_loss_curve, float(self.job_ctxt.params['INTEREST_RATE']),
+            get_mean_loss_ratio, float(self.job_ctxt.params['INTEREST_RATE']),
             float(self.job_ctxt.params['ASSET_LIFE_EXPECTANCY'])
         )
 
@@ -309,7 +337,8 @@ class EventBasedRiskCalculator(general.ProbabilisticRiskCalculator):
         kvs.set_value_json_encoded(bcr_block_key, result)
         LOGGER.debug('bcr result for block %s: %r', block_id, result)
 
-        return aggregate_curve.losses
+        return general.store_partial_losses(
+            self.job_ctxt.job_id, block_id, aggregate_curve.losses)
 
     def compute_loss_ratios(self, asset, gmf_slice):
         """For a given asset and ground motion field, computes
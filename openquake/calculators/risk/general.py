@@ -32,10 +32,13 @@ from celery.task import task
 from django.contrib.gis import geos
 
 from numpy import array
+from numpy import asarray
 from numpy import exp
+from numpy import frombuffer
 from numpy import histogram
 from numpy import linspace
 from numpy import mean
+from numpy import sum as numpy_sum
 from numpy import where
 from numpy import zeros
 from scipy import sqrt, log
@@ -53,13 +56,21 @@ from openquake.output import risk as risk_output
 from openquake.parser import exposure
 from openquake.parser import fragility
 from openquake.parser import vulnerability
+from openquake.utils import config
+from openquake.utils import memory
 from openquake.utils import round_float
+from openquake.utils import stats as utils_stats
+from openquake.utils import tasks as utils_tasks
 from openquake.utils.tasks import calculator_for_task
+from openquake.utils.tasks import retrying
 
 
 LOG = logs.LOG
 BLOCK_SIZE = 100
 
+# The estimated memory footprint of an asset in a risk task, in bytes
+# (hazard values, loss ratio and loss curves).
+ASSET_BYTES = 64 * 1024
 
 def conditional_loss_poes(params):
     """Return the PoE(s) specified in the configuration file used to
@@ -101,17 +112,23 @@ def _compute_conditional_loss(curve, probability):
 
 
 @task
+@utils_stats.progress_indicator("r")
+@retrying
 def compute_risk(job_id, block_id, **kwargs):
     """A task for computing risk, calls the compute_risk method defined in the
     chosen risk calculator.
 
     The calculator used is determined by the calculation configuration's
-    calculation mode (i.e., classical, event_based, etc.).
+    calculation mode (i.e., classical, event_based, etc.). The sites of the
+    block are counted as the units of work processed.
     """
 
     calculator = calculator_for_task(job_id, 'risk')
 
-    return calculator.compute_risk(block_id, **kwargs)
+    result = calculator.compute_risk(block_id, **kwargs)
+    utils_stats.record_units(
+        job_id, "r", len(Block.from_kvs(job_id, block_id).sites))
+    return result
 
 
 class BaseRiskCalculator(Calculator):
@@ -228,17 +245,47 @@ class BaseRiskCalculator(Calculator):
 
         self.job_ctxt.blocks_keys = []  # pylint: disable=W0201
         sites = engine.read_sites_from_exposure(self.job_ctxt)
+        block_size = self.compute_block_size(sites)
 
         block_count = 0
 
-        for block in split_into_blocks(self.job_ctxt.job_id, sites):
+        for block in split_into_blocks(
+                self.job_ctxt.job_id, sites, block_size):
             self.job_ctxt.blocks_keys.append(block.block_id)
             block.to_kvs()
 
             block_count += 1
 
-        LOG.info("Job has partitioned %s sites into %s blocks",
-                 len(sites), block_count)
+        LOG.info("Job has partitioned %s sites into %s blocks of %s sites",
+                 len(sites), block_count, block_size)
+        utils_stats.set_units_total(self.job_ctxt.job_id, "r", len(sites))
+
+    def compute_block_size(self, sites):
+        """Return the number of sites per block.
+
+        The `block_size` configured in the `risk` section of openquake.cfg
+        takes precedence. Otherwise the sites are split so that each of the
+        active workers (see :func:`openquake.utils.tasks.active_workers`)
+        gets :data:`openquake.utils.tasks.TASKS_PER_WORKER` blocks, with
+        smaller blocks where the assets of a block would exceed its memory
+        budget (see :func:`openquake.utils.memory.block_memory`).
+
+        :param sites: the sites of the job's exposure
+        """
+        configured = config.configured_block_size("risk")
+        if configured or not sites:
+            return configured or BLOCK_SIZE
+
+        self._load_exposure_model(self.job_ctxt.job_id)
+        assets = models.ExposureData.objects.filter(
+            exposure_model__input__in=self._em_inputs,
+            site__contained=self.job_ctxt.oq_job_profile.region).count()
+        site_cost = float(assets) / len(sites) * ASSET_BYTES
+
+        return utils_tasks.adaptive_block_size(
+            len(sites), site_cost, memory.block_memory("risk"),
+            min_blocks=utils_tasks.TASKS_PER_WORKER
+            * utils_tasks.active_workers())
 
     def store_exposure_assets(self):
         """Load exposure assets and write them to database."""
@@ -328,35 +375,59 @@ class BaseRiskCalculator(Calculator):
             for asset in assets:
                 yield point, asset
 
+    def block_assets_iterator(self, block_id):
+        """
+        Generates the tuples (point, asset) for all assets known to this job
+        that are located at the sites of the given block.
+
+        :param block_id: the id of a block stored by :py:meth:`partition`
+        :returns: tuples (point, asset), see :py:meth:`grid_assets_iterator`
+        """
+        block = Block.from_kvs(self.job_ctxt.job_id, block_id)
+
+        for site in block.sites:
+            point = self.job_ctxt.region.grid.point_at(site)
+            for asset in self.assets_at(self.job_ctxt.job_id, site):
+                yield point, asset
+
     def _write_output_for_block(self, job_id, block_id):
         """
         Write loss / loss ratio curves to xml for a single block.
+
+        The curves of all the assets in the block are fetched from the
+        kvs with a single MGET.
         """
 
         loss_curves = []
         loss_ratio_curves = []
+
         block = Block.from_kvs(job_id, block_id)
+        sites_assets = []
+        keys = []
 
         for site in block.sites:
             point = self.job_ctxt.region.grid.point_at(site)
-            assets = BaseRiskCalculator.assets_at(self.job_ctxt.job_id, site)
 
-            for asset in assets:
-                loss_curve = kvs.get_client().get(
-                    kvs.tokens.loss_curve_key(
+            for asset in self.assets_at(self.job_ctxt.job_id, site):
+                sites_assets.append((site, asset))
+                keys.append(kvs.tokens.loss_curve_key(
                     job_id, point.row, point.column, asset.asset_ref))
-
-                loss_ratio_curve = kvs.get_client().get(
-                    kvs.tokens.loss_ratio_key(
+                keys.append(kvs.tokens.loss_ratio_key(
                     job_id, point.row, point.column, asset.asset_ref))
 
-                if loss_curve:
-                    loss_curve = shapes.Curve.from_json(loss_curve)
-                    loss_curves.append((site, (loss_curve, asset)))
+        values = kvs.get_client().mget(keys) if keys else []
+
+        for idx, (site, asset) in enumerate(sites_assets):
+            loss_curve = values[2 * idx]
+            loss_ratio_curve = values[2 * idx + 1]
 
-                if loss_ratio_curve:
-                    loss_ratio_curve = shapes.Curve.from_json(loss_ratio_curve)
-                    loss_ratio_curves.append((site, (loss_ratio_curve, asset)))
+            if loss_curve:
+                loss_curve = shapes.Curve.from_json(loss_curve)
+                loss_curves.append((site, (loss_curve, asset)))
+
+            if loss_ratio_curve:
+                loss_ratio_curve = shapes.Curve.from_json(loss_ratio_curve)
+                loss_ratio_curves.append((site, (loss_ratio_curve, asset)))
 
         results = self._serialize(block_id, curves=loss_ratio_curves,
                 curve_mode="loss_ratio")
@@ -373,6 +444,10 @@ class BaseRiskCalculator(Calculator):
         For each site in the region of this job, returns a list of assets and
         their losses at a given probability of exceedance.
 
+        The losses of all the assets are fetched from the kvs with a single
+        MGET, so `assets_iterator` is meant to cover a block of sites (see
+        :py:meth:`block_assets_iterator`) rather than the whole region.
+
         :param:loss_poe: the probability of exceedance
         :type:loss_poe: float
         :param:assets_iterator: an iterator over the assets, returning (point,
@@ -391,20 +466,24 @@ class BaseRiskCalculator(Calculator):
             :py:class:`dict` (loss dict) with the following key:
                 ***value*** - the value of the loss for the asset
         """
-        result = defaultdict(list)
+        points_assets = list(assets_iterator)
+        if not points_assets:
+            return []
 
-        for point, asset in assets_iterator:
-            key = kvs.tokens.loss_key(self.job_ctxt.job_id, point.row,
-                                      point.column, asset.asset_ref, loss_poe)
+        keys = [kvs.tokens.loss_key(self.job_ctxt.job_id, point.row,
+                                    point.column, asset.asset_ref, loss_poe)
+                for point, asset in points_assets]
 
-            loss_value = kvs.get_client().get(key)
+        result = OrderedDict()
 
+        for (_, asset), loss_value in zip(
+                points_assets, kvs.get_client().mget(keys)):
             if loss_value:
                 risk_site = shapes.Site(asset.site.x, asset.site.y)
                 loss = {
                     "value": loss_value,
                 }
-                result[risk_site].append((loss, asset))
+                result.setdefault(risk_site, []).append((loss, asset))
 
         return result.items()
 
@@ -473,12 +552,7 @@ class ProbabilisticRiskCalculator(BaseRiskCalculator):
                     "poE": loss_poe,
                 }
 
-                writer.serialize(
-                    [metadata]
-                    + self.asset_losses_per_site(
-                        loss_poe,
-                        self.grid_assets_iterator(
-                            job_ctxt.region.grid)))
+                writer.serialize(BlockLossMap(self, loss_poe, metadata))
                 LOG.info('Loss Map is at: %s' % path)
 
     def write_output_bcr(self):
@@ -501,6 +575,32 @@ class ProbabilisticRiskCalculator(BaseRiskCalculator):
         LOG.info('BCR Map is at: %s' % path)
 
 
+class BlockLossMap(object):
+    """
+    Loss map data for the map writers, assembled block by block.
+
+    Iterating yields the metadata dict followed by the (site, [(loss,
+    asset), ...]) pairs of every block in turn, so that only the data of
+    one block is held in memory at a time. Each iteration reads the
+    losses from the kvs again, which lets composite writers consume the
+    map once per writer.
+    """
+
+    def __init__(self, calculator, loss_poe, metadata):
+        self.calculator = calculator
+        self.loss_poe = loss_poe
+        self.metadata = metadata
+
+    def __iter__(self):
+        yield self.metadata
+
+        for block_id in self.calculator.job_ctxt.blocks_keys:
+            for item in self.calculator.asset_losses_per_site(
+                    self.loss_poe,
+                    self.calculator.block_assets_iterator(block_id)):
+                yield item
+
+
 class EpsilonProvider(object):
     """
     Simple class for combining job configuration parameters and an `epsilon`
@@ -586,11 +686,11 @@ class Block(object):
         """Provide an iterator across the unique grid points within a region,
          corresponding to the sites within this block."""
 
-        used_points = []
+        used_points = set()
         for site in self.sites:
             point = region.grid.point_at(site)
             if point not in used_points:
-                used_points.append(point)
+                used_points.add(point)
                 yield point
 
     @staticmethod
@@ -646,15 +746,21 @@ def split_into_blocks(job_id, sites, block_size=BLOCK_SIZE):
                     sites=sites[i:i + block_size])
 
 
-def compute_bcr_for_block(job_id, points, get_loss_curve,
+def compute_bcr_for_block(job_id, points, get_mean_loss_ratio,
                           interest_rate, asset_life_expectancy):
     """
     Compute and return Benefit-Cost Ratio data for a number of points.
 
-    :param get_loss_curve:
+    The mean loss ratios are requested asset by asset, in exposure order,
+    first with the original and then with the retrofitted vulnerability
+    function (the order matters when they are computed from random
+    epsilons); expected annual losses and BCRs for the whole block are
+    then computed as array operations.
+
+    :param get_mean_loss_ratio:
         Function that takes three positional arguments: point object,
         vulnerability function object and asset object and is supposed
-        to return a loss curve.
+        to return the mean loss ratio of the asset.
     :return:
         A list of tuples::
 
@@ -664,42 +770,49 @@ def compute_bcr_for_block(job_id, points, get_loss_curve,
                 ...]),
              ...]
     """
-    # too many local vars (16/15) -- pylint: disable=R0914
-    result = defaultdict(list)
-
     vuln_curves = vulnerability.load_vuln_model_from_kvs(job_id)
     vuln_curves_retrofitted = vulnerability.load_vuln_model_from_kvs(
         job_id, retrofitted=True)
 
+    all_assets = []
+    ratios_original = []
+    ratios_retrofitted = []
+
     for point in points:
-        assets = BaseRiskCalculator.assets_for_cell(job_id, point.site)
-        for asset in assets:
-            vuln_function = vuln_curves[asset.taxonomy]
-            loss_curve = get_loss_curve(point, vuln_function, asset)
-            LOG.info('for asset %s loss_curve = %s',
-                     asset.asset_ref, loss_curve)
-            eal_original = compute_mean_loss(loss_curve)
-
-            vuln_function = vuln_curves_retrofitted[asset.taxonomy]
-            loss_curve = get_loss_curve(point, vuln_function, asset)
-            LOG.info('for asset %s loss_curve retrofitted = %s',
-                     asset.asset_ref, loss_curve)
-            eal_retrofitted = compute_mean_loss(loss_curve)
-
-            bcr = compute_bcr(eal_original, eal_retrofitted,
-                              interest_rate, asset_life_expectancy,
-                              asset.retrofitting_cost)
-
-            LOG.info('for asset %s EAL original = %f, '
-                     'EAL retrofitted = %f, BCR = %f',
-                     asset.asset_ref, eal_original, eal_retrofitted, bcr)
-
-            key = (asset.site.x, asset.site.y)
-
-            result[key].append(({'bcr': bcr,
-                                 'eal_original': eal_original,
-                                 'eal_retrofitted': eal_retrofitted},
-                                asset.asset_ref))
+        for asset in BaseRiskCalculator.assets_for_cell(job_id, point.site):
+            all_assets.append(asset)
+            ratios_original.append(get_mean_loss_ratio(
+                point, vuln_curves[asset.taxonomy], asset))
+            ratios_retrofitted.append(get_mean_loss_ratio(
+                point, vuln_curves_retrofitted[asset.taxonomy], asset))
+
+    if not all_assets:
+        return []
+
+    values = array([asset.value or 0.0 for asset in all_assets], dtype=float)
+    costs = array([asset.retrofitting_cost for asset in all_assets],
+                  dtype=float)
+
+    eals_original = values * asarray(ratios_original, dtype=float)
+    eals_retrofitted = values * asarray(ratios_retrofitted, dtype=float)
+    bcrs = compute_bcr(eals_original, eals_retrofitted,
+                       interest_rate, asset_life_expectancy, costs)
+
+    result = defaultdict(list)
+
+    for asset, bcr, eal_original, eal_retrofitted in zip(
+            all_assets, bcrs.tolist(), eals_original.tolist(),
+            eals_retrofitted.tolist()):
+        LOG.debug('for asset %s EAL original = %f, '
+                  'EAL retrofitted = %f, BCR = %f',
+                  asset.asset_ref, eal_original, eal_retrofitted, bcr)
+
+        key = (asset.site.x, asset.site.y)
+
+        result[key].append(({'bcr': bcr,
+                             'eal_original': eal_original,
+                             'eal_retrofitted': eal_retrofitted},
+                            asset.asset_ref))
 
     return result.items()
 
@@ -717,14 +830,17 @@ def compute_loss_curve(loss_ratio_curve, asset):
     return loss_ratio_curve.rescale_abscissae(asset)
 
 
+def _midpoints(values):
+    """Return the means of each pair of consecutive values."""
+    values = asarray(values, dtype=float)
+    return (values[:-1] + values[1:]) / 2.0
+
+
 def _compute_mid_mean_pe(loss_ratio_curve):
     """Compute a new loss ratio curve taking the mean values."""
 
-    loss_ratios = loss_ratio_curve.abscissae
-    pes = loss_ratio_curve.ordinates
-
-    ratios = collect(loop(loss_ratios, lambda x, y: mean([x, y])))
-    mid_pes = collect(loop(pes, lambda x, y: mean([x, y])))
+    ratios = _midpoints(loss_ratio_curve.abscissae)
+    mid_pes = _midpoints(loss_ratio_curve.ordinates)
 
     return shapes.Curve(zip(ratios, mid_pes))
 
@@ -733,11 +849,9 @@ def _compute_mid_po(loss_ratio_pe_mid_curve):
     """Compute a loss ratio curve that has PoOs
     (Probabilities of Occurrence) as Y values."""
 
-    loss_ratios = loss_ratio_pe_mid_curve.abscissae
-    pes = loss_ratio_pe_mid_curve.ordinates
-
-    ratios = collect(loop(loss_ratios, lambda x, y: mean([x, y])))
-    pos = collect(loop(pes, lambda x, y: x - y))
+    ratios = _midpoints(loss_ratio_pe_mid_curve.abscissae)
+    pes = asarray(loss_ratio_pe_mid_curve.ordinates, dtype=float)
+    pos = pes[:-1] - pes[1:]
 
     return shapes.Curve(zip(ratios, pos))
 
@@ -745,9 +859,10 @@ def _compute_mid_po(loss_ratio_pe_mid_curve):
 def compute_mean_loss(curve):
     """Compute the mean loss (or loss ratio) for the given curve."""
 
-    mid_curve = _compute_mid_po(_compute_mid_mean_pe(curve))
-    return sum(i * j for i, j in zip(
-            mid_curve.abscissae, mid_curve.ordinates))
+    ratios = _midpoints(_midpoints(curve.abscissae))
+    mid_pes = _midpoints(curve.ordinates)
+
+    return float(numpy_sum(ratios * (mid_pes[:-1] - mid_pes[1:])))
 
 
 def loop(elements, func, *args):
@@ -849,27 +964,25 @@ def _sampled_based(vuln_function, gmf_set, epsilon_provider, asset):
     :type asset: an :py:class:`openquake.db.model.ExposureData` instance
     """
 
-    loss_ratios = []
-
     means = vuln_function.loss_ratio_for(gmf_set["IMLs"])
     covs = vuln_function.cov_for(gmf_set["IMLs"])
 
-    for mean_ratio, cov in zip(means, covs):
-        if mean_ratio <= 0.0:
-            loss_ratios.append(0.0)
-        else:
-            variance = (mean_ratio * cov) ** 2.0
+    loss_ratios = zeros(means.shape)
+    positive = means > 0.0
+
+    means = means[positive]
+    variances = (means * covs[positive]) ** 2.0
 
-            epsilon = epsilon_provider.epsilon(asset)
-            sigma = math.sqrt(
-                        math.log((variance / mean_ratio ** 2.0) + 1.0))
+    # one epsilon for each positive mean loss ratio, drawn in order
+    epsilons = array([epsilon_provider.epsilon(asset)
+                      for _ in xrange(means.size)], dtype=float)
 
-            mu = math.log(mean_ratio ** 2.0 / math.sqrt(
-                    variance + mean_ratio ** 2.0))
+    sigmas = sqrt(log((variances / means ** 2.0) + 1.0))
+    mus = log(means ** 2.0 / sqrt(variances + means ** 2.0))
 
-            loss_ratios.append(math.exp(mu + (epsilon * sigma)))
+    loss_ratios[positive] = exp(mus + (epsilons * sigmas))
 
-    return array(loss_ratios)
+    return loss_ratios
 
 
 def _mean_based(vuln_function, gmf_set):
@@ -888,30 +1001,22 @@ def _mean_based(vuln_function, gmf_set):
         **TSES** - time representative of the Stochastic Event Set (float)
     """
 
-    loss_ratios = []
-    retrieved = {}
     imls = vuln_function.imls
+    ground_motion_values = array(gmf_set["IMLs"], dtype=float)
 
     # seems like with numpy you can only specify a single fill value
     # if the x_new is outside the range. Here we need two different values,
     # depending if the x_new is below or upon the defined values
-    for ground_motion_field in gmf_set["IMLs"]:
-        if ground_motion_field < imls[0]:
-            loss_ratios.append(0.0)
-        elif ground_motion_field > imls[-1]:
-            loss_ratios.append(vuln_function.loss_ratios[-1])
-        else:
-            # The actual value is computed later
-            mark = len(loss_ratios)
-            retrieved[mark] = gmf_set['IMLs'][mark]
-            loss_ratios.append(0.0)
-
-    means = vuln_function.loss_ratio_for(retrieved.values())
+    below = ground_motion_values < imls[0]
+    above = ground_motion_values > imls[-1]
+    inside = ~(below | above)
 
-    for mark, mean_ratio in zip(retrieved.keys(), means):
-        loss_ratios[mark] = mean_ratio
+    loss_ratios = zeros(ground_motion_values.shape)
+    loss_ratios[above] = vuln_function.loss_ratios[-1]
+    loss_ratios[inside] = vuln_function.loss_ratio_for(
+        ground_motion_values[inside])
 
-    return array(loss_ratios)
+    return loss_ratios
 
 
 def _compute_loss_ratios_range(loss_ratios, loss_histogram_bins):
@@ -1143,7 +1248,26 @@ class AggregateLossCurve(object):
 
         assert self.losses.shape == losses.shape
 
-        self.losses = self.losses + losses
+        self.losses += losses
+
+    def append_from_kvs(self, key):
+        """
+        Accumulate the partial losses stored in the kvs with
+        :py:func:`store_partial_losses`. The partial losses are removed
+        from the kvs.
+
+        :param key: the kvs key returned by :py:func:`store_partial_losses`,
+            `None` for blocks without losses.
+        """
+        if key is None:
+            return
+
+        pipe = kvs.get_client().pipeline()
+        pipe.get(key)
+        pipe.delete(key)
+        data, _ = pipe.execute()
+
+        self.append(frombuffer(data, dtype=float))
 
     @property
     def empty(self):
@@ -1180,6 +1304,28 @@ class AggregateLossCurve(object):
         return _generate_curve(loss_range, probs_of_exceedance)
 
 
+def store_partial_losses(job_id, block_id, losses):
+    """
+    Store the (partial) aggregate losses computed for a block in the kvs.
+
+    The losses are stored as raw binary data, so that the control node can
+    accumulate the partial losses of the blocks one at a time (see
+    :py:meth:`AggregateLossCurve.append_from_kvs`) instead of receiving all
+    of them through the celery result backend.
+
+    :param losses: the losses of the block, `None` if the block has no assets
+    :type losses: 1-dimensional :py:class:`numpy.ndarray`
+    :returns: the kvs key of the stored losses or `None` if there are no
+        losses to store
+    """
+    if losses is None:
+        return None
+
+    key = kvs.tokens.aggregate_losses_key(job_id, block_id)
+    kvs.get_client().set(key, asarray(losses, dtype=float).tostring())
+    return key
+
+
 def load_gmvs_at(job_id, point):
     """
     From the KVS, load all the ground motion values for the given point. We
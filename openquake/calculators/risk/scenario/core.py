@@ -29,6 +29,7 @@ from openquake import shapes
 
 from openquake.output import risk as risk_output
 from openquake.parser import vulnerability
+from openquake.utils import tasks as utils_tasks
 from openquake.calculators.risk import general
 
 
@@ -59,8 +60,9 @@ class ScenarioRiskCalculator(general.BaseRiskCalculator):
         for block_id in self.job_ctxt.blocks_keys:
             LOGGER.debug("Dispatching task for block %s of %s"
                 % (block_id, len(self.job_ctxt.blocks_keys)))
-            a_task = general.compute_risk.delay(
-                self.job_ctxt.job_id, block_id, vuln_model=vuln_model)
+            a_task = utils_tasks.submit(
+                general.compute_risk, self.job_ctxt.job_id, block_id,
+                vuln_model=vuln_model)
             tasks.append(a_task)
 
         for task in tasks:
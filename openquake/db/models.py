@@ -49,6 +49,16 @@ def profile4job(job_id):
     return j2p.oq_job_profile
 
 
+def checkpoints4job(job_id):
+    """Return the units of work completed by the given job.
+
+    :param int job_id: identifier of the job in question
+    :returns: a set of unit identifiers (strings)
+    """
+    return set(JobCheckpoint.objects.filter(
+        oq_job=job_id).values_list('unit', flat=True))
+
+
 def inputs4job(job_id, input_type=None, path=None):
     """Return the inputs for the given job, input type and path.
 
@@ -752,11 +762,35 @@ class JobStats(djm.Model):
     # The number of logic tree samples
     # (for hazard jobs of all types except scenario)
     realizations = djm.IntegerField(null=True)
+    # The progress of the current phase of a running job, see
+    # :class:`openquake.utils.stats.ProgressEstimator`
+    phase = djm.TextField(null=True, choices=(
+        (u'hazard', u'Hazard'),
+        (u'risk', u'Risk'),
+    ))
+    units_done = djm.IntegerField(null=True)
+    units_total = djm.IntegerField(null=True)
+    # Units of work per second
+    throughput = djm.FloatField(null=True)
+    eta = djm.DateTimeField(null=True)
 
     class Meta:
         db_table = 'uiapi\".\"job_stats'
 
 
+class JobCheckpoint(djm.Model):
+    '''
+    A unit of work completed by a job, see :func:`checkpoints4job`.
+    '''
+    oq_job = djm.ForeignKey('OqJob')
+    unit = djm.TextField()
+    completed_at = djm.DateTimeField(editable=False, default=datetime.utcnow)
+
+    class Meta:
+        db_table = 'uiapi\".\"job_checkpoint'
+        unique_together = ('oq_job', 'unit')
+
+
 class Job2profile(djm.Model):
     '''
     Associates jobs with their profiles.
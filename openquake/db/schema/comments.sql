@@ -395,6 +395,15 @@ COMMENT ON COLUMN uiapi.oq_job.duration IS 'The job''s duration in seconds (only
 COMMENT ON TABLE uiapi.job_stats IS 'Tracks various job statistics';
 COMMENT ON COLUMN uiapi.job_stats.num_sites IS 'The number of total sites in the calculation';
 COMMENT ON COLUMN uiapi.job_stats.realizations IS 'The number of logic tree samples in the calculation (for hazard jobs of all types except scenario)';
+COMMENT ON COLUMN uiapi.job_stats.phase IS 'The phase (hazard or risk) a running job is working on';
+COMMENT ON COLUMN uiapi.job_stats.units_done IS 'The number of units of work (e.g. sites) of the phase completed so far';
+COMMENT ON COLUMN uiapi.job_stats.units_total IS 'The number of units of work of the phase';
+COMMENT ON COLUMN uiapi.job_stats.throughput IS 'The units of work completed per second (moving average)';
+COMMENT ON COLUMN uiapi.job_stats.eta IS 'The estimated completion time of the phase';
+
+
+COMMENT ON TABLE uiapi.job_checkpoint IS 'The units of work completed by a job, skipped when the job is resumed';
+COMMENT ON COLUMN uiapi.job_checkpoint.unit IS 'Identifies a unit of work, e.g. a calculation phase (hazard, risk) or a block of sites';
 
 
 COMMENT ON TABLE uiapi.oq_job_profile IS 'Holds the parameters needed to invoke the OpenQuake engine.';
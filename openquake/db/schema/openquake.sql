@@ -606,7 +606,26 @@ CREATE TABLE uiapi.job_stats (
     -- The number of total sites in the calculation
     num_sites INTEGER NOT NULL,
     -- The number of logic tree samples (for hazard jobs of all types except scenario)
-    realizations INTEGER
+    realizations INTEGER,
+    -- The progress of the current phase of a running job
+    phase VARCHAR CONSTRAINT job_stats_phase
+        CHECK(phase IS NULL OR phase IN ('hazard', 'risk')),
+    units_done INTEGER,
+    units_total INTEGER,
+    -- Units of work per second, moving average
+    throughput float,
+    eta timestamp with time zone
+) TABLESPACE uiapi_ts;
+
+
+-- The units of work completed by a job, used to resume interrupted jobs
+CREATE TABLE uiapi.job_checkpoint (
+    id SERIAL PRIMARY KEY,
+    oq_job_id INTEGER NOT NULL,
+    unit VARCHAR NOT NULL,
+    completed_at timestamp without time zone
+        DEFAULT timezone('UTC'::text, now()) NOT NULL,
+    UNIQUE (oq_job_id, unit)
 ) TABLESPACE uiapi_ts;
 
 
@@ -1835,6 +1854,9 @@ FOREIGN KEY (owner_id) REFERENCES admin.oq_user(id) ON DELETE RESTRICT;
 ALTER TABLE uiapi.job_stats ADD CONSTRAINT  uiapi_job_stats_oq_job_fk
 FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
 
+ALTER TABLE uiapi.job_checkpoint ADD CONSTRAINT uiapi_job_checkpoint_oq_job_fk
+FOREIGN KEY (oq_job_id) REFERENCES uiapi.oq_job(id) ON DELETE CASCADE;
+
 ALTER TABLE uiapi.input2job ADD CONSTRAINT  uiapi_input2job_input_fk
 FOREIGN KEY (input_id) REFERENCES uiapi.input(id) ON DELETE CASCADE;
 
@@ -20,11 +20,17 @@
 """
 
 
-import md5
+import contextlib
+import fcntl
+import hashlib
 import os
 import re
+import shelve
+import whichdb
 
 from datetime import datetime
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from ConfigParser import ConfigParser
 from lxml import etree
 
@@ -38,12 +44,14 @@ from django.core.exceptions import ObjectDoesNotExist
 from openquake.calculators.hazard import CALCULATORS as HAZ_CALCS
 from openquake.calculators.risk import CALCULATORS as RISK_CALCS
 from openquake.db.models import CharArrayField
+from openquake.db.models import checkpoints4job
 from openquake.db.models import ExposureData
 from openquake.db.models import FloatArrayField
 from openquake.db.models import Input
 from openquake.db.models import Input2job
 from openquake.db.models import inputs4job
 from openquake.db.models import Job2profile
+from openquake.db.models import JobCheckpoint
 from openquake.db.models import JobStats
 from openquake.db.models import ModelContent
 from openquake.db.models import OqJob
@@ -65,6 +73,7 @@ from openquake.kvs import mark_job_as_current
 from openquake.supervising import supervisor
 from openquake.utils import config as utils_config
 from openquake.utils import stats
+from openquake.utils import tasks as utils_tasks
 
 CALCS = dict(hazard=HAZ_CALCS, risk=RISK_CALCS)
 RE_INCLUDE = re.compile(r'^(.*)_INCLUDE')
@@ -326,9 +335,13 @@ class JobContext(object):
     def _record_initial_stats(self):
         '''
         Report initial job stats (such as start time) by adding a
-        uiapi.job_stats record to the db.
+        uiapi.job_stats record to the db. The record of a resumed job is
+        updated instead.
         '''
-        job_stats = JobStats(oq_job=self.oq_job)
+        try:
+            job_stats = JobStats.objects.get(oq_job=self.oq_job)
+        except ObjectDoesNotExist:
+            job_stats = JobStats(oq_job=self.oq_job)
         job_stats.start_time = datetime.utcnow()
         job_stats.num_sites = len(self.sites_to_compute())
 
@@ -530,16 +543,172 @@ def _prepare_config_parameters(params, sections):
     return new_params, sections
 
 
+# Input files are hashed in chunks of this size (in bytes).
+DIGEST_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _compute_digest(path):
+    """Compute the md5sum digest of the file with the given path.
+
+    The file is read in chunks of `DIGEST_CHUNK_SIZE` bytes.
+
+    :param str path: file path
+    :returns: a string of length 32 with the md5sum digest
+    """
+    checksum = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(DIGEST_CHUNK_SIZE), ''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _file_signature(path):
+    """Return the (absolute path, size, mtime, inode) tuple for the file with
+    the given path.
+
+    A cached digest is only valid as long as the signature of the file did
+    not change.
+    """
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+    return (abs_path, stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+def _digest_cache_key(abs_path):
+    """The digest cache key for the given absolute file path."""
+    if isinstance(abs_path, unicode):
+        abs_path = abs_path.encode("utf-8")
+    return abs_path
+
+
+def _digest_cache_path():
+    """Return the path of the input file digest cache configured in the
+    `inputs` section of openquake.cfg or `None` if no cache is configured.
+    """
+    path = utils_config.get("inputs", "digest_cache")
+    if not path:
+        return None
+    return os.path.expanduser(path)
+
+
+@contextlib.contextmanager
+def _locked_digest_cache(path, exclusive=False):
+    """Open the digest cache with the given path as a :py:mod:`shelve`.
+
+    Concurrent jobs share the cache: the shelve is only open while a
+    :py:func:`fcntl.flock` is held on the `<path>.lock` file, shared for
+    reading and exclusive for writing.
+
+    :param bool exclusive: open the cache for writing
+    """
+    cache_dir = os.path.dirname(path)
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            cache = shelve.open(path, "c" if exclusive else "r")
+            try:
+                yield cache
+            finally:
+                cache.close()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _cached_digests(path, signatures):
+    """Return the digests found in the digest cache with the given path.
+
+    Any error while reading the cache is logged and handled as a cache
+    miss.
+
+    :param dict signatures: maps file paths to their signatures, see
+        :py:func:`_file_signature`
+    :returns: a dictionary mapping the file paths with a valid cached digest
+        to the digest
+    """
+    if not whichdb.whichdb(path):
+        # the cache was not created yet
+        return dict()
+    digests = dict()
+    try:
+        with _locked_digest_cache(path) as cache:
+            for file_path, signature in signatures.iteritems():
+                entry = cache.get(_digest_cache_key(signature[0]))
+                if entry is not None and entry[0] == signature[1:]:
+                    digests[file_path] = entry[1]
+    except Exception, e:
+        logs.LOG.warn("Cannot read the input digest cache (%s): %s"
+                      % (path, e))
+        return dict()
+    return digests
+
+
+def _cache_digests(path, entries):
+    """Store digests in the digest cache with the given path.
+
+    Any error while writing the cache is logged and ignored.
+
+    :param entries: (signature, digest) pairs, see
+        :py:func:`_file_signature`
+    """
+    try:
+        with _locked_digest_cache(path, exclusive=True) as cache:
+            for signature, digest in entries:
+                cache[_digest_cache_key(signature[0])] = (
+                    signature[1:], digest)
+    except Exception, e:
+        logs.LOG.warn("Cannot write the input digest cache (%s): %s"
+                      % (path, e))
+
+
+def _file_digests(paths):
+    """Return the md5sum digests of the files with the given paths.
+
+    Digests found in the digest cache (see :py:func:`_digest_cache_path`)
+    are reused if the size, modification time and inode of the file did not
+    change. The remaining files are hashed in a pool of threads if
+    `digest_threads` is set to a value greater than 1 in the `inputs` section
+    of openquake.cfg. The cache is not held open while hashing.
+
+    :param paths: file paths
+    :returns: a dictionary mapping the given paths to their digests
+    """
+    signatures = dict((path, _file_signature(path)) for path in set(paths))
+
+    cache_path = _digest_cache_path()
+    digests = dict()
+    if cache_path is not None:
+        digests = _cached_digests(cache_path, signatures)
+    missing = [path for path in signatures if path not in digests]
+
+    threads = int(utils_config.get("inputs", "digest_threads") or 0)
+    if threads > 1 and len(missing) > 1:
+        # hashlib releases the GIL while hashing large chunks.
+        pool = ThreadPool(min(threads, len(missing)))
+        try:
+            computed = pool.map(_compute_digest, missing)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        computed = [_compute_digest(path) for path in missing]
+
+    digests.update(izip(missing, computed))
+    if cache_path is not None and missing:
+        _cache_digests(cache_path, [(signatures[path], digests[path])
+                                    for path in missing])
+
+    return digests
+
+
 def _file_digest(path):
     """Return a 32 character digest for the file with the given path.
 
     :param str path: file path
     :returns: a string of length 32 with the md5sum digest
     """
-    checksum = md5.new()
-    with open(path) as fh:
-        checksum.update(fh.read())
-        return checksum.hexdigest()
+    return _file_digests([path])[path]
 
 
 def _identical_input(input_type, digest, owner_id):
@@ -596,9 +765,20 @@ def _insert_input_files(params, job, force_inputs):
 
     inputs_seen = []
 
+    # Compute the digests of all input files (including the source models
+    # referenced by logic trees) in one go.
+    paths = []
+    for param_key, file_type in INPUT_FILE_TYPES.items():
+        if param_key not in params:
+            continue
+        paths.append(params[param_key])
+        if file_type == "lt_source":
+            paths.extend(_get_source_models(params[param_key]))
+    digests = _file_digests(paths)
+
     def ln_input2job(path, input_type):
         """Link identical or newly created input to the given job."""
-        digest = _file_digest(path)
+        digest = digests.get(path) or _file_digest(path)
         linked_inputs = inputs4job(job.id)
         if any(li.digest == digest and li.input_type == input_type
                for li in linked_inputs):
@@ -831,9 +1011,15 @@ def run_job(job, params, sections, output_type='db', log_level='warn',
     if not output_type in ('db', 'xml'):
         raise RuntimeError("output_type must be 'db' or 'xml'")
 
+    local = utils_tasks.executor() == 'local'
+    if kvs.backend() == 'memory' and not local:
+        raise RuntimeError(
+            "The memory kvs backend requires the local task executor")
+
     job.description = job.profile().description
     job.status = 'running'
     job.save()
+    kvs.bump_job_status_generation(job.id)
 
     # Clear any counters for this job_id, prior to running the
     # job.
@@ -858,6 +1044,10 @@ def run_job(job, params, sections, output_type='db', log_level='warn',
     # the connection it immediately becomes unavailable for other
     close_connection()
 
+    if local:
+        _run_job_locally(job, job_ctxt, sections, log_level, log_file)
+        return job
+
     job_pid = os.fork()
     if not job_pid:
         # calculation executor process
@@ -869,10 +1059,12 @@ def run_job(job, params, sections, output_type='db', log_level='warn',
                               % str(ex))
             job.status = 'failed'
             job.save()
+            kvs.bump_job_status_generation(job.id)
             raise
         else:
             job.status = 'succeeded'
             job.save()
+            kvs.bump_job_status_generation(job.id)
         return
 
     supervisor_pid = os.fork()
@@ -898,6 +1090,41 @@ def run_job(job, params, sections, output_type='db', log_level='warn',
     return job
 
 
+def _run_job_locally(job, job_ctxt, sections, log_level, log_file=None):
+    """Run the job in this process, with its tasks executed by the local
+    executor (see :func:`openquake.utils.tasks.submit`).
+
+    There is neither an AMQP log channel nor a supervisor process: the log
+    messages are written to the console (or `log_file`) directly and the
+    job's status, stop time and kvs data are taken care of here.
+    """
+    if log_file is not None:
+        handler = supervisor.SupervisorLogFileHandler(job.id, log_file)
+    else:
+        handler = supervisor.SupervisorLogStreamHandler(job.id)
+    logs.logging.root.addHandler(handler)
+    logs.set_logger_level(logs.logging.root, log_level)
+
+    # The local workers must be started before the JVM.
+    utils_tasks.start_local_pool()
+    try:
+        _launch_job(job_ctxt, sections)
+    except Exception, ex:
+        logs.LOG.critical("Calculation failed with exception: '%s'"
+                          % str(ex))
+        job.status = 'failed'
+        raise
+    else:
+        job.status = 'succeeded'
+    finally:
+        utils_tasks.stop_local_pool()
+        job.save()
+        kvs.bump_job_status_generation(job.id)
+        supervisor.record_job_stop_time(job.id)
+        supervisor.cleanup_after_job(job.id)
+        logs.logging.root.removeHandler(handler)
+
+
 def _launch_job(job_ctxt, sections):
     """Instantiate calculator(s) and actually run the job.
 
@@ -923,11 +1150,17 @@ def _launch_job(job_ctxt, sections):
         os.makedirs(output_dir)
 
     calc_mode = job_ctxt.oq_job_profile.calc_mode
+    completed = checkpoints4job(job_ctxt.job_id)
 
     for job_type in ('hazard', 'risk'):
         if not job_type.upper() in sections:
             continue
 
+        if job_type in completed:
+            logs.LOG.info("Skipping the %s calculation of job %s, completed "
+                          "by an earlier run" % (job_type, job_ctxt.job_id))
+            continue
+
         calc_class = CALCS[job_type][calc_mode]
 
         calculator = calc_class(job_ctxt)
@@ -939,6 +1172,51 @@ def _launch_job(job_ctxt, sections):
         calculator.execute()
         calculator.post_execute()
 
+        JobCheckpoint.objects.get_or_create(oq_job=job_ctxt.oq_job,
+                                            unit=job_type)
+
+
+# The calculation modes whose calculators record the units of work they
+# complete and can hence be resumed, see resume_job(). The calculators of
+# the other modes would recompute (and store again) all of their outputs.
+RESUMABLE_MODES = set(
+    ['classical', 'event_based', 'classical_bcr', 'event_based_bcr'])
+
+
+def resume_job(job_id, path_to_cfg):
+    """Prepare the resumption of a job that did not complete.
+
+    The units of work completed by the earlier runs of the job (see
+    :meth:`openquake.calculators.base.Calculator.record_unit`) are skipped
+    when the job is passed to :func:`run_job` again.
+
+    :param int job_id: identifier of the job to resume
+    :param str path_to_cfg: path to the config file the job was started
+        with; the job parameters are not persisted in full, so they are
+        parsed again.
+    :returns: a tuple of :class:`openquake.db.models.OqJob` instance,
+        params dict, and sections list, to be passed to :func:`run_job`.
+    :raises RuntimeError: if the job does not exist, has succeeded or its
+        calculation mode does not support resumption (see
+        :data:`RESUMABLE_MODES`).
+    """
+    try:
+        job = OqJob.objects.get(id=job_id)
+    except ObjectDoesNotExist:
+        raise RuntimeError("Job %s does not exist" % job_id)
+
+    if job.status == 'succeeded':
+        raise RuntimeError("Job %s has already succeeded" % job_id)
+
+    params, sections = _parse_config_file(path_to_cfg)
+    params, sections = _prepare_config_parameters(params, sections)
+
+    calc_mode = CALCULATION_MODE[params['CALCULATION_MODE']]
+    if calc_mode not in RESUMABLE_MODES:
+        raise RuntimeError("Jobs in %s mode cannot be resumed"
+                           % params['CALCULATION_MODE'])
+    return job, params, sections
+
 
 def import_job_profile(path_to_cfg, job, user_name='openquake',
                        force_inputs=False):
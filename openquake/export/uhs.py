@@ -20,11 +20,16 @@ database.
 
 
 import h5py
+import itertools
 import numpy
 import os
 
+from django.db import connections
+from django.db import router
+
 from openquake.db import models
 from openquake.export.core import makedirs
+from openquake.utils import config
 from openquake.utils import round_float
 from openquake.output import uhs as uhs_output
 
@@ -33,41 +38,34 @@ _DS_NAME_FMT = 'lon:%s-lat:%s'
 _HDF5_FILE_NAME_FMT = 'uhs_poe:%s.hdf5'
 _XML_FILE_NAME = 'uhs.xml'
 
+#: Dataset names used in consolidated UHS result files
+_CONSOLIDATED_DS_NAME = 'uhs'
+_SITES_DS_NAME = 'sites'
 
-def _point_to_ds_name(point):
-    """Generate a dataset name from a
-    :class:`django.contrib.gis.geos.point.Point`. This dataset name is meant to
-    be used in UHS HDF5 result files.
-
-    :param point:
-        :class:`django.contrib.gis.geos.point.Point` object.
-    :returns:
-        A dataset name generated from the point's lat/lon values. Example::
-
-            "lon:-179.45-lat:-20.75"
-
-    A simple example:
-
-    >>> from django.contrib.gis.geos.point import Point
-    >>> pt = Point(-179.45, -20.75)
-    >>> _point_to_ds_name(pt)
-    'lon:-179.45-lat:-20.75'
+#: Number of rows fetched per round trip from the server side cursor
+_FETCH_SIZE = 10000
+#: Number of sites written at once to a consolidated UHS dataset
+_SITE_BATCH_SIZE = 1000
 
-    This function uses :function:`openquake.utils.round_float` to round
-    coordinate values. Thus, any coordinate value with more than 7 digits after
-    the decimal will be rounded to 7 digits:
-
-    >>> pt = Point(-179.12345675, 79.12345674)
-    >>> _point_to_ds_name(pt)
-    'lon:-179.1234568-lat:79.1234567'
-    """
-    return _DS_NAME_FMT % (round_float(point.x), round_float(point.y))
+_UHS_DATA_QUERY = """
+SELECT ST_X(location), ST_Y(location), realization, sa_values
+FROM hzrdr.uh_spectrum_data
+WHERE uh_spectrum_id = %s
+ORDER BY ST_X(location), ST_Y(location), realization
+"""
 
 
 @makedirs
 def export_uhs(output, target_dir):
     """Export the specified ``output`` to the ``target_dir``.
 
+    The data of each PoE is read in a single pass and written site by site.
+    If the `consolidated_uhs_export` flag is set in the `hazard` section of
+    openquake.cfg, each result file holds a single (sites x realizations x
+    periods) dataset and a table of site coordinates (see
+    :function:`write_consolidated_uhs_data`) instead of one dataset per
+    site.
+
     :param output:
         :class:`openquake.db.models.Output` associated with UHS calculation
         results.
@@ -84,31 +82,27 @@ def export_uhs(output, target_dir):
 
     uh_spectrums = models.UhSpectrum.objects.filter(uh_spectra=uh_spectra.id)
 
+    consolidated = config.flag_set('hazard', 'consolidated_uhs_export')
+
     # accumulate a list of (poe, path) pairs to serialize to NRML XML
     # each `path` is the full path to a result hdf5 file
     nrml_data = []
 
     for spectrum in uh_spectrums:
         # create a file for each spectrum/poe
-        uhs_data = models.UhSpectrumData.objects.filter(
-            uh_spectrum=spectrum.id)
-
-        # If there are multiple LT samples/realizations, we'll have multiple
-        # records for each site. However, there should only be a 1 dataset per
-        # site so we need to 'uniquify'.
-        ds_names = list(set([_point_to_ds_name(datum.location)
-                             for datum in uhs_data]))
-
-        # Create the empty result file
-        file_name = touch_result_hdf5_file(
-            target_dir, spectrum.poe, ds_names, uh_spectra.realizations,
-            len(uh_spectra.periods))
-        file_name = os.path.abspath(file_name)
-
+        file_name = os.path.abspath(
+            os.path.join(target_dir, _HDF5_FILE_NAME_FMT % spectrum.poe))
         nrml_data.append((spectrum.poe, file_name))
 
-        # Now write the actual data
-        write_uhs_data(file_name, uhs_data)
+        site_blocks = group_uhs_rows(
+            _uhs_data_rows(spectrum.id), uh_spectra.realizations,
+            len(uh_spectra.periods))
+        if consolidated:
+            write_consolidated_uhs_data(
+                file_name, site_blocks, uh_spectra.realizations,
+                len(uh_spectra.periods))
+        else:
+            write_uhs_site_blocks(file_name, site_blocks)
         file_names.append(file_name)
 
     nrml_file_path = os.path.join(target_dir, _XML_FILE_NAME)
@@ -122,59 +116,105 @@ def export_uhs(output, target_dir):
     return file_names
 
 
-def touch_result_hdf5_file(target_dir, poe, ds_names, n_realizations,
-                           n_periods):
-    """Create an empty HDF5 file with appropriately sized datasets. The quanity
-    of datasets created is equal to the length of ``ds_names``. Each dataset
-    will be a 2D matrix with a number of rows == ``n_realizations`` and number
-    of columns == ``n_periods``. Each dataset will be created 'empty'
-    (all values == 0.0).
-
-    The datatype for each value is `numpy.float64`.
+def _uhs_data_rows(spectrum_id):
+    """Read the data of a uniform hazard spectrum from the database, in a
+    single pass over a server side cursor.
 
-    :param str target_dir:
-        Location to place the new file.
-    :param float poe:
-        Probability of Exceedance associated with this file. The PoE will be
-        used to generate the resulting file name.
-    :param list ds_names:
-        List strings representing dataset names. 1 dataset will be created for
-        each name.
-
-        Note: Each dataset name should be unique.
+    :param int spectrum_id:
+        ID of a :class:`openquake.db.models.UhSpectrum`.
+    :returns:
+        A generator of (lon, lat, realization, sa_values) tuples, ordered by
+        site and realization.
+    """
+    connection = connections[router.db_for_read(models.UhSpectrumData)]
+    # Make sure the underlying DB-API connection is open.
+    connection.cursor()
+    cursor = connection.connection.cursor(name='uhs_export_%s' % spectrum_id)
+    try:
+        cursor.execute(_UHS_DATA_QUERY, (spectrum_id,))
+        while True:
+            rows = cursor.fetchmany(_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+def group_uhs_rows(rows, n_realizations, n_periods):
+    """Group UHS data rows by site, one site at a time.
+
+    :param rows:
+        An iterable of (lon, lat, realization, sa_values) tuples, where the
+        rows of each site are adjacent.
     :param int n_realizations:
-        Number of rows in each dataset.
+        Number of realizations (rows of each site's matrix).
     :param int n_periods:
-        Number of columns in each dataset.
-
+        Number of periods (columns of each site's matrix).
     :returns:
-        The full path of the created file.
+        A generator of ((lon, lat), matrix) pairs, where `matrix` is a
+        (``n_realizations`` x ``n_periods``) `numpy.float64` array holding
+        the SA values of each realization.
     """
-    file_name = _HDF5_FILE_NAME_FMT % poe
-    full_path = os.path.join(target_dir, file_name)
-
-    ds_shape = (n_realizations, n_periods)
-
-    with h5py.File(full_path, 'w') as h5_file:
-        for name in ds_names:
-            h5_file.create_dataset(name, dtype=numpy.float64, shape=ds_shape)
+    for coords, site_rows in itertools.groupby(rows, lambda row: row[:2]):
+        matrix = numpy.zeros((n_realizations, n_periods), dtype=numpy.float64)
+        for _lon, _lat, realization, sa_values in site_rows:
+            matrix[realization] = sa_values
+        yield coords, matrix
+
+
+def write_uhs_site_blocks(hdf5_file, site_blocks):
+    """Write a UHS HDF5 file with a dataset per site. Each dataset is
+    written with a single assignment.
+
+    :param str hdf5_file:
+        Path of the file to create.
+    :param site_blocks:
+        An iterable of ((lon, lat), matrix) pairs, see
+        :function:`group_uhs_rows`.
+    """
+    with h5py.File(hdf5_file, 'w') as h5_file:
+        for (lon, lat), matrix in site_blocks:
+            ds_name = _DS_NAME_FMT % (round_float(lon), round_float(lat))
+            h5_file.create_dataset(ds_name, data=matrix)
 
-    return full_path
 
+def write_consolidated_uhs_data(hdf5_file, site_blocks, n_realizations,
+                                n_periods):
+    """Write a UHS HDF5 file with two datasets:
 
-def write_uhs_data(hdf5_file, uhs_data):
-    """Given a path to an empty UHS HDF5 file (see
-    :function:`touch_result_hdf5_file`), write data (spectral acceleration
-    values) into the correct row in the correct dataset.
+        * 'uhs', a (sites x realizations x periods) matrix of SA values
+        * 'sites', a (sites x 2) table of the (lon, lat) site coordinates
 
-    :param str h5df_file:
-        Path to the empty HDF5 file. The datasets should already be created.
-    :param uhs_data:
-        An iterable of :class:`openquake.db.models.UhSpectrumData` objects.
+    :param str hdf5_file:
+        Path of the file to create.
+    :param site_blocks:
+        An iterable of ((lon, lat), matrix) pairs, see
+        :function:`group_uhs_rows`.
+    :param int n_realizations:
+        Number of realizations.
+    :param int n_periods:
+        Number of periods.
     """
-    with h5py.File(hdf5_file, 'a') as h5_file:
-        for datum in uhs_data:
-            ds_name = _point_to_ds_name(datum.location)
-            # The `realization` is the row in the dataset.
-            # Each dataset is a 2D matrix of floats.
-            h5_file[ds_name][datum.realization] = datum.sa_values
+    site_blocks = iter(site_blocks)
+    with h5py.File(hdf5_file, 'w') as h5_file:
+        uhs = h5_file.create_dataset(
+            _CONSOLIDATED_DS_NAME, dtype=numpy.float64,
+            shape=(0, n_realizations, n_periods),
+            maxshape=(None, n_realizations, n_periods))
+        sites = h5_file.create_dataset(
+            _SITES_DS_NAME, dtype=numpy.float64, shape=(0, 2),
+            maxshape=(None, 2))
+
+        while True:
+            batch = list(itertools.islice(site_blocks, _SITE_BATCH_SIZE))
+            if not batch:
+                break
+            coords, matrices = zip(*batch)
+            start = sites.shape[0]
+            end = start + len(batch)
+            uhs.resize(end, axis=0)
+            uhs[start:end] = numpy.array(matrices)
+            sites.resize(end, axis=0)
+            sites[start:end] = numpy.array(coords)
@@ -33,6 +33,7 @@ except ImportError:
 
 from lxml import etree
 
+from openquake.java import jclass
 from openquake.java import jvm
 from openquake.nrml.utils import nrml_schema_file
 
@@ -188,44 +189,35 @@ class BranchSet(object):
         Return ``True`` if ``mfd`` is opensha GR MFD object
         (and in particular not evenly discretized function).
         """
-        classname = 'org.opensha.sha.magdist.GutenbergRichterMagFreqDist'
-        return isinstance(mfd, jvm().JClass(classname))
+        return isinstance(mfd, jclass('GutenbergRichterMagFreqDist'))
 
     @classmethod
     def _is_point(cls, source):
         """
         Return ``True`` if ``source`` is opensha source of point type.
         """
-        classname = 'org.opensha.sha.earthquake.rupForecastImpl.' \
-                    'GEM1.SourceData.GEMPointSourceData'
-        return isinstance(source, jvm().JClass(classname))
+        return isinstance(source, jclass('GEMPointSourceData'))
 
     @classmethod
     def _is_simplefault(cls, source):
         """
         Return ``True`` if ``source`` is opensha source of simple fault type.
         """
-        classname = 'org.opensha.sha.earthquake.rupForecastImpl.' \
-                    'GEM1.SourceData.GEMFaultSourceData'
-        return isinstance(source, jvm().JClass(classname))
+        return isinstance(source, jclass('GEMFaultSourceData'))
 
     @classmethod
     def _is_complexfault(cls, source):
         """
         Return ``True`` if ``source`` is opensha source of complex fault type.
         """
-        classname = 'org.opensha.sha.earthquake.rupForecastImpl.' \
-                    'GEM1.SourceData.GEMSubductionFaultSourceData'
-        return isinstance(source, jvm().JClass(classname))
+        return isinstance(source, jclass('GEMSubductionFaultSourceData'))
 
     @classmethod
     def _is_area(cls, source):
         """
         Return ``True`` if ``source`` is opensha source of area type.
         """
-        classname = 'org.opensha.sha.earthquake.rupForecastImpl.' \
-                    'GEM1.SourceData.GEMAreaSourceData'
-        return isinstance(source, jvm().JClass(classname))
+        return isinstance(source, jclass('GEMAreaSourceData'))
 
     def filter_source(self, source):
         # pylint: disable=R0911,R0912
@@ -1021,8 +1013,7 @@ class LogicTreeProcessor(object):
             the java class ``org.gem.JsonSerializer`` is used.
         """
         rnd = random.Random(random_seed)
-        sm_reader = jvm().JClass('org.gem.engine.hazard.'
-                                 'parsers.SourceModelReader')
+        sm_reader = jclass('SourceModelReader')
         branch = self.source_model_lt.root_branchset.sample(rnd)
         sources = sm_reader(branch.value, float(mfd_bin_width)).read()
         while True:
@@ -1033,7 +1024,7 @@ class LogicTreeProcessor(object):
             for source in sources:
                 branchset.apply_uncertainty(branch.value, source)
 
-        serializer = jvm().JClass('org.gem.JsonSerializer')
+        serializer = jclass('JsonSerializer')
         return serializer.getJsonSourceList(sources)
 
     def sample_and_save_gmpe_logictree(self, cache, key, random_seed):
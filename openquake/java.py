@@ -25,6 +25,8 @@ import logging
 
 from functools import wraps
 
+from celery.signals import worker_process_init
+
 from openquake.nrml import utils as nrml_utils
 from openquake.utils import config
 
@@ -76,13 +78,70 @@ JAVA_CLASSES = {
     "PythonBridgeAppender": "org.gem.log.PythonBridgeAppender",
     "DisaggregationCalculator": "org.gem.calc.DisaggregationCalculator",
     "UHSCalculator": "org.gem.calc.UHSCalculator",
+    # classes used for type checks by the logic tree processor
+    "GutenbergRichterMagFreqDist":
+        "org.opensha.sha.magdist.GutenbergRichterMagFreqDist",
+    "GEMPointSourceData":
+        "org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData."
+        "GEMPointSourceData",
+    "GEMFaultSourceData":
+        "org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData."
+        "GEMFaultSourceData",
+    "GEMSubductionFaultSourceData":
+        "org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData."
+        "GEMSubductionFaultSourceData",
+    "GEMAreaSourceData":
+        "org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData."
+        "GEMAreaSourceData",
 }
 
+# Module-private cache of resolved java classes, to be used by jclass().
+__JCLASS_CACHE = {}
+
 
+# pylint: disable=W0603
 def jclass(class_key):
-    """Wrapper around jpype.JClass for short class names"""
-    jvm()
-    return jpype.JClass(JAVA_CLASSES[class_key])
+    """Wrapper around jpype.JClass for short class names.
+
+    The resolved classes are cached, only the first lookup of a class
+    (per process) goes through jpype.
+    """
+    klass = __JCLASS_CACHE.get(class_key)
+    if klass is None:
+        jvm()
+        klass = jpype.JClass(JAVA_CLASSES[class_key])
+        __JCLASS_CACHE[class_key] = klass
+    return klass
+
+
+def preload_classes():
+    """Start the JVM and resolve all the classes in :const:`JAVA_CLASSES`.
+
+    Classes that cannot be found on the classpath are skipped.
+
+    :returns: the number of classes resolved
+    """
+    jpype_ = jvm()
+    for class_key in JAVA_CLASSES:
+        try:
+            jclass(class_key)
+        except jpype_.JavaException:
+            logging.getLogger('java').debug(
+                'java class %s not found, skipping', JAVA_CLASSES[class_key])
+    return len(__JCLASS_CACHE)
+
+
+def _warm_up_worker(**_kwargs):
+    """Start the JVM and resolve the java classes in a celery worker process.
+
+    Connected to the celery `worker_process_init` signal so that the JVM
+    start-up and the classpath scan do not slow down the first task executed
+    by a fresh worker process.
+    """
+    preload_classes()
+
+
+worker_process_init.connect(_warm_up_worker)
 
 
 class JavaLoggingBridge(object):
@@ -220,11 +279,10 @@ def jvm():
     Return the jpype module, after guaranteeing the JVM is running and
     the classpath has been loaded properly.
     """
-    jarpaths = (os.path.abspath(
-                    os.path.join(os.path.dirname(__file__), "../dist")),
-                '/usr/share/java')
-
     if not jpype.isJVMStarted():
+        jarpaths = (os.path.abspath(
+                        os.path.join(os.path.dirname(__file__), "../dist")),
+                    '/usr/share/java')
         max_mem = get_jvm_max_mem()
         jpype.startJVM(jpype.getDefaultJVMPath(),
             "-Xmx%sM" % max_mem,
@@ -326,11 +384,12 @@ def unpack_exception(func):
     """
     @wraps(func)
     def unwrap_exception(*targs, **tkwargs):  # pylint: disable=C0111
-        jvm_instance = jvm()
+        if not jpype.isJVMStarted():
+            jvm()
 
         try:
             return func(*targs, **tkwargs)
-        except jvm_instance.JavaException, e:
+        except jpype.JavaException, e:
             trace = sys.exc_info()[2]
 
             raise JavaException(e), None, trace
@@ -25,6 +25,7 @@ import json
 import numpy
 import redis
 from openquake import logs
+from openquake.kvs import memory
 from openquake.kvs import tokens
 from openquake.utils import config
 
@@ -36,15 +37,32 @@ INTERNAL_ID_SEPARATOR = ':'
 MAX_LENGTH_RANDOM_ID = 36
 SITES_KEY_TOKEN = "sites"
 
+# Maximum number of keys removed by a single DEL/UNLINK command.
+DELETE_BATCH_SIZE = 1000
+# Number of DEL/UNLINK commands sent in one pipeline round trip.
+DELETE_PIPELINE_DEPTH = 16
+
 
 # Module-private kvs connection pool, to be used by get_client().
 __KVS_CONN_POOL = None
 
+# Module-private cache of the UNLINK support of the kvs servers, keyed by
+# (host, port), see _supports_unlink().
+__UNLINK_SUPPORT = dict()
+
+
+def backend():
+    """Return the configured kvs backend, 'redis' (the default) or
+    'memory' (see :mod:`openquake.kvs.memory`)."""
+    return config.get("kvs", "backend") or "redis"
+
 
 # pylint: disable=W0603
 def get_client(**kwargs):
     """Return a redis kvs client connection object."""
     global __KVS_CONN_POOL
+    if backend() == "memory":
+        return memory.get_client()
     if __KVS_CONN_POOL is None:
         cfg = config.get_section("kvs")
         __KVS_CONN_POOL = redis.ConnectionPool(
@@ -53,6 +71,61 @@ def get_client(**kwargs):
     return redis.Redis(**kwargs)
 
 
+def get_dedicated_client():
+    """Return a redis kvs client with a connection of its own.
+
+    The connection pool used by :func:`get_client` holds a single
+    connection; threads running alongside the main one (e.g. to purge
+    data in the background) need a client of their own."""
+    if backend() == "memory":
+        return memory.get_client()
+    cfg = config.get_section("kvs")
+    return redis.Redis(host=cfg["host"], port=int(cfg["port"]))
+
+
+def _supports_unlink(client):
+    """True if both the redis client library and server support UNLINK.
+
+    The server version is only asked once per server and process.
+    """
+    if not hasattr(client, "unlink"):
+        return False
+    settings = client.connection_pool.connection_kwargs
+    server = (settings.get("host"), settings.get("port"))
+    if server not in __UNLINK_SUPPORT:
+        version = client.info().get("redis_version", "0")
+        __UNLINK_SUPPORT[server] = int(version.split(".")[0]) >= 4
+    return __UNLINK_SUPPORT[server]
+
+
+def delete_keys(keys, client=None, batch_size=DELETE_BATCH_SIZE):
+    """Delete the given keys from the kvs in bounded batches.
+
+    The batches are sent through a non-transactional pipeline, so that no
+    single huge DEL stalls the kvs for other clients. UNLINK is used in
+    place of DEL where available, leaving the reclaiming of memory to a
+    server background thread.
+
+    :param keys: the keys to delete
+    :type keys: list of strings
+    :param client: the redis client to use, :func:`get_client` by default
+    :param int batch_size: maximum number of keys per DEL/UNLINK command
+    """
+    if not keys:
+        return
+
+    client = client or get_client()
+    pipe = client.pipeline(transaction=False)
+    delete = pipe.unlink if _supports_unlink(client) else pipe.delete
+
+    for count, start in enumerate(xrange(0, len(keys), batch_size), 1):
+        delete(*keys[start:start + batch_size])
+        if count % DELETE_PIPELINE_DEPTH == 0:
+            pipe.execute()
+
+    pipe.execute()
+
+
 def get_value_json_decoded(key):
     """ Get value from kvs and json decode """
     try:
@@ -122,6 +195,33 @@ def mark_job_as_current(job_id):
     client.sadd(tokens.CURRENT_JOBS, job_id)
 
 
+def bump_job_status_generation(job_id):
+    """
+    Increment the status generation counter of a job.
+
+    This must be called whenever the status of a job changes; worker
+    processes use the counter to invalidate the job data they cache (see
+    :func:`openquake.utils.tasks.get_running_job`).
+
+    :param job_id: the job id
+    :type job_id: int
+    :returns: the new value of the counter
+    """
+    return get_client().incr(tokens.job_status_generation_key(job_id))
+
+
+def job_status_generation(job_id):
+    """
+    Get the status generation counter of a job.
+
+    :param job_id: the job id
+    :type job_id: int
+    :returns: the counter value (as a string) or `None` if the counter does
+        not exist (e.g. because the job's KVS data was garbage collected)
+    """
+    return get_client().get(tokens.job_status_generation_key(job_id))
+
+
 def current_jobs():
     """
     Get all current job keys, sorted in ascending order.
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+An in-process KVS backend, selected by setting `backend = memory` in the
+`kvs` section of openquake.cfg.
+
+:class:`MemoryClient` emulates the subset of the `redis.Redis` client API
+used by the engine. The data is only visible to the threads of the process
+that stored it, i.e. the backend can only be used with the local executor
+(see :mod:`openquake.utils.tasks`).
+"""
+
+import fnmatch
+import threading
+
+
+# Module-private data stores, maps database numbers to (data dict, lock)
+# pairs, to be used by get_client().
+__STORES = dict()
+__STORES_LOCK = threading.Lock()
+
+
+# pylint: disable=W0603
+def get_client(db=0):
+    """Return a client of the in-memory database with the given number."""
+    with __STORES_LOCK:
+        if db not in __STORES:
+            __STORES[db] = (dict(), threading.RLock())
+        data, lock = __STORES[db]
+    return MemoryClient(data, lock)
+
+
+def _str(value):
+    """Values are stored as strings, just like redis does."""
+    return value if isinstance(value, str) else str(value)
+
+
+class MemoryClient(object):
+    """A `redis.Redis` look-alike keeping its data in a dict.
+
+    Strings, hashes, lists and sets are stored as `str`, `dict`, `list` and
+    `set` values respectively.
+    """
+
+    def __init__(self, data, lock):
+        self._data = data
+        self._lock = lock
+
+    def pipeline(self, transaction=True):  # pylint: disable=W0613
+        """Return a :class:`MemoryPipeline` for this client."""
+        return MemoryPipeline(self)
+
+    def info(self):
+        """Server information, there is none to speak of."""
+        return dict(redis_version="0")
+
+    def flushdb(self):
+        """Delete all keys of the database."""
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def keys(self, pattern="*"):
+        """Return the keys matching the given glob-style pattern."""
+        with self._lock:
+            return [key for key in self._data
+                    if fnmatch.fnmatchcase(key, pattern)]
+
+    def exists(self, key):
+        """True if the key exists."""
+        return key in self._data
+
+    def delete(self, *keys):
+        """Delete the given keys, return the number of deleted keys."""
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    deleted += 1
+            return deleted
+
+    def get(self, key):
+        """Return the string value of the key or `None`."""
+        return self._data.get(key)
+
+    def mget(self, keys, *args):
+        """Return the string values of the given keys."""
+        keys = list(keys) + list(args) if args else keys
+        with self._lock:
+            return [self._data.get(key) for key in keys]
+
+    def set(self, key, value):
+        """Set the string value of the key."""
+        self._data[key] = _str(value)
+        return True
+
+    def incr(self, key, amount=1):
+        """Increment the integer value of the key."""
+        with self._lock:
+            value = int(self._data.get(key, 0)) + amount
+            self._data[key] = str(value)
+            return value
+
+    def _container(self, key, container_type):
+        """Return the container stored under the key, create it if needed."""
+        return self._data.setdefault(key, container_type())
+
+    def hget(self, key, field):
+        """Return the value of a hash field or `None`."""
+        with self._lock:
+            return self._data.get(key, dict()).get(field)
+
+    def hset(self, key, field, value):
+        """Set the value of a hash field, return 1 if the field is new."""
+        with self._lock:
+            container = self._container(key, dict)
+            new = field not in container
+            container[field] = _str(value)
+            return int(new)
+
+    def hincrby(self, key, field, amount=1):
+        """Increment the integer value of a hash field."""
+        with self._lock:
+            container = self._container(key, dict)
+            value = int(container.get(field, 0)) + amount
+            container[field] = str(value)
+            return value
+
+    def hgetall(self, key):
+        """Return all fields and values of a hash."""
+        with self._lock:
+            return dict(self._data.get(key, dict()))
+
+    def rpush(self, key, *values):
+        """Append values to a list, return the length of the list."""
+        with self._lock:
+            container = self._container(key, list)
+            container.extend(_str(value) for value in values)
+            return len(container)
+
+    def lpush(self, key, *values):
+        """Prepend values to a list, return the length of the list."""
+        with self._lock:
+            container = self._container(key, list)
+            for value in values:
+                container.insert(0, _str(value))
+            return len(container)
+
+    def lrange(self, key, start, end):
+        """Return the list elements from `start` to `end` (inclusive)."""
+        with self._lock:
+            container = self._data.get(key, list())
+            end = None if end == -1 else end + 1
+            return container[start:end]
+
+    def sadd(self, key, *members):
+        """Add members to a set, return the number of new members."""
+        with self._lock:
+            container = self._container(key, set)
+            before = len(container)
+            container.update(_str(member) for member in members)
+            return len(container) - before
+
+    def srem(self, key, *members):
+        """Remove members from a set, return the number of removed
+        members."""
+        with self._lock:
+            container = self._data.get(key, set())
+            before = len(container)
+            container.difference_update(_str(member) for member in members)
+            if not container:
+                self._data.pop(key, None)
+            return before - len(container)
+
+    def sismember(self, key, member):
+        """True if `member` is a member of the set."""
+        with self._lock:
+            return _str(member) in self._data.get(key, set())
+
+    def smembers(self, key):
+        """Return all members of a set."""
+        with self._lock:
+            return set(self._data.get(key, set()))
+
+
+class MemoryPipeline(object):
+    """Buffer the commands issued to a :class:`MemoryClient` and execute
+    them atomically, like a `redis` transaction."""
+
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+
+        def buffered(*args, **kwargs):  # pylint: disable=C0111
+            self._commands.append((command, args, kwargs))
+            return self
+
+        return buffered
+
+    def execute(self):
+        """Execute the buffered commands, return their results."""
+        # pylint: disable=W0212
+        with self._client._lock:
+            results = [command(*args, **kwargs)
+                       for command, args, kwargs in self._commands]
+        self._commands = []
+        return results
@@ -31,6 +31,8 @@ HAZARD_CURVE_POES_KEY_TOKEN = 'hazard_curve_poes'
 MEAN_HAZARD_CURVE_KEY_TOKEN = 'mean_hazard_curve'
 QUANTILE_HAZARD_CURVE_KEY_TOKEN = 'quantile_hazard_curve'
 STOCHASTIC_SET_TOKEN = 'ses'
+GMF_CHUNK_TOKEN = 'gmf_chunk'
+SITE_INDEX_TOKEN = 'site_index'
 MEAN_HAZARD_MAP_KEY_TOKEN = 'mean_hazard_map'
 QUANTILE_HAZARD_MAP_KEY_TOKEN = 'quantile_hazard_map'
 GMFS_KEY_TOKEN = 'GMFS'
@@ -44,9 +46,12 @@ LOSS_RATIO_CURVE_KEY_TOKEN = 'LOSS_RATIO_CURVE'
 LOSS_CURVE_KEY_TOKEN = 'LOSS_CURVE'
 VULNERABILITY_CURVE_KEY_TOKEN = 'VULNERABILITY_CURVE'
 BCR_BLOCK_KEY_TOKEN = 'BCR_BLOCK'
+AGGREGATE_LOSSES_KEY_TOKEN = 'AGGREGATE_LOSSES'
 
 
 CURRENT_JOBS = 'CURRENT_JOBS'
+COMPLETED_TASKS_TOKEN = 'COMPLETED_TASKS'
+JOB_STATUS_GENERATION_TOKEN = 'STATUS_GENERATION'
 
 
 def _generate_key(job_id, type_, *parts):
@@ -89,6 +94,11 @@ def generate_job_key(job_id):
     return JOB_KEY_FMT % job_id
 
 
+def job_status_generation_key(job_id):
+    """Return the KVS key for the status generation counter of a job."""
+    return _generate_key(job_id, JOB_STATUS_GENERATION_TOKEN)
+
+
 def generate_blob_key(job_id, blob):
     """ Return the KVS key for a binary blob """
     return _generate_key(job_id, 'blob', hashlib.sha1(blob).hexdigest())
@@ -100,14 +110,20 @@ def vuln_key(job_id, retrofitted=False):
                          "retrofitted" if retrofitted else "normal")
 
 
-def source_model_key(job_id):
-    """ Return the KVS key for the source model of the given job"""
-    return _generate_key(job_id, SOURCE_MODEL_TOKEN)
+def source_model_key(job_id, *parts):
+    """ Return the KVS key for the source model of the given job
+
+    Additional `parts` (e.g. history and realization) identify one of
+    several source models sampled for the job."""
+    return _generate_key(job_id, SOURCE_MODEL_TOKEN, *parts)
 
 
-def gmpe_key(job_id):
-    """ Return the KVS key for the GMPE of the given job"""
-    return _generate_key(job_id, GMPE_TOKEN)
+def gmpe_key(job_id, *parts):
+    """ Return the KVS key for the GMPE of the given job
+
+    Additional `parts` have the same meaning as for
+    :func:`source_model_key`."""
+    return _generate_key(job_id, GMPE_TOKEN, *parts)
 
 
 def stochastic_set_key(job_id, history, realization):
@@ -115,6 +131,24 @@ def stochastic_set_key(job_id, history, realization):
     return _generate_key(job_id, STOCHASTIC_SET_TOKEN, history, realization)
 
 
+def gmf_chunk_key(job_id, history, realization, chunk):
+    """ Return the KVS key for a chunk of the ground motion field matrix of
+    the given job and stochastic set"""
+    return _generate_key(job_id, GMF_CHUNK_TOKEN, history, realization, chunk)
+
+
+def site_index_key(job_id):
+    """ Return the KVS key for the site index (the coordinates of the sites
+    to compute) of the given job"""
+    return _generate_key(job_id, SITE_INDEX_TOKEN)
+
+
+def completed_tasks_key(job_id, task_name):
+    """ Return the KVS key for the results of the completed invocations of
+    the given task"""
+    return _generate_key(job_id, COMPLETED_TASKS_TOKEN, task_name)
+
+
 def erf_key(job_id):
     """ Return the KVS key for the ERF of the given job"""
     return _generate_key(job_id, ERF_KEY_TOKEN)
@@ -168,6 +202,11 @@ def bcr_block_key(job_id, block_id):
     return _generate_key(job_id, BCR_BLOCK_KEY_TOKEN, block_id)
 
 
+def aggregate_losses_key(job_id, block_id):
+    """ Return the key for the partial aggregate losses of a block """
+    return _generate_key(job_id, AGGREGATE_LOSSES_KEY_TOKEN, block_id)
+
+
 def _mean_hazard_curve_key(job_id, site_fragment):
     "Common code for the key functions below"
     return _generate_key(job_id, MEAN_HAZARD_CURVE_KEY_TOKEN, site_fragment)
@@ -23,11 +23,18 @@ TODO(jmc): support debug level per logger.
 
 """
 import logging
+import os
+import Queue
 import socket
+import sys
 import threading
+import traceback
 
 import kombu
+from celery.signals import task_postrun
+
 from openquake.signalling import AMQPMessageConsumer, amqp_connect
+from openquake.utils import config
 
 
 LEVELS = {'debug': logging.DEBUG,
@@ -78,6 +85,18 @@ def set_logger_level(logger, level):
     logger.setLevel(LEVELS.get(level, logging.WARNING))
 
 
+# Module-private cache for the host name, to be used by hostname().
+_HOSTNAME = None
+
+
+def hostname():
+    """The fully qualified domain name of this host, resolved only once."""
+    global _HOSTNAME  # pylint: disable=W0603
+    if _HOSTNAME is None:
+        _HOSTNAME = socket.getfqdn()
+    return _HOSTNAME
+
+
 class AMQPHandler(logging.Handler):  # pylint: disable=R0902
     """
     Logging handler that sends log messages to AMQP.
@@ -86,7 +105,18 @@ class AMQPHandler(logging.Handler):  # pylint: disable=R0902
     with values of LogRecord object enclosed. Those values should be enough
     to reconstruct LogRecord upon receiving.
 
+    Records are not published on the calling thread. They are put on a
+    bounded queue that is drained by a background thread which publishes
+    them in batches. When the queue is full the calling thread either blocks
+    or the record is dropped, depending on the `queue_full` policy. Call
+    :meth:`flush` to wait for the delivery of all queued records.
+
     :param level: minimum logging level to be sent.
+    :param int queue_size: the maximum number of queued records, defaults
+        to the `queue_size` setting in the `logging` section of
+        openquake.cfg or :const:`DEFAULT_QUEUE_SIZE`.
+    :param str queue_full: 'block' or 'drop', defaults to the `queue_full`
+        setting in the `logging` section of openquake.cfg or 'block'.
     """
 
     #: Routing key for a record is generated by formatting the record
@@ -94,13 +124,37 @@ class AMQPHandler(logging.Handler):  # pylint: disable=R0902
     #: are available, but very few make sense being in routing key.
     ROUTING_KEY_FORMAT = "oq.job.%(job_id)s.%(name)s"
 
+    #: The maximum number of records published in one go.
+    BATCH_SIZE = 100
+
+    DEFAULT_QUEUE_SIZE = 10000
+
     _MDC = threading.local()
 
     # pylint: disable=R0913
-    def __init__(self, level=logging.NOTSET):
+    def __init__(self, level=logging.NOTSET, queue_size=None,
+                 queue_full=None):
         logging.Handler.__init__(self, level=level)
         self.producer = self._initialize()
 
+        if queue_size is None:
+            queue_size = config.get("logging", "queue_size")
+        self.queue_size = (int(queue_size) if queue_size
+                           else self.DEFAULT_QUEUE_SIZE)
+
+        if queue_full is None:
+            queue_full = config.get("logging", "queue_full") or "block"
+        assert queue_full in ("block", "drop"), (
+            "Invalid queue_full policy: %s" % queue_full)
+        self.block_when_full = queue_full == "block"
+
+        #: The number of records dropped because the queue was full.
+        self.dropped = 0
+
+        self._queue = None
+        self._publisher = None
+        self._publisher_pid = None
+
     @staticmethod
     def _initialize():
         """Initialize amqp artefacts."""
@@ -116,6 +170,50 @@ class AMQPHandler(logging.Handler):  # pylint: disable=R0902
         """
         self._MDC.job_id = job_id
 
+    def _publisher_running(self):
+        """True if the publisher thread was started in this process."""
+        return (self._publisher is not None
+                and self._publisher_pid == os.getpid())
+
+    def _start_publisher(self):
+        """Start the publisher thread (again, after a fork)."""
+        self._queue = Queue.Queue(maxsize=self.queue_size)
+        self._publisher = threading.Thread(
+            target=self._publish_records, name="AMQPHandler-publisher")
+        self._publisher.daemon = True
+        self._publisher_pid = os.getpid()
+        self._publisher.start()
+
+    def _publish_records(self):
+        """Drain the record queue and publish the records in batches.
+
+        Runs in the publisher thread until a `None` sentinel is dequeued.
+        """
+        queue = self._queue
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            for data in batch:
+                if data is None:
+                    continue
+                try:
+                    routing_key = self.ROUTING_KEY_FORMAT % data
+                    self.producer.publish(data, routing_key)
+                except Exception:  # pylint: disable=W0703
+                    if logging.raiseExceptions:
+                        traceback.print_exc(file=sys.stderr)
+
+            for _ in batch:
+                queue.task_done()
+
+            if None in batch:
+                return
+
     def emit(self, record):  # pylint: disable=E0202
         # exc_info objects are not easily serializable
         # so we can not support "logger.exception()"
@@ -126,11 +224,43 @@ class AMQPHandler(logging.Handler):  # pylint: disable=R0902
         # what was in args
         data['msg'] = record.getMessage()
         data['args'] = ()
-        data['hostname'] = socket.getfqdn()
+        data['hostname'] = hostname()
         data['job_id'] = getattr(self._MDC, 'job_id', None)
 
-        routing_key = self.ROUTING_KEY_FORMAT % data
-        self.producer.publish(data, routing_key)
+        if not self._publisher_running():
+            self._start_publisher()
+
+        try:
+            self._queue.put(data, block=self.block_when_full)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until all queued records have been published."""
+        if self._publisher_running():
+            self._queue.join()
+
+    def close(self):
+        """Publish the queued records and stop the publisher thread."""
+        if self._publisher_running():
+            self._queue.put(None)
+            self._publisher.join()
+        self._publisher = None
+        logging.Handler.close(self)
+
+
+def flush_amqp_handlers(**_kwargs):
+    """Flush the :class:`AMQPHandler` instances of the root logger.
+
+    Connected to the celery `task_postrun` signal in order to guarantee
+    the delivery of all log records emitted by a task once it ends.
+    """
+    for handler in logging.root.handlers:
+        if isinstance(handler, AMQPHandler):
+            handler.flush()
+
+
+task_postrun.connect(flush_amqp_handlers)
 
 
 class AMQPLogSource(AMQPMessageConsumer):
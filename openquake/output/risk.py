@@ -24,6 +24,9 @@ NRML serialization of risk-related data sets.
 """
 
 from collections import defaultdict
+from collections import OrderedDict
+from itertools import chain
+from itertools import groupby
 
 from lxml import etree
 
@@ -77,7 +80,8 @@ class BaseMapXMLWriter(nrml.TreeNRMLWriter):
         Overrides the base `serialize` method to handle writing metadata
         in addition to the site/asset/loss/BCR data.
 
-        :param data: List of data to serialize to the output file.
+        :param data: List (or other iterable) of data to serialize to the
+            output file.
 
             Each element should consist of a tuple of (site, (loss, asset))
             information.
@@ -94,14 +98,48 @@ class BaseMapXMLWriter(nrml.TreeNRMLWriter):
                   <remaining data>]
 
             If no metadata is specified, defaults will be used.
+
+        Data items for the same site are written to a single map node. If
+        the installed lxml supports incremental writing (`etree.xmlfile`),
+        map nodes are written to the file one at a time instead of building
+        the whole document in memory.
+
+        When `data` is not a list or tuple (e.g. a generator yielding the
+        map block by block) it is consumed lazily and only adjacent items
+        for the same site are merged.
         """
-        if isinstance(data[0], dict):
-            self.write_metadata(data[0])
-            data = data[1:]
+        if isinstance(data, (list, tuple)):
+            metadata, data = split_metadata(data)
+            data = _group_by_site(data)
+        else:
+            metadata, data = split_metadata(data)
+            data = _group_adjacent_sites(data)
+
+        self.write_metadata(metadata)
+
+        if hasattr(etree, "xmlfile"):
+            self._serialize_incrementally(data)
         else:
-            self.write_metadata({})
+            super(BaseMapXMLWriter, self).serialize(data)
 
-        super(BaseMapXMLWriter, self).serialize(data)
+    def _serialize_incrementally(self, data):
+        """
+        Write the document skeleton (as set up by the constructor and
+        :py:meth:`write_metadata`) and then the map nodes one by one.
+
+        :param data: list of (site, values) pairs, see :py:meth:`write`
+        """
+        self.initialize()
+        with etree.xmlfile(self.path, encoding="UTF-8") as xml_file:
+            xml_file.write_declaration()
+            with xml_file.element(self.root_node.tag,
+                                  dict(self.root_node.attrib), nsmap=NSMAP):
+                with xml_file.element(self.risk_result_node.tag,
+                                      dict(self.risk_result_node.attrib)):
+                    with xml_file.element(self.map_container.tag,
+                                          dict(self.map_container.attrib)):
+                        for site, values in data:
+                            xml_file.write(self._map_node(site, values))
 
     def write_metadata(self, metadata):
         """
@@ -121,15 +159,23 @@ class BaseMapXMLWriter(nrml.TreeNRMLWriter):
         for key in self.METADATA:
             self.map_container.set(key, str(metadata.get(key, self.UNDEFINED)))
 
-    def _generate_map_node(self, site):
-        """ convenience method to generate a new map node """
+    def _generate_map_node(self, site, parent=None):
+        """
+        Convenience method to generate a new map node.
+
+        :param parent: the element the map node is appended to. If `None`,
+            a standalone element is created.
+        """
         # Generate an id for the new node element
         # Note: ids are created start at '1'
         self.node_counter += 1
         map_node_id = "mn_%i" % self.node_counter
 
         # Create the new node element
-        map_node_el = etree.SubElement(self.map_container, self.MAP_NODE_TAG)
+        if parent is None:
+            map_node_el = etree.Element(self.MAP_NODE_TAG, nsmap=NSMAP)
+        else:
+            map_node_el = etree.SubElement(parent, self.MAP_NODE_TAG)
 
         # Set the gml:id
         nrml.set_gml_id(map_node_el, map_node_id)
@@ -147,23 +193,22 @@ class BaseMapXMLWriter(nrml.TreeNRMLWriter):
 
         return map_node_el
 
-    def _get_site_elem_for_site(self, site):
+    def _map_node(self, site, values, parent=None):
         """
-        Searches the current xml document for a Site node matching the input
-        Site object.
-
-        :param site: Site object to match with Site node in the xml document
-        :type site: :py:class:`shapes.Site` object
+        Build the map node for the given site, containing the loss/bcr nodes
+        of all the given assets.
 
-        :returns: matching Site node (of type :py:class:`lxml.etree._Element`,
-            or None if no match is found
+        See :py:meth:`write` for the parameters.
         """
-        site_nodes = self.map_container.xpath(
-            './nrml:LMNode/nrml:site', namespaces=NAMESPACES)
-        for node in site_nodes:
-            if xml.element_equal_to_site(node, site):
-                return node
-        return None
+        map_node_el = self._generate_map_node(site, parent)
+
+        # now add the loss/bcr nodes as a child of the map node
+        # we have loss data in first position, asset data in second position
+        # ({'stddev_loss': 100, 'mean_loss': 0}, {'assetID': 'a1711'})
+        for value in values:
+            self.handle_map_node_for_asset(map_node_el, value[0], value[1])
+
+        return map_node_el
 
     def write(self, site, values):
         """Writes an asset element with loss map ratio information.
@@ -185,14 +230,56 @@ class BaseMapXMLWriter(nrml.TreeNRMLWriter):
             :py:class:`dict` (asset dict)
                 ***assetID*** - the assetID
         """
+        self._map_node(site, values, parent=self.map_container)
 
-        map_node_el = self._generate_map_node(site)
 
-        # now add the loss/bcr nodes as a child of the map node
-        # we have loss data in first position, asset data in second position
-        # ({'stddev_loss': 100, 'mean_loss': 0}, {'assetID': 'a1711'})
-        for value in values:
-            self.handle_map_node_for_asset(map_node_el, value[0], value[1])
+def _group_by_site(data):
+    """
+    Merge the values of (site, values) pairs referring to the same site.
+
+    :param data: iterable of (site, values) pairs
+    :returns: list of (site, values) pairs with unique sites, in the order
+        in which the sites first appear in `data`
+    """
+    grouped = OrderedDict()
+    for site, values in data:
+        if site in grouped:
+            grouped[site].extend(values)
+        else:
+            grouped[site] = list(values)
+    return grouped.items()
+
+
+def _group_adjacent_sites(data):
+    """
+    Lazily merge the values of adjacent (site, values) pairs referring to
+    the same site.
+
+    :param data: iterable of (site, values) pairs
+    :returns: generator of (site, values) pairs
+    """
+    for site, items in groupby(data, key=lambda item: item[0]):
+        values = []
+        for _, site_values in items:
+            values.extend(site_values)
+        yield site, values
+
+
+def split_metadata(data):
+    """
+    Separate the optional metadata dict at the head of the data passed to
+    the map writers from the rest of the items.
+
+    :param data: iterable whose first element may be a metadata dict
+    :returns: a (metadata, items) pair where `metadata` is a (possibly
+        empty) dict and `items` an iterator over the remaining elements
+    """
+    items = iter(data)
+    for first in items:
+        if isinstance(first, dict):
+            return first, items
+        return {}, chain([first], items)
+    return {}, items
 
 
 class LossMapXMLWriter(BaseMapXMLWriter):
@@ -443,11 +530,8 @@ class LossMapDBWriter(writer.DBWriter):
     def serialize(self, iterable):
         self.insert_output(self.get_output_type())
 
-        if isinstance(iterable[0], dict):
-            self._insert_metadata(iterable[0])
-            iterable = iterable[1:]
-        else:
-            self._insert_metadata({})
+        metadata, iterable = split_metadata(iterable)
+        self._insert_metadata(metadata)
 
         super(LossMapDBWriter, self).serialize(iterable)
 
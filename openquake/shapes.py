@@ -18,19 +18,16 @@
 
 """Collection of base classes for processing spatially-related data."""
 
-import hashlib
 import json
 import math
 import numpy
 
 from itertools import izip
-from numpy import zeros
 from numpy import empty
 from numpy import allclose
 from numpy import sin, cos, arctan2, sqrt, radians
 
 from shapely import geometry
-from scipy.interpolate import interp1d
 
 from nhlib import geo as nhlib_geo
 
@@ -168,11 +165,16 @@ class RegionConstraint(Region):
 class GridPoint(object):
     """Simple (trivial) point class"""
 
+    __slots__ = ('column', 'row', 'grid')
+
     def __init__(self, grid, column, row):
         self.column = column
         self.row = row
         self.grid = grid
 
+    def __reduce__(self):
+        return (self.__class__, (self.grid, self.column, self.row))
+
     def __eq__(self, other):
         if isinstance(other, Site):
             other = self.grid.point_at(other)
@@ -225,6 +227,11 @@ class Grid(object):
 
         self.polygon = self._build_polygon()
 
+        # The polygon is an axis-aligned rectangle: `contains` or `touches`
+        # boils down to comparing the coordinates with its bounds.
+        (self._min_lon, self._min_lat,
+         self._max_lon, self._max_lat) = self.polygon.bounds
+
     def _build_polygon(self):
         """
         Create the polygon underlying this grid.
@@ -255,13 +262,8 @@ class Grid(object):
         underlying the gridded region.
         """
 
-        if self.polygon.contains(site.point):
-            return True
-
-        if self.polygon.touches(site.point):
-            return True
-
-        return False
+        return (self._min_lon <= site.longitude <= self._max_lon
+                and self._min_lat <= site.latitude <= self._max_lat)
 
     def _latitude_to_row(self, latitude):
         """
@@ -321,29 +323,120 @@ class Grid(object):
 
         return GridPoint(self, column, row)
 
+    def points_at(self, lons, lats):
+        """
+        Vectorized version of :py:meth:`point_at`.
+
+        :param lons: longitudes of the sites, rounded like the ones of
+            :py:class:`Site` (e.g. the columns of a :py:class:`SiteArray`)
+        :param lats: latitudes of the sites
+        :returns: a (columns, rows) tuple of integer numpy arrays
+        :raises ValueError: if any of the sites is outside the region
+        """
+        lons = numpy.asarray(lons, dtype=float)
+        lats = numpy.asarray(lats, dtype=float)
+
+        inside = ((self._min_lon <= lons) & (lons <= self._max_lon)
+                  & (self._min_lat <= lats) & (lats <= self._max_lat))
+        if not inside.all():
+            idx = numpy.flatnonzero(~inside)[0]
+            raise ValueError("Site <%s> is outside region."
+                             % Site(float(lons[idx]), float(lats[idx])))
+
+        columns = _round_half_away(
+            (lons - self.llc.longitude) / self.cell_size)
+        rows = _round_half_away(
+            numpy.fabs(lats - self.llc.latitude) / self.cell_size)
+        return columns, rows
+
     def __iter__(self):
-        for row in range(0, self.rows):
-            for col in range(0, self.columns):
+        for row in xrange(0, self.rows):
+            for col in xrange(0, self.columns):
                 point = GridPoint(self, col, row)
                 yield point
 
+    def centers_array(self):
+        """
+        Return the centers of the cells contained in this grid, in the same
+        order as :py:meth:`__iter__`.
+
+        :returns: a numpy array with shape (rows * columns, 2) containing
+            the (longitude, latitude) pairs
+        """
+        lons = self.llc.longitude + numpy.arange(self.columns) * self.cell_size
+        lats = self.llc.latitude + numpy.arange(self.rows) * self.cell_size
+
+        centers = empty((self.rows * self.columns, 2))
+        centers[:, 0] = numpy.tile(lons, self.rows)
+        centers[:, 1] = numpy.repeat(lats, self.columns)
+        return centers
+
     def centers(self):
         """
         Return the set of sites defining the center of
         the cells contained in this grid.
         """
 
-        return [point.site for point in self]
+        return [Site(lon, lat) for lon, lat in self.centers_array().tolist()]
+
+
+def _round_half_away(values):
+    """
+    Round to the nearest integer like the built-in `round` does (halves are
+    rounded away from zero) and return an integer numpy array.
+    """
+    return (numpy.sign(values)
+            * numpy.floor(numpy.fabs(values) + 0.5)).astype(int)
+
+
+# Coordinates are rounded to 7 decimal places (see `round_float`), which
+# makes them exactly representable as integers once scaled. The scaled
+# longitude fits in 32 bits and the scaled latitude in 31 bits after the
+# offsets below, so the two can be packed into a single non-negative 63-bit
+# integer without collisions.
+_COORD_SCALE = 10 ** 7
+_LON_OFFSET = 180 * _COORD_SCALE
+_LAT_OFFSET = 90 * _COORD_SCALE
+
+
+def _site_hash(longitude, latitude, depth):
+    """
+    Hash value for the given (already rounded) site coordinates.
+
+    The value only depends on the coordinates, and is therefore the same in
+    all processes. It is used to build KVS keys (see `openquake.kvs.tokens`).
+    """
+    packed = (((int(round(latitude * _COORD_SCALE)) + _LAT_OFFSET) << 32)
+              | (int(round(longitude * _COORD_SCALE)) + _LON_OFFSET))
+    if depth:
+        return hash((packed, depth))
+    return hash(packed)
 
 
 class Site(nhlib_geo.Point):
     """Site is a dictionary-keyable point"""
 
+    # Hazard and risk calculators create and hash a very large number of
+    # sites: the shapely point is only built when needed and the hash value
+    # is computed once.
+    __slots__ = ('_point', '_hash')
+
     def __init__(self, longitude, latitude, depth=0.0):
         nhlib_geo.Point.__init__(
             self, round_float(longitude), round_float(latitude), depth=depth)
 
-        self.point = geometry.Point(self.longitude, self.latitude)
+        self._point = None
+        self._hash = None
+
+    def __reduce__(self):
+        return (self.__class__, (self.longitude, self.latitude, self.depth))
+
+    @property
+    def point(self):
+        """The shapely point for this site, created on first access."""
+        if self._point is None:
+            self._point = geometry.Point(self.longitude, self.latitude)
+        return self._point
 
     @property
     def coords(self):
@@ -373,9 +466,9 @@ class Site(nhlib_geo.Point):
         return self.__hash__()
 
     def __hash__(self):
-        return hash(
-            hashlib.md5(
-                repr((self.longitude, self.latitude, self.depth))).hexdigest())
+        if self._hash is None:
+            self._hash = _site_hash(self.longitude, self.latitude, self.depth)
+        return self._hash
 
     def to_java(self):
         """Converts to a Java Site object"""
@@ -388,70 +481,82 @@ class Site(nhlib_geo.Point):
         return self.hash() == other.hash()
 
 
-class Field(object):
-    """Uses a 2 dimensional numpy array to store a field of values."""
+class SiteArray(object):
+    """
+    Column oriented collection of sites, meant for block level code.
 
-    def __init__(self, field=None, rows=1, cols=1):
-        if field is not None:
-            self.field = field
-        else:
-            self.field = zeros((rows, cols))
+    Longitudes, latitudes and depths are stored in numpy arrays and the
+    site hash values (the site fragments used in KVS keys) are computed
+    upfront, so that no :py:class:`Site` objects need to be created when
+    building keys for a whole block.
 
-    def get(self, row, col):
-        """ Return the value at self.field[row][col]
-            :param row
-            :param col
-        """
-        try:
-            return self.field[row][col]
-        except IndexError:
-            print "Field with shape [%s] doesn't have value at [%s][%s]" % (
-                self.field.shape, row, col)
+    :param lons: longitudes of the sites
+    :param lats: latitudes of the sites
+    :param depths: depths of the sites, all 0.0 if not given
+    """
 
-    @classmethod
-    def from_json(cls, json_str, grid=None):
-        """Construct a field from a serialized version in
-        json format."""
-        assert grid
-        as_dict = json.JSONDecoder().decode(json_str)
-        return cls.from_dict(as_dict, grid=grid)
+    def __init__(self, lons, lats, depths=None):
+        lons = [round_float(lon) for lon in lons]
+        lats = [round_float(lat) for lat in lats]
+        if depths is None:
+            depths = [0.0] * len(lons)
+        assert len(lons) == len(lats) == len(depths), (
+            "lons, lats and depths must have the same length")
+
+        self.lons = numpy.array(lons, dtype=float)
+        self.lats = numpy.array(lats, dtype=float)
+        self.depths = numpy.array(depths, dtype=float)
+        self.hashes = self._hashes()
 
     @classmethod
-    def from_dict(cls, values, transform=math.exp, grid=None):
-        """Construct a field from a dictionary.
+    def from_sites(cls, sites):
         """
-        assert grid
-        assert grid.cell_size
-        field = zeros((grid.rows, grid.columns))
-
-        for _key, field_site in values.items():
-            point = grid.point_at(
-                Site(field_site['lon'], field_site['lat']))
-            field[point.row][point.column] = transform(
-                    float(field_site['mag']))
-
-        return cls(field)
-
-
-class FieldSet(object):
-    """ An iterator for a set of fields """
+        Build a site array from a sequence of :py:class:`Site` objects.
+        """
+        sites = list(sites)
+        # The coordinates of the sites are rounded already and their hash
+        # values are cached, no need to compute them again.
+        array = cls.__new__(cls)
+        array.lons = numpy.array([site.longitude for site in sites],
+                                 dtype=float)
+        array.lats = numpy.array([site.latitude for site in sites],
+                                 dtype=float)
+        array.depths = numpy.array([site.depth for site in sites],
+                                   dtype=float)
+        array.hashes = [hash(site) for site in sites]
+        return array
+
+    def _hashes(self):
+        """
+        Compute the hash values of all sites, identical to the ones of the
+        corresponding :py:class:`Site` objects.
+        """
+        packed = (
+            ((numpy.rint(self.lats * _COORD_SCALE).astype(numpy.int64)
+              + _LAT_OFFSET) << 32)
+            | (numpy.rint(self.lons * _COORD_SCALE).astype(numpy.int64)
+               + _LON_OFFSET))
+        return [hash((int(value), float(depth))) if depth else hash(int(value))
+                for value, depth in izip(packed, self.depths)]
+
+    def keys(self, template):
+        """
+        Build the KVS keys for all sites from a key template such as the
+        one returned by
+        :py:func:`openquake.kvs.tokens.mean_hazard_curve_key_template`.
+        """
+        return [template % site_hash for site_hash in self.hashes]
 
-    def __init__(self, as_dict, grid):
-        assert grid
-        self.grid = grid
-        self.fields = as_dict.values()[0]  # NOTE: There's a junk wrapper
+    def __len__(self):
+        return len(self.lons)
 
-    @classmethod
-    def from_json(cls, json_str, grid=None):
-        """ Construct a field set from a serialized version in json format """
-        assert grid
-        as_dict = json.JSONDecoder().decode(json_str)
-        return cls(as_dict, grid=grid)
+    def __getitem__(self, idx):
+        return Site(float(self.lons[idx]), float(self.lats[idx]),
+                    float(self.depths[idx]))
 
     def __iter__(self):
-        """Pop off the fields sequentially"""
-        for field in self.fields.values():
-            yield Field.from_dict(field, grid=self.grid)
+        for lon, lat, depth in izip(self.lons, self.lats, self.depths):
+            yield Site(float(lon), float(lat), float(depth))
 
 
 def range_clip(val, val_range):
@@ -508,6 +613,34 @@ def range_clip(val, val_range):
     return val
 
 
+def _interpolate(x_value, x_values, y_values):
+    """
+    Linearly interpolate the y value(s) corresponding to the given x
+    value(s).
+
+    Input values are clipped to the range of `x_values`, as done by
+    :py:func:`range_clip`: `numpy.interp` already returns the first (last)
+    y value for x values below (above) the range.
+
+    :param x_value: value(s) to interpolate
+    :type x_value: float, list/tuple of floats, or :py:class:`numpy.ndarray`
+        of floats
+    :param x_values: the abscissae, in ascending order with no duplicates.
+        Must contain at least 2 elements.
+    :type x_values: 1-dimensional :py:class:`numpy.ndarray`
+    :param y_values: the ordinates, same length as `x_values`
+    :type y_values: 1-dimensional :py:class:`numpy.ndarray`
+
+    :returns: :py:class:`numpy.ndarray` containing a number of interpolated
+        values equal to the size of the input (1 or many)
+    """
+    assert len(x_values) >= 2, "val_range must contain at least 2 elements"
+    assert (numpy.diff(x_values) > 0).all(), \
+        "val_range must be arranged in ascending order with no duplicates"
+
+    return numpy.asarray(numpy.interp(x_value, x_values, y_values))
+
+
 class Curve(object):
     """This class defines a curve (discrete function)
     used in the risk domain."""
@@ -606,28 +739,32 @@ class Curve(object):
     def ordinate_for(self, x_value, y_index=0):
         """
             Return the y value corresponding to the given x value.
-            interp1d parameters can be a list of x_values, y_values
+            x_value can be a list or a numpy array of x values,
             this is very useful to speed up the computation and feed
             "directly" numpy
         """
 
-        x_value = range_clip(x_value, self.x_values)
-
         y_values = self.y_values
 
         if self.y_values.ndim > 1:
             y_values = self.y_values[:, y_index]
 
-        return interp1d(self.x_values, y_values)(x_value)
+        return _interpolate(x_value, self.x_values, y_values)
 
     def abscissa_for(self, y_value):
         """Return the x value corresponding to the given y value."""
 
-        # inverting the function
-        inverted_func = [(ordinate, x_value) for ordinate, x_value in
-                zip(self.ordinate_for(self.abscissae), self.abscissae)]
+        # inverting the function, the ordinates at the abscissae
+        # are the y values themselves
+        ordinates = self.y_values
+
+        if self.y_values.ndim > 1:
+            ordinates = self.y_values[:, 0]
+
+        # stable sort, as done by the Curve constructor
+        order = numpy.argsort(ordinates, kind="mergesort")
 
-        return Curve(inverted_func).ordinate_for(y_value)
+        return _interpolate(y_value, ordinates[order], self.x_values[order])
 
     def ordinate_out_of_bounds(self, y_value):
         """Check if the given value is outside the Y values boundaries."""
@@ -668,33 +805,37 @@ class VulnerabilityFunction(object):
         :type loss_ratios: list of floats, equal in length to imls
         :param covs: Coefficients of Variation. All values must be >= 0.0.
         :type covs: list of floats, equal in length to imls
-        """
-        self._imls = imls
-        self._loss_ratios = loss_ratios
-        self._covs = covs
 
+        The values are stored in read-only numpy arrays, computed once:
+        vulnerability functions are immutable.
+        """
         # Check for proper IML ordering:
-        assert self._imls == sorted(set(self._imls)), \
+        assert imls == sorted(set(imls)), \
             "IML values must be in ascending order with no duplicates."
 
         # Check for proper IML values (> 0.0).
-        assert all(x >= 0.0 for x in self._imls), \
+        assert all(x >= 0.0 for x in imls), \
             "IML values must be >= 0.0."
 
         # Check CoV and loss ratio list lengths:
-        assert len(self._covs) == len(self._imls), \
+        assert len(covs) == len(imls), \
             "CoV list should be the same length as the IML list."
-        assert len(self._loss_ratios) == len(self._imls), \
+        assert len(loss_ratios) == len(imls), \
             "Loss ratio list should be the same length as the IML list."
 
         # Check for proper CoV values (>= 0.0):
-        assert all(x >= 0.0 for x in self._covs), \
+        assert all(x >= 0.0 for x in covs), \
             "CoV values must be >= 0.0."
 
         # Check for proper loss ratio values (0.0 <= value <= 1.0):
-        assert all(x >= 0.0 and x <= 1.0 for x in self._loss_ratios), \
+        assert all(x >= 0.0 and x <= 1.0 for x in loss_ratios), \
             "Loss ratio values must be in the interval [0.0, 1.0]."
 
+        self._imls = _read_only_array(imls)
+        self._loss_ratios = _read_only_array(loss_ratios)
+        self._covs = _read_only_array(covs)
+        self._stddevs = _read_only_array(self._covs * self._loss_ratios)
+
     def __eq__(self, other):
         """
         Compares IML, loss ratio, and CoV values to determine equality.
@@ -708,39 +849,38 @@ class VulnerabilityFunction(object):
     @property
     def imls(self):
         """
-        IML values as a numpy.array.
+        IML values as a (read-only) numpy.array.
         """
-        return numpy.array(self._imls)
+        return self._imls
 
     @property
     def loss_ratios(self):
         """
-        Loss ratios as a numpy.array.
+        Loss ratios as a (read-only) numpy.array.
         """
-        return numpy.array(self._loss_ratios)
+        return self._loss_ratios
 
     @property
     def covs(self):
         """
-        Coeffecicients of Variation as a numpy.array.
+        Coeffecicients of Variation as a (read-only) numpy.array.
         """
-        return numpy.array(self._covs)
+        return self._covs
 
     @property
     def is_empty(self):
         """
         True if there are no IML values in the function.
         """
-        return len(self.imls) == 0
+        return len(self._imls) == 0
 
     @property
     def stddevs(self):
         """
-            Convenience method: returns a list of calculated
-            Standard Deviations
+            Convenience method: returns a (read-only) numpy.array of
+            calculated Standard Deviations
         """
-        return [cov * loss_ratio for cov, loss_ratio in izip(self.covs,
-            self.loss_ratios)]
+        return self._stddevs
 
     def loss_ratio_for(self, iml):
         """
@@ -757,9 +897,7 @@ class VulnerabilityFunction(object):
         :returns: :py:class:`numpy.ndarray` containing a number of interpolated
             values equal to the size of the input (1 or many)
         """
-        iml = range_clip(iml, self.imls)
-
-        return interp1d(self.imls, self.loss_ratios)(iml)
+        return _interpolate(iml, self._imls, self._loss_ratios)
 
     def cov_for(self, iml):
         """
@@ -776,9 +914,7 @@ class VulnerabilityFunction(object):
         :returns: :py:class:`numpy.ndarray` containing a number of interpolated
             values equal to the size of the input (1 or many)
         """
-        iml = range_clip(iml, self.imls)
-
-        return interp1d(self.imls, self.covs)(iml)
+        return _interpolate(iml, self._imls, self._covs)
 
     def __iter__(self):
         """Iterate on the values of this function, returning triples
@@ -852,6 +988,13 @@ class VulnerabilityFunction(object):
         return cls.from_dict(as_dict)
 
 
+def _read_only_array(values):
+    """Return a read-only float numpy array with the given values."""
+    values = numpy.array(values, dtype=float)
+    values.flags.writeable = False
+    return values
+
+
 EMPTY_CURVE = Curve(())
 EMPTY_VULN_FUNCTION = VulnerabilityFunction([], [], [])
 
@@ -50,6 +50,9 @@ from openquake.utils import stats
 LOG_FORMAT = ('[%(asctime)s #%(job_id)s %(hostname)s %(levelname)s '
               '%(processName)s/%(process)s %(name)s] %(message)s')
 
+# Maps the computation areas of the statistics counters to job phases.
+PHASES = {"h": "hazard", "r": "risk"}
+
 
 def ignore_sigint():
     """
@@ -90,6 +93,28 @@ def record_job_stop_time(job_id):
     job_stats.save(using='job_superv')
 
 
+def record_job_progress(job_id, progress):
+    """
+    Record the progress of the current phase of a job in the
+    uiapi.job_stats table.
+
+    :param job_id: the job id
+    :type job_id: int
+    :param progress: the progress of the job
+    :type progress: :class:`openquake.utils.stats.Progress`
+    """
+    job_stats = JobStats.objects.get(oq_job=job_id)
+    job_stats.phase = PHASES[progress.area]
+    job_stats.units_done = progress.done
+    job_stats.units_total = progress.total
+    job_stats.throughput = progress.throughput
+    if progress.eta is not None:
+        job_stats.eta = datetime.utcfromtimestamp(progress.eta)
+    else:
+        job_stats.eta = None
+    job_stats.save(using='job_superv')
+
+
 def cleanup_after_job(job_id):
     """
     Release the resources used by an openquake job.
@@ -129,6 +154,7 @@ def update_job_status_and_error_msg(job_id, status, error_msg=None):
     job = OqJob.objects.get(id=job_id)
     job.status = status
     job.save()
+    kvs.bump_job_status_generation(job_id)
 
     if error_msg:
         ErrorMsg.objects.using('job_superv')\
@@ -190,10 +216,14 @@ class SupervisorLogMessageConsumer(logs.AMQPLogSource):
 
        - handling its "critical" and "error" messages
        - periodically checking that the job process is still running
+       - periodically recording the progress of the job
     """
     # Failure counter check delay, translates to 20 seconds with the current
     # settings.
     FCC_DELAY = 20
+    # Progress recording delay, translates to 10 seconds with the current
+    # settings.
+    PROGRESS_DELAY = 10
 
     def __init__(self, job_id, job_pid, timeout=1):
         self.selflogger = logging.getLogger('oq.job.%s.supervisor' % job_id)
@@ -210,6 +240,9 @@ class SupervisorLogMessageConsumer(logs.AMQPLogSource):
         self.joblogger.addHandler(self.jobhandler)
         # Failure counter check delay value
         self.fcc_delay_value = 0
+        # Progress recording delay value
+        self.progress_delay_value = 0
+        self.progress_estimator = stats.ProgressEstimator(job_id)
 
     def run(self):
         """
@@ -251,7 +284,13 @@ class SupervisorLogMessageConsumer(logs.AMQPLogSource):
         On timeout expiration check if the job process is still running
         and whether it experienced any failures.
 
-        Terminate the job process in the latter case.
+        Terminate the job process in the latter case. Failed task
+        invocations that are retried (see
+        :func:`openquake.utils.tasks.retrying`) are not counted as failures
+        until they exhausted their attempts.
+
+        The progress of a running job is recorded every `PROGRESS_DELAY`
+        expirations (see :func:`record_job_progress`).
         """
         def failure_counters_need_check():
             """Return `True` if failure counters should be checked."""
@@ -291,6 +330,13 @@ class SupervisorLogMessageConsumer(logs.AMQPLogSource):
             cleanup_after_job(self.job_id)
             raise StopIteration()
 
+        self.progress_delay_value += 1
+        if self.progress_delay_value >= self.PROGRESS_DELAY:
+            self.progress_delay_value = 0
+            progress = self.progress_estimator.sample()
+            if progress is not None:
+                record_job_progress(self.job_id, progress)
+
 
 def supervise(pid, job_id, timeout=1, log_file=None):
     """
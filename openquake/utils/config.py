@@ -93,6 +93,12 @@ def get(section, key):
     return data.get(key) if data else None
 
 
+def override(section, key, value):
+    """Override the configuration value for the given `section` and `key`
+    for the lifetime of the process, e.g. with a command line option."""
+    Config().cfg.setdefault(section, dict())[key] = value
+
+
 def abort_if_no_config_available():
     """Call sys.exit() if no openquake configuration file is readable."""
     if not Config().is_readable():
@@ -107,20 +113,25 @@ def abort_if_no_config_available():
         sys.exit(2)
 
 
-def hazard_block_size(default=8192):
-    """Return the default or configured hazard block size."""
-    block_size = 0
+def positive_int(section, setting, default=None):
+    """Return the value of an integer setting of openquake.cfg if it is set
+    to a positive number, the given default otherwise.
 
-    configured_size = get("hazard", "block_size")
-    if configured_size is not None:
-        configured_size = int(configured_size.strip())
+    :param string section: name of the configuration file section
+    :param string setting: name of the configuration file setting
+    :raises ValueError: if the setting is not an integer
+    """
+    configured = get(section, setting)
+    if configured is not None and int(configured.strip()) > 0:
+        return int(configured.strip())
+    return default
 
-    if configured_size and configured_size > 0:
-        block_size = configured_size
-    else:
-        block_size = default
 
-    return block_size
+def configured_block_size(section):
+    """Return the block size configured in the given section (`hazard` or
+    `risk`) of openquake.cfg or `None` if it is not set (or not positive),
+    i.e. if the calculators are to compute it."""
+    return positive_int(section, "block_size")
 
 
 def flag_set(section, setting):
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Utility functions that keep the (Python side) memory footprint of a task
+within the budget configured in the `tasks` section of openquake.cfg
+(`memory_budget`, in MB).
+
+Buffers that do not fit the budget are either processed in chunks (see
+:func:`rows_per_chunk`) or spilled to a temporary file in the `spill_dir`
+directory and memory-mapped (see :func:`allocate`).
+"""
+
+import tempfile
+
+import numpy
+
+from openquake import logs
+from openquake.utils import config
+
+
+# The default memory budget of a task, in MB.
+DEFAULT_TASK_MEMORY = 512
+
+MB = 1024 * 1024
+
+
+# The default memory budget of a block of sites, in MB.
+DEFAULT_BLOCK_MEMORY = 256
+
+
+def task_memory():
+    """Return the memory budget of a task in bytes."""
+    return config.positive_int(
+        "tasks", "memory_budget", DEFAULT_TASK_MEMORY) * MB
+
+
+def block_memory(section):
+    """Return the memory budget of a block of sites in bytes, as configured
+    in the given section (`hazard` or `risk`) of openquake.cfg
+    (`block_memory`, in MB)."""
+    return config.positive_int(
+        section, "block_memory", DEFAULT_BLOCK_MEMORY) * MB
+
+
+def spill_dir():
+    """Return the directory of the files backing the spilled arrays, the
+    system's temporary directory unless configured otherwise."""
+    return config.get("tasks", "spill_dir") or tempfile.gettempdir()
+
+
+def rows_per_chunk(row_bytes, what="rows"):
+    """Return the number of rows of `row_bytes` bytes each that fit the
+    task memory budget (at least one).
+
+    :param str what: describes the rows, for the log
+    """
+    budget = task_memory()
+    rows = max(1, int(budget // max(row_bytes, 1)))
+    logs.LOG.debug("%s of %s bytes each, processed %s at a time (task "
+                   "memory budget: %s MB)" % (what, row_bytes, rows,
+                                              budget // MB))
+    return rows
+
+
+def allocate(shape, dtype=numpy.float64, what="array"):
+    """Return a zero-filled array of the given shape and type.
+
+    The array is kept in memory if it fits the task memory budget and is
+    backed by a temporary file otherwise (see :func:`spill_dir`). The file
+    is removed as soon as the array is garbage collected.
+
+    :param str what: describes the array, for the log
+    :returns: a :class:`numpy.ndarray` or :class:`numpy.memmap` instance
+    """
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    budget = task_memory()
+    if nbytes <= budget:
+        return numpy.zeros(shape, dtype)
+
+    logs.LOG.info("%s of %s MB exceeds the task memory budget of %s MB, "
+                  "spilled to %s" % (what, nbytes // MB, budget // MB,
+                                     spill_dir()))
+    return numpy.memmap(tempfile.TemporaryFile(dir=spill_dir()),
+                        dtype=dtype, mode="w+", shape=shape)
+
+
+def load(dataset, what="dataset"):
+    """Load an array-like object (e.g. a :class:`h5py.Dataset`) into an
+    array allocated with :func:`allocate`, copying it in chunks along its
+    first axis so that no chunk exceeds the task memory budget.
+
+    :param str what: describes the dataset, for the log
+    """
+    result = allocate(dataset.shape, dataset.dtype, what)
+    if not result.size:
+        return result
+    row_bytes = result.nbytes // len(result)
+    step = rows_per_chunk(row_bytes, "%s rows" % what)
+    for start in xrange(0, len(result), step):
+        result[start:start + step] = dataset[start:start + step]
+    return result
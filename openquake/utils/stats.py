@@ -21,9 +21,17 @@
 Utility functions related to keeping job progress information and statistics.
 """
 
-from functools import wraps
+import collections
+import fnmatch
 import redis
+import threading
+import time
+
+from functools import wraps
+
+from celery.exceptions import RetryTaskError
 
+from openquake import kvs
 from openquake.utils import config
 
 
@@ -72,6 +80,55 @@ STATS_KEYS = {
 #   job_id, computation area, key fragment, counter_type.
 _KEY_TEMPLATE = "oqs/%s/%s/%s/%s"
 
+# The incremental and totals counters of a job are kept in a single kvs hash.
+# The hash field names are the full predefined statistics keys (see
+# key_name()). Debug counters are stored in separate kvs keys.
+_COUNTERS_TEMPLATE = "oqs/%s/counters"
+
+# Increments performed by a task (i.e. a function wrapped by
+# progress_indicator) are buffered and flushed in a single pipelined batch
+# when the task ends or when the oldest buffered increment is older than
+# the following number of seconds.
+FLUSH_INTERVAL = 5.0
+
+# The key fragment of the counters of the units of work (e.g. sites or
+# stochastic event sets) processed and to be processed in a computation
+# area, see record_units() and set_units_total().
+UNITS = "units"
+
+# The weight of the latest throughput measurement in the moving average
+# kept by ProgressEstimator.
+THROUGHPUT_SMOOTHING = 0.3
+
+# Module-private kvs connection pool, to be used by _redis().
+__STATS_CONN_POOL = None
+
+# Module-private buffer of counter increments, maps (job_id, key) pairs
+# to increments.
+_PENDING = collections.defaultdict(int)
+_PENDING_LOCK = threading.Lock()
+
+
+class _BufferState(threading.local):  # pylint: disable=R0903
+    """Per-thread counter buffering state."""
+    # The number of progress_indicator wrappers currently executing
+    depth = 0
+    # The time of the last flush
+    last_flush = 0.0
+
+
+_BUFFER_STATE = _BufferState()
+
+
+def counters_key(job_id):
+    """Return the name of the kvs hash holding the counters of a job."""
+    return _COUNTERS_TEMPLATE % job_id
+
+
+def _is_debug_key(key):
+    """True if `key` is the full name of a debug counter."""
+    return key.endswith("/d")
+
 
 def kvs_op(dop, *kvs_args):
     """Apply the kvs operation using the predefined key.
@@ -89,6 +146,9 @@ def kvs_op(dop, *kvs_args):
 def failure_counters(job_id, area=None):
     """Return a list of 2-tuples with failure keys/counters for the given area.
 
+    All counters of the job are read from its kvs hash in a single round
+    trip, no `KEYS` command is issued.
+
     :param int job_id: identifier of the job in question
     :param str area: computation area, one of:
         "g" : general
@@ -104,10 +164,33 @@ def failure_counters(job_id, area=None):
     else:
         pattern = "oqs/%s/*-failures*" % job_id
 
-    result = keys = kvs_op("keys", pattern)
-    if keys:
-        result = zip(keys, [int(c) for c in kvs_op("mget", keys)])
-    return result
+    counters = kvs_op("hgetall", counters_key(job_id))
+    return [(key, int(value)) for key, value in counters.iteritems()
+            if fnmatch.fnmatchcase(key, pattern)]
+
+
+def _set(job_id, key, value):
+    """Set the counter with the given full key name."""
+    if _is_debug_key(key):
+        kvs_op("set", key, value)
+    else:
+        kvs_op("hset", counters_key(job_id), key, value)
+
+
+def _get(job_id, key):
+    """Get the value of the counter with the given full key name."""
+    if _is_debug_key(key):
+        return kvs_op("get", key)
+    else:
+        return kvs_op("hget", counters_key(job_id), key)
+
+
+def _incr(job_id, key, amount=1):
+    """Increment the counter with the given full key name."""
+    if _is_debug_key(key):
+        kvs_op("incr", key, amount)
+    else:
+        kvs_op("hincrby", counters_key(job_id), key, amount)
 
 
 def pk_set(job_id, skey, value):
@@ -120,7 +203,7 @@ def pk_set(job_id, skey, value):
     key = key_name(job_id, *STATS_KEYS[skey])
     if not key:
         return
-    kvs_op("set", key, value)
+    _set(job_id, key, value)
 
 
 def pk_inc(job_id, skey):
@@ -132,7 +215,7 @@ def pk_inc(job_id, skey):
     key = key_name(job_id, *STATS_KEYS[skey])
     if not key:
         return
-    kvs_op("incr", key)
+    _incr(job_id, key)
 
 
 def pk_get(job_id, skey, cast2int=True):
@@ -146,22 +229,28 @@ def pk_get(job_id, skey, cast2int=True):
     key = key_name(job_id, *STATS_KEYS[skey])
     if not key:
         return
-    value = kvs_op("get", key)
+    value = _get(job_id, key)
     if cast2int:
         return int(value) if value else 0
     else:
         return value
 
 
+# pylint: disable=W0603
 def _redis():
     """Return a connection to the redis store."""
-    host = config.get("kvs", "host")
-    port = config.get("kvs", "port")
-    port = int(port) if port else 6379
+    global __STATS_CONN_POOL
     stats_db = config.get("kvs", "stats_db")
     stats_db = int(stats_db) if stats_db else 15
-    args = {"host": host, "port": port, "db": stats_db}
-    return redis.Redis(**args)
+    if kvs.backend() == "memory":
+        return kvs.memory.get_client(stats_db)
+    if __STATS_CONN_POOL is None:
+        host = config.get("kvs", "host")
+        port = config.get("kvs", "port")
+        port = int(port) if port else 6379
+        __STATS_CONN_POOL = redis.ConnectionPool(
+            host=host, port=port, db=stats_db)
+    return redis.Redis(connection_pool=__STATS_CONN_POOL)
 
 
 def key_name(job_id, area, key_fragment, counter_type):
@@ -187,8 +276,41 @@ def key_name(job_id, area, key_fragment, counter_type):
     return _KEY_TEMPLATE % (job_id, area, key_fragment, counter_type)
 
 
+def _buffer_incr(job_id, key, amount=1):
+    """Buffer an increment of the counter with the given full key name."""
+    with _PENDING_LOCK:
+        _PENDING[(job_id, key)] += amount
+
+
+def flush_counters():
+    """Write all buffered counter increments with a single pipelined batch
+    of `HINCRBY` commands."""
+    _BUFFER_STATE.last_flush = time.time()
+    with _PENDING_LOCK:
+        if not _PENDING:
+            return
+        pending = _PENDING.items()
+        _PENDING.clear()
+
+    pipe = _redis().pipeline(transaction=False)
+    for (job_id, key), increment in pending:
+        pipe.hincrby(counters_key(job_id), key, increment)
+    pipe.execute()
+
+
 class progress_indicator(object):   # pylint: disable=C0103
-    """Count successful/failed invocations of the wrapped function."""
+    """Count successful/failed invocations of the wrapped function.
+
+    Counter increments performed by the wrapped function (see
+    :func:`incr_counter`) are buffered and flushed, along with the
+    success/failure count, when the wrapped function terminates. The time
+    spent in successful invocations is accumulated (in milliseconds) in the
+    "<function name>-ms" counter.
+
+    Invocations that failed but will be retried (see
+    :func:`openquake.utils.tasks.retrying`) are counted as retries, not as
+    failures.
+    """
 
     def __init__(self, area):
         """Captures the computation area parameter."""
@@ -210,18 +332,34 @@ class progress_indicator(object):   # pylint: disable=C0103
             """The actual decorator."""
             # The first argument is always the job_id
             job_id = self.find_job_id(*args, **kwargs)
-            conn = _redis()
+            if _BUFFER_STATE.depth == 0:
+                _BUFFER_STATE.last_flush = time.time()
+            _BUFFER_STATE.depth += 1
+            started = time.time()
             try:
                 result = func(*args, **kwargs)
                 key = key_name(job_id, self.area, func.__name__, "i")
-                conn.incr(key)
+                _buffer_incr(job_id, key)
+                key = key_name(job_id, self.area, func.__name__ + "-ms", "i")
+                _buffer_incr(job_id, key,
+                             int((time.time() - started) * 1000))
                 return result
+            except RetryTaskError:
+                # Count retry
+                key = key_name(
+                    job_id, self.area, func.__name__ + "-retries", "i")
+                _buffer_incr(job_id, key)
+                raise
             except:
                 # Count failure
                 key = key_name(
                     job_id, self.area, func.__name__ + "-failures", "i")
-                conn.incr(key)
+                _buffer_incr(job_id, key)
                 raise
+            finally:
+                _BUFFER_STATE.depth -= 1
+                if _BUFFER_STATE.depth == 0:
+                    flush_counters()
 
         return wrapper
 
@@ -238,21 +376,31 @@ def set_total(job_id, area, key_fragment, value):
     :param valye: the value that should be set.
     """
     key = key_name(job_id, area, key_fragment, "t")
-    kvs_op("set", key, value)
+    _set(job_id, key, value)
 
 
-def incr_counter(job_id, area, key_fragment):
+def incr_counter(job_id, area, key_fragment, amount=1):
     """Increment the counter for the given key.
 
+    Inside a function wrapped by :class:`progress_indicator` the increment
+    is buffered (see :func:`flush_counters`), otherwise it is applied
+    immediately.
+
     :param int job_id: identifier of the job in question
     :param str area: computation area, one of:
         "g" : general
         "h" : hazard
         "r" : risk
     :param string key_fragment: a part of the predefined statistics key
+    :param int amount: the increment
     """
     key = key_name(job_id, area, key_fragment, "i")
-    kvs_op("incr", key)
+    if _BUFFER_STATE.depth > 0:
+        _buffer_incr(job_id, key, amount)
+        if time.time() - _BUFFER_STATE.last_flush > FLUSH_INTERVAL:
+            flush_counters()
+    else:
+        _incr(job_id, key, amount)
 
 
 def get_counter(job_id, area, key_fragment, counter_type):
@@ -273,14 +421,107 @@ def get_counter(job_id, area, key_fragment, counter_type):
     key = key_name(job_id, area, key_fragment, counter_type)
     if not key:
         return
-    value = kvs_op("get", key)
+    value = _get(job_id, key)
     return int(value) if value else value
 
 
+def set_units_total(job_id, area, total):
+    """Set the number of units of work (e.g. sites) to be processed in the
+    given computation area, see :func:`record_units`."""
+    set_total(job_id, area, UNITS, total)
+
+
+def record_units(job_id, area, amount):
+    """Count the units of work processed by a task in the given
+    computation area."""
+    incr_counter(job_id, area, UNITS, amount)
+
+
+def units(job_id, area):
+    """Return the number of units of work processed and to be processed
+    in the given computation area.
+
+    :returns: a (done, total) 2-tuple, `total` is `None` if the total was
+        not set (yet)
+    """
+    return (get_counter(job_id, area, UNITS, "i") or 0,
+            get_counter(job_id, area, UNITS, "t"))
+
+
+def current_area(job_id):
+    """Return the computation area ("h" or "r") the job is working on
+    or `None` if no units of work were announced (yet).
+
+    The risk phase of a job follows its hazard phase."""
+    for area in ("r", "h"):
+        if units(job_id, area)[1] is not None:
+            return area
+    return None
+
+
+# pylint: disable=C0103
+Progress = collections.namedtuple(
+    "Progress", "area done total throughput eta")
+
+
+class ProgressEstimator(object):
+    """Estimate when the phases of a job will be completed.
+
+    The throughput (units of work per second) of each computation area is
+    measured between consecutive samples of the units counters and smoothed
+    with an exponential moving average.
+    """
+
+    def __init__(self, job_id, smoothing=THROUGHPUT_SMOOTHING):
+        self.job_id = job_id
+        self.smoothing = smoothing
+        # Maps computation areas to (time, units done) samples.
+        self.samples = dict()
+        # Maps computation areas to smoothed throughputs.
+        self.throughputs = dict()
+
+    def sample(self, area=None, now=None):
+        """Sample the units counters of the given area (defaults to the
+        current one, see :func:`current_area`).
+
+        :returns: a :class:`Progress` instance, its `eta` (seconds since the
+            epoch) is `None` until the throughput could be measured, or
+            `None` if no units of work were announced (yet)
+        """
+        area = area or current_area(self.job_id)
+        if area is None:
+            return None
+        now = time.time() if now is None else now
+        done, total = units(self.job_id, area)
+
+        previous = self.samples.get(area)
+        if previous is not None and now > previous[0]:
+            latest = float(done - previous[1]) / (now - previous[0])
+            average = self.throughputs.get(area)
+            if average is None:
+                average = latest
+            else:
+                average = (self.smoothing * latest
+                           + (1 - self.smoothing) * average)
+            self.throughputs[area] = average
+        self.samples[area] = (now, done)
+
+        throughput = self.throughputs.get(area)
+        eta = None
+        if total is not None and done >= total:
+            eta = now
+        elif total is not None and throughput:
+            eta = now + (total - done) / throughput
+        return Progress(area, done, total, throughput, eta)
+
+
 def delete_job_counters(job_id):
     """Delete the progress indication counters for the given `job_id`."""
+    with _PENDING_LOCK:
+        for pending in [p for p in _PENDING if p[0] == job_id]:
+            del _PENDING[pending]
     conn = _redis()
-    keys = conn.keys("oqs/%s*" % job_id)
+    keys = conn.keys("oqs/%s/*" % job_id)
     if keys:
         conn.delete(*keys)
 
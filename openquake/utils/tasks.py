@@ -19,10 +19,231 @@
 
 """Utility functions related to splitting work into tasks."""
 
+import collections
+import cPickle
+import functools
+import hashlib
 import itertools
+import math
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+from celery.exceptions import TimeoutError
+from celery.registry import tasks as task_registry
+from celery.result import AsyncResult
+from celery.task.control import inspect
 from celery.task.sets import TaskSet
+from django.db import close_connection
 
+from openquake import kvs
 from openquake import logs
+from openquake.utils import config
+
+# The default number of attempts of a task invocation.
+DEFAULT_MAX_ATTEMPTS = 3
+
+# The default number of seconds to wait before re-queueing a failed task.
+DEFAULT_RETRY_DELAY = 10
+
+# Module-private pool of workers of the local executor, to be used by
+# submit().
+__LOCAL_POOL = None
+
+# Module-private number of celery workers, to be used by active_workers().
+__CELERY_WORKERS = None
+
+# The number of tasks per worker aimed at when splitting a job in blocks, a
+# few tasks per worker even out the differences in task run times.
+TASKS_PER_WORKER = 4
+
+
+def executor():
+    """Return the configured task executor (the `executor` setting in the
+    `tasks` section of openquake.cfg):
+
+        - 'celery' (the default): tasks are sent to the celery workers
+        - 'local': tasks are run by a pool of worker processes of the job
+          process (see :func:`start_local_pool`), no message broker is
+          needed
+    """
+    return config.get("tasks", "executor") or "celery"
+
+
+def local_workers():
+    """Return the number of workers of the local executor, as configured in
+    the `tasks` section of openquake.cfg (`local_workers`); defaults to the
+    number of CPUs."""
+    return config.positive_int(
+        "tasks", "local_workers", multiprocessing.cpu_count())
+
+
+# pylint: disable=W0603
+def start_local_pool():
+    """Start the workers of the local executor.
+
+    The workers are processes, unless the in-memory kvs backend is used
+    (see :mod:`openquake.kvs.memory`): its data is only visible within the
+    job process, the workers are threads in that case.
+
+    This must be called before the job process starts the JVM, a forked
+    copy of which would not be usable by the worker processes.
+    """
+    global __LOCAL_POOL
+    if __LOCAL_POOL is not None:
+        return
+    if kvs.backend() == "memory":
+        __LOCAL_POOL = ThreadPool(local_workers())
+    else:
+        # The worker processes must not share the database connection of
+        # the job process.
+        close_connection()
+        __LOCAL_POOL = multiprocessing.Pool(local_workers())
+
+
+def stop_local_pool():
+    """Wait for the workers of the local executor to finish and stop
+    them."""
+    global __LOCAL_POOL
+    if __LOCAL_POOL is None:
+        return
+    __LOCAL_POOL.close()
+    __LOCAL_POOL.join()
+    __LOCAL_POOL = None
+
+
+def _celery_workers():
+    """Return the total pool size of the celery workers that reply to a
+    `stats` broadcast, or `None` if no worker replies."""
+    try:
+        replies = inspect().stats()
+    except Exception, exc:  # pylint: disable=W0703
+        logs.LOG.warn("Cannot inspect the celery workers: %s" % exc)
+        return None
+    if not replies:
+        return None
+    return sum(reply.get("pool", dict()).get("max-concurrency", 1)
+               for reply in replies.itervalues()) or None
+
+
+def active_workers():
+    """Return the number of workers the tasks of a job are run by:
+
+        - the `workers` setting in the `tasks` section of openquake.cfg,
+          if set
+        - the number of workers of the local executor (see
+          :func:`local_workers`)
+        - the total pool size of the celery workers; they are inspected
+          once per process, the number of CPUs of this machine is assumed
+          if none of them replies
+    """
+    global __CELERY_WORKERS
+    configured = config.positive_int("tasks", "workers")
+    if configured is not None:
+        return configured
+    if executor() == "local":
+        return local_workers()
+    if __CELERY_WORKERS is None:
+        __CELERY_WORKERS = _celery_workers() or multiprocessing.cpu_count()
+    return __CELERY_WORKERS
+
+
+def adaptive_block_size(units, unit_cost, max_block_cost, min_blocks=1):
+    """Return the number of units (e.g. sites) per block of a job.
+
+    The units are split into (at least) `min_blocks` blocks of equal size,
+    and blocks whose estimated cost exceeds `max_block_cost` are split
+    further.
+
+    :param int units: the number of units of the job
+    :param float unit_cost: the estimated cost (e.g. memory) of a unit
+    :param float max_block_cost: the maximum cost of a block, in the same
+        unit as `unit_cost`
+    :param int min_blocks: the minimum number of blocks, e.g. to provide
+        enough tasks for all workers (see :data:`TASKS_PER_WORKER`)
+    :returns: a positive integer
+    """
+    block_size = int(math.ceil(float(units) / max(min_blocks, 1)))
+    if unit_cost > 0:
+        block_size = min(block_size, int(max_block_cost // unit_cost))
+    return max(block_size, 1)
+
+
+def _run_local_task(task_name, args, kwargs):
+    """Run the named task in a worker of the local executor."""
+    if threading.current_thread().name != "MainThread":
+        # pylint: disable=W0404
+        import jpype
+        if jpype.isJVMStarted() and not jpype.isThreadAttachedToJVM():
+            jpype.attachThreadToJVM()
+    return task_registry[task_name](*args, **kwargs)
+
+
+class LocalResult(object):
+    """The result of a task run by the local executor, offering the parts
+    of the `celery.result.AsyncResult` API used by the calculators."""
+
+    def __init__(self, async_result):
+        self.task_id = str(uuid.uuid4())
+        self._async_result = async_result
+
+    def ready(self):
+        """True if the task has completed."""
+        return self._async_result.ready()
+
+    def get(self, timeout=None):
+        """Wait for the task to complete and return its result, the
+        exception raised by a failed task is re-raised."""
+        return self._async_result.get(timeout)
+
+    wait = get
+
+    def successful(self):
+        """True if the task has completed without raising an
+        exception."""
+        return self.ready() and self._async_result.successful()
+
+    @property
+    def status(self):
+        """'PENDING', 'SUCCESS' or 'FAILURE'."""
+        if not self.ready():
+            return "PENDING"
+        return "SUCCESS" if self.successful() else "FAILURE"
+
+    @property
+    def result(self):
+        """The result of the task, the exception raised by a failed task,
+        `None` while the task is pending."""
+        if not self.ready():
+            return None
+        try:
+            return self.get()
+        except Exception, exc:  # pylint: disable=W0703
+            return exc
+
+
+def submit(task_func, *args, **kwargs):
+    """Run the given task asynchronously with the configured executor (see
+    :func:`executor`).
+
+    :param task_func: A `celery` task callable.
+    :returns: a `celery.result.AsyncResult` or, with the local executor, a
+        :class:`LocalResult` instance; its `submitted` attribute holds the
+        submission time (see :func:`as_completed`)
+    """
+    if executor() != "local":
+        result = task_func.delay(*args, **kwargs)
+    else:
+        start_local_pool()
+        result = LocalResult(__LOCAL_POOL.apply_async(
+            _run_local_task, (task_func.name, args, kwargs)))
+    result.submitted = time.time()
+    return result
 
 
 def distribute(task_func, (name, data), tf_args=None, ath=None, ath_args=None,
@@ -59,16 +280,26 @@ def distribute(task_func, (name, data), tf_args=None, ath=None, ath_args=None,
     """
     logs.HAZARD_LOG.debug("-data_length: %s" % len(data))
 
-    subtask = task_func.subtask
     if tf_args:
-        subtasks = [subtask(**dict(tf_args.items() + [(name, item)]))
-                    for item in data]
+        task_kwargs = [dict(tf_args.items() + [(name, item)])
+                       for item in data]
     else:
-        subtasks = [subtask(**{name: item}) for item in data]
+        task_kwargs = [{name: item} for item in data]
 
-    logs.HAZARD_LOG.debug("-#subtasks: %s" % len(subtasks))
+    logs.HAZARD_LOG.debug("-#subtasks: %s" % len(task_kwargs))
+
+    if executor() == "local":
+        # There is no supervisor watching the failure counters of the
+        # tasks, the local executor waits for all the tasks (whether their
+        # results are ignored or not) and raises the first failure.
+        pending = [submit(task_func, **kwargs) for kwargs in task_kwargs]
+        results = [result.get() for result in pending]
+    else:
+        subtask = task_func.subtask
+        result = TaskSet(
+            tasks=[subtask(**kwargs) for kwargs in task_kwargs]).apply_async()
+        results = None
 
-    result = TaskSet(tasks=subtasks).apply_async()
     if task_func.ignore_result:
         # Did the user specify an asynchronous task handler function?
         if ath:
@@ -78,7 +309,8 @@ def distribute(task_func, (name, data), tf_args=None, ath=None, ath_args=None,
                 return ath()
     else:
         # Only called when we expect result messages to come back.
-        results = result.join_native()
+        if results is None:
+            results = result.join_native()
         _check_exception(results)
         if results and flatten_results:
             sample = results[0]
@@ -94,6 +326,261 @@ def _check_exception(results):
             raise result
 
 
+def task_timeout():
+    """Return the maximum number of seconds a task may take from its
+    submission to its completion, as configured in the `tasks` section of
+    openquake.cfg (`task_timeout`), `None` if there is no limit."""
+    return config.positive_int("tasks", "task_timeout")
+
+
+def _ready_results(batch, wait):
+    """Return the results of the batch that are ready.
+
+    The results of a celery result backend supporting `get_many` (e.g. the
+    amqp backend) are collected with a single request, waiting at most
+    `wait` seconds for the first/next one; the others (e.g.
+    :class:`LocalResult` instances) are asked one by one.
+    """
+    backend = getattr(batch[0], "backend", None)
+    if not (all(isinstance(result, AsyncResult) for result in batch)
+            and hasattr(backend, "get_many")):
+        return [result for result in batch if result.ready()]
+
+    by_id = dict((result.task_id, result) for result in batch)
+    ready = []
+    try:
+        for task_id, _ in backend.get_many(by_id.keys(), timeout=wait,
+                                           interval=wait):
+            ready.append(by_id[task_id])
+    except (TimeoutError, socket.timeout):
+        pass
+    return ready
+
+
+def as_completed(results, timeout=None, poll_interval=0.1, batch_size=100):
+    """Yield the given task results in the order in which they complete.
+
+    The pending results are polled in batches of (at most) `batch_size`
+    items, with one request to the result backend per batch where the
+    backend supports it (see :func:`_ready_results`); a result is yielded
+    as soon as it is ready (whether the task succeeded or not). The caller
+    can thus process the results of fast tasks while slower ones are still
+    running instead of waiting for the tasks in submission order.
+
+    :param results: the `celery.result.AsyncResult` instances of interest
+    :param timeout: the maximum number of seconds a task may take from its
+        submission (see :func:`submit`) to its completion, `None` means
+        "wait forever"
+    :param float poll_interval: the number of seconds to wait for a batch
+        without completed tasks
+    :param int batch_size: the number of pending results polled per batch
+    :returns: a generator of completed `celery.result.AsyncResult` instances
+    :raises TimeoutError: if a task did not complete within `timeout`
+        seconds
+    """
+    now = time.time()
+    pending = collections.deque(
+        (result, getattr(result, "submitted", now)) for result in results)
+    # The number of pending results polled since the last completion.
+    checked = 0
+
+    while pending:
+        batch = [pending.popleft() for _ in xrange(min(batch_size,
+                                                       len(pending)))]
+        ready = _ready_results([result for result, _ in batch],
+                               poll_interval)
+        for result in ready:
+            yield result
+
+        ready = set(id(result) for result in ready)
+        late = []
+        for result, submitted in batch:
+            if id(result) in ready:
+                continue
+            pending.append((result, submitted))
+            if timeout is not None and time.time() - submitted > timeout:
+                late.append(result.task_id)
+        if late:
+            raise TimeoutError(
+                "task(s) %s did not complete within %s seconds"
+                % (", ".join(str(task_id) for task_id in late), timeout))
+
+        checked = 0 if ready else checked + len(batch)
+        if pending and checked >= len(pending):
+            # A full pass over the pending results without any completions.
+            checked = 0
+            time.sleep(poll_interval)
+
+
+def as_completed_bounded(submit, task_args, max_pending, timeout=None,
+                         poll_interval=0.1):
+    """Submit tasks keeping at most `max_pending` of them in flight and
+    yield them in the order in which they complete.
+
+    A new task is submitted whenever a completed one has been handed to
+    the caller, so that the workers are kept busy while the caller
+    processes the results.
+
+    :param submit: a function taking the items of `task_args` as
+        positional arguments and returning a `celery.result.AsyncResult`
+    :param task_args: an iterable of argument tuples, one per task; it is
+        consumed lazily
+    :param int max_pending: the maximum number of tasks in flight
+    :param timeout: see :func:`as_completed`
+    :param float poll_interval: see :func:`as_completed`
+    :returns: a generator of (args, `celery.result.AsyncResult`) pairs
+    """
+    assert max_pending > 0, "max_pending must be positive"
+
+    task_args = iter(task_args)
+    # (result, args) pairs of the tasks in flight
+    pending = []
+
+    while True:
+        for args in task_args:
+            pending.append((submit(*args), args))
+            if len(pending) >= max_pending:
+                break
+
+        if not pending:
+            return
+
+        done = as_completed([result for result, _ in pending],
+                            timeout=timeout,
+                            poll_interval=poll_interval).next()
+        for idx, (result, args) in enumerate(pending):
+            if result is done:
+                del pending[idx]
+                break
+
+        yield args, done
+
+
+def max_attempts():
+    """Return the number of attempts of a task invocation, as configured in
+    the `tasks` section of openquake.cfg (`max_attempts`)."""
+    return config.positive_int(
+        "tasks", "max_attempts", DEFAULT_MAX_ATTEMPTS)
+
+
+def retry_delay(retries):
+    """Return the number of seconds to wait before re-queueing a failed
+    task. The delay configured in the `tasks` section of openquake.cfg
+    (`retry_delay`) is doubled for each retry already performed.
+
+    :param int retries: the number of retries already performed
+    """
+    configured = config.get("tasks", "retry_delay")
+    if configured is not None:
+        delay = float(configured.strip())
+    else:
+        delay = DEFAULT_RETRY_DELAY
+    return delay * 2 ** retries
+
+
+def _invocation_id(args, kwargs):
+    """Identify a task invocation of a job by its arguments (the job ID
+    excluded)."""
+    kwargs = sorted((k, v) for k, v in kwargs.iteritems() if k != "job_id")
+    return hashlib.md5(repr((args[1:], kwargs))).hexdigest()
+
+
+def _task_request(task_name):
+    """Return the request context of the named task or `None` if no such
+    task is registered."""
+    try:
+        return task_registry[task_name].request
+    except KeyError:
+        return None
+
+
+def retrying(func):
+    """Make the invocations of a task idempotent and retry them on failure.
+
+    The result of each successful invocation is recorded in the KVS (see
+    :func:`openquake.kvs.tokens.completed_tasks_key`); an invocation with
+    the same arguments, e.g. a re-delivered message, returns the recorded
+    result instead of computing it again. Only a completion marker is
+    recorded for tasks whose results are ignored, their repeated
+    invocations return `None`. See also :func:`forget_completed`.
+
+    A failed invocation is re-queued by means of `celery`'s task retry
+    mechanism, with an exponential back-off (see :func:`retry_delay`),
+    until it was attempted :func:`max_attempts` times; only then is the
+    exception raised.
+
+    Invocations that are not executed by a worker (e.g. direct calls) are
+    neither recorded nor retried.
+
+    The first argument of the wrapped task must be the job ID. Its
+    arguments must identify the work performed, and its result must be
+    picklable.
+    """
+    task_name = "%s.%s" % (func.__module__, func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):  # pylint: disable=C0111
+        request = _task_request(task_name)
+        if request is None or request.id is None:
+            return func(*args, **kwargs)
+
+        job_id = args[0] if args else kwargs["job_id"]
+        key = kvs.tokens.completed_tasks_key(job_id, func.__name__)
+        field = _invocation_id(args, kwargs)
+        ignore_result = task_registry[task_name].ignore_result
+
+        if ignore_result:
+            if kvs.get_client().sismember(key, field):
+                logs.LOG.debug("%s already completed for job %s, skipped"
+                               % (func.__name__, job_id))
+                return None
+        else:
+            completed = kvs.get_client().hget(key, field)
+            if completed is not None:
+                logs.LOG.debug("%s already completed for job %s, skipped"
+                               % (func.__name__, job_id))
+                return cPickle.loads(completed)
+
+        try:
+            result = func(*args, **kwargs)
+        except JobCompletedError:
+            raise
+        except Exception, exc:  # pylint: disable=W0703
+            exc_info = sys.exc_info()
+            attempts = max_attempts()
+            if request.retries + 1 >= attempts:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            logs.LOG.warn("%s failed for job %s (attempt %s of %s): %s"
+                          % (func.__name__, job_id, request.retries + 1,
+                             attempts, exc))
+            task_registry[task_name].retry(
+                exc=exc, countdown=retry_delay(request.retries),
+                max_retries=attempts - 1)
+
+        if ignore_result:
+            kvs.get_client().sadd(key, field)
+        else:
+            kvs.get_client().hset(
+                key, field, cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+        return result
+
+    return wrapper
+
+
+def forget_completed(job_id, task_names, client=None):
+    """Purge the records of the completed invocations of the given tasks
+    (see :func:`retrying`) from the KVS.
+
+    :param int job_id: identifier of the job in question
+    :param task_names: the names of the task functions
+    :param client: the redis client to use, defaults to
+        :func:`openquake.kvs.get_client`
+    """
+    client = client or kvs.get_client()
+    client.delete(*[kvs.tokens.completed_tasks_key(job_id, name)
+                    for name in task_names])
+
+
 class JobCompletedError(Exception):
     """
     Exception to be thrown by :func:`get_running_job`
@@ -101,6 +588,68 @@ class JobCompletedError(Exception):
     """
 
 
+# The maximum number of jobs whose context is cached per worker process.
+JOB_CACHE_SIZE = 8
+
+# Module-private cache of job contexts and calculators, to be used by
+# get_running_job() and calculator_for_task(). Maps job ids to
+# (status generation, job context, {job type: calculator}) triples, the least
+# recently used job comes first.
+_JOB_CACHE = collections.OrderedDict()
+
+# The id of the job for which AMQP logging was last initialized in this
+# worker process.
+_LOGGING_JOB_ID = None
+
+
+def _cached_job(job_id, generation):
+    """Return the cache entry for the given job or `None`.
+
+    A cache entry is only valid for the job status generation at which it was
+    created; stale entries are evicted.
+    """
+    entry = _JOB_CACHE.pop(job_id, None)
+    if entry is None or generation is None or entry[0] != generation:
+        return None
+    # Re-insert the entry in order to mark it as the most recently used one.
+    _JOB_CACHE[job_id] = entry
+    return entry
+
+
+def _cache_job(job_id, generation, job_ctxt):
+    """Cache the given job context, evict the least recently used job."""
+    if generation is None:
+        # The job's status generation is unknown (e.g. the job's KVS data
+        # was garbage collected), do not cache anything.
+        return
+    _JOB_CACHE[job_id] = (generation, job_ctxt, dict())
+    while len(_JOB_CACHE) > JOB_CACHE_SIZE:
+        _JOB_CACHE.popitem(last=False)
+
+
+def clear_job_cache():
+    """Purge all job contexts/calculators cached in this process."""
+    global _LOGGING_JOB_ID  # pylint: disable=W0603
+    _JOB_CACHE.clear()
+    _LOGGING_JOB_ID = None
+
+
+def _init_logs(job_ctxt, job_id):
+    """Initialize AMQP logging unless already done for the given job."""
+    global _LOGGING_JOB_ID  # pylint: disable=W0603
+    if _LOGGING_JOB_ID == job_id or executor() == "local":
+        # The workers of the local executor use the log handlers of the
+        # job process.
+        return
+
+    if job_ctxt and job_ctxt.params:
+        level = job_ctxt.log_level
+    else:
+        level = 'warn'
+    logs.init_logs_amqp_send(level=level, job_id=job_id)
+    _LOGGING_JOB_ID = job_id
+
+
 def get_running_job(job_id):
     """Helper function which is intended to be run by celery task functions.
 
@@ -109,6 +658,11 @@ def get_running_job(job_id):
     data from the database and KVS and return a
     :class:`openquake.engine.JobContext` object.
 
+    The :class:`openquake.engine.JobContext` is cached per worker process
+    and reused as long as the job's status generation counter (see
+    :func:`openquake.kvs.job_status_generation`) does not change. A task
+    for a job whose context is cached thus only costs a single KVS read.
+
     If the calculation is not currently running, a
     :exception:`JobCompletedError` is raised.
 
@@ -123,15 +677,19 @@ def get_running_job(job_id):
     # pylint: disable=W0404
     from openquake.engine import JobContext
 
-    if JobContext.is_job_completed(job_id):
-        raise JobCompletedError(job_id)
+    generation = kvs.job_status_generation(job_id)
+    entry = _cached_job(job_id, generation)
 
-    job_ctxt = JobContext.from_kvs(job_id)
-    if job_ctxt and job_ctxt.params:
-        level = job_ctxt.log_level
+    if entry is not None:
+        job_ctxt = entry[1]
     else:
-        level = 'warn'
-    logs.init_logs_amqp_send(level=level, job_id=job_id)
+        if JobContext.is_job_completed(job_id):
+            raise JobCompletedError(job_id)
+
+        job_ctxt = JobContext.from_kvs(job_id)
+        _cache_job(job_id, generation, job_ctxt)
+
+    _init_logs(job_ctxt, job_id)
 
     return job_ctxt
 
@@ -142,6 +700,9 @@ def calculator_for_task(job_id, job_type):
     data from the database and KVS and instantiate the calculator required for
     a task's computation.
 
+    Calculators are cached per worker process alongside the job context (see
+    :func:`get_running_job`).
+
     :param int job_id:
         id of a in-progress job.
     :params job_type:
@@ -159,7 +720,17 @@ def calculator_for_task(job_id, job_type):
     from openquake.engine import CALCS
 
     job_ctxt = get_running_job(job_id)
-    calc_mode = job_ctxt.oq_job_profile.calc_mode
-    calculator = CALCS[job_type][calc_mode](job_ctxt)
+
+    entry = _JOB_CACHE.get(job_id)
+    if entry is not None and entry[1] is job_ctxt:
+        calculators = entry[2]
+    else:
+        calculators = dict()
+
+    calculator = calculators.get(job_type)
+    if calculator is None:
+        calc_mode = job_ctxt.oq_job_profile.calc_mode
+        calculator = CALCS[job_type][calc_mode](job_ctxt)
+        calculators[job_type] = calculator
 
     return calculator
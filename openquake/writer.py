@@ -122,6 +122,10 @@ class DBWriter(object):
     override serialize().
     """
 
+    #: Flush the bulk inserter after this many entries, so that the rows
+    #: of a large output are never all kept in memory.
+    BULK_FLUSH_SIZE = 10000
+
     def __init__(self, nrml_path, oq_job_id):
         self.nrml_path = nrml_path
         self.oq_job_id = oq_job_id
@@ -159,8 +163,9 @@ class DBWriter(object):
 
         An Output record with type get_output_type() will be created, then
         each item of the iterable will be serialized in turn to the database.
+        The iterable may be a generator, it is consumed only once.
         """
-        LOGGER.info("serializing %s points", len(iterable))
+        LOGGER.info("serializing points")
 
         if not self.output:
             self.insert_output(self.get_output_type())
@@ -171,13 +176,19 @@ class DBWriter(object):
         else:
             items = iterable
 
+        count = 0
         for key, values in items:
             self.insert_datum(key, values)
+            count += 1
+
+            if (self.bulk_inserter
+                and self.bulk_inserter.count >= self.BULK_FLUSH_SIZE):
+                self.bulk_inserter.flush()
 
         if self.bulk_inserter:
             self.bulk_inserter.flush()
 
-        LOGGER.info("serialized %s points", len(iterable))
+        LOGGER.info("serialized %s points", count)
 
 
 class CompositeWriter(object):
@@ -18,6 +18,7 @@
 import unittest
 
 from openquake import engine
+from openquake import kvs
 from openquake import shapes
 from openquake.calculators.hazard import general
 from openquake.db import models
@@ -337,3 +338,19 @@ class SetJavaSiteParamsTestCase(unittest.TestCase):
         self.assertEqual(
             15.0, jsite.getParameter('Depth 2.5 km/sec').getValue().value
         )
+
+
+class MgetDecodedTestCase(unittest.TestCase):
+    """Tests the behaviour of general.mget_decoded()."""
+
+    def test_missing_values_are_none(self):
+        client = kvs.get_client()
+        client.set("mget_decoded_test!a", "[1.5, 2]")
+        client.delete("mget_decoded_test!b")
+        try:
+            self.assertEqual(
+                [[1.5, 2], None],
+                general.mget_decoded(["mget_decoded_test!a",
+                                      "mget_decoded_test!b"]))
+        finally:
+            client.delete("mget_decoded_test!a")
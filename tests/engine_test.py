@@ -14,9 +14,14 @@
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import fcntl
+import hashlib
+import mock
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 import unittest
 import uuid
 
@@ -353,6 +358,65 @@ class FileDigestTestCase(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+class FileDigestsTestCase(helpers.ConfigTestCase, unittest.TestCase):
+    """Test the _file_digests() function and the digest cache."""
+
+    def setUp(self):
+        self.setup_config()
+        self.cache_dir = tempfile.mkdtemp()
+        self.prepare_config("inputs", {
+            "digest_cache": os.path.join(self.cache_dir, "digests"),
+            "digest_threads": 2})
+        self.paths = [helpers.touch(content="abc" * (i + 1))
+                      for i in xrange(3)]
+        self.expected = dict(
+            (path, hashlib.md5(open(path).read()).hexdigest())
+            for path in self.paths)
+
+    def tearDown(self):
+        self.teardown_config()
+        shutil.rmtree(self.cache_dir)
+        for path in self.paths:
+            os.unlink(path)
+
+    def test_file_digests(self):
+        self.assertEqual(self.expected, engine._file_digests(self.paths))
+
+    def test_file_digests_are_cached(self):
+        engine._file_digests(self.paths)
+        with mock.patch("openquake.engine._compute_digest") as compute:
+            self.assertEqual(self.expected, engine._file_digests(self.paths))
+            self.assertEqual(0, compute.call_count)
+
+    def test_changed_file_is_hashed_again(self):
+        engine._file_digests(self.paths)
+        with open(self.paths[0], "a") as fh:
+            fh.write("def")
+        self.assertEqual(hashlib.md5("abcdef").hexdigest(),
+                         engine._file_digest(self.paths[0]))
+
+    def test_cache_errors_are_cache_misses(self):
+        engine._file_digests(self.paths)
+        with mock.patch("shelve.open", side_effect=ValueError("corrupt")):
+            self.assertEqual(self.expected, engine._file_digests(self.paths))
+
+    def test_cache_is_locked(self):
+        with mock.patch("fcntl.flock") as flock:
+            engine._file_digests(self.paths)
+            engine._file_digests(self.paths)
+        # written once (exclusive), then read once (shared)
+        self.assertEqual(
+            [fcntl.LOCK_EX, fcntl.LOCK_UN, fcntl.LOCK_SH, fcntl.LOCK_UN],
+            [args[1] for args, _ in flock.call_args_list])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, "digests.lock")))
+
+    def test_file_digests_without_cache(self):
+        self.prepare_config("inputs", {"digest_cache": ""})
+        self.assertEqual(self.expected, engine._file_digests(self.paths))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+
 class IdenticalInputTestCase(unittest.TestCase, helpers.DbTestCase):
     """Test the _identical_input() function."""
 
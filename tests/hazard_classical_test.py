@@ -25,6 +25,7 @@ import os
 import unittest
 
 from openquake.calculators.hazard.classical import core as classical
+from openquake.calculators.hazard import general
 from openquake.calculators.hazard.general import create_java_cache
 from openquake import kvs
 from openquake import logs
@@ -234,6 +235,29 @@ class DoMeansTestCase(unittest.TestCase):
             map_serializer=fake_serializer)
         self.assertEqual(1, fake_serializer.number_of_calls)
 
+    def test_maps_computed_by_curve_tasks_when_configured(self):
+        """
+        When `maps_in_curve_tasks` is set the curve tasks receive the IMLs
+        and PoEs of the maps and no separate map calculation is done.
+        """
+        self.job_ctxt.params["POES"] = "0.6 0.8"
+        map_func = mock.Mock()
+        map_serializer = mock.Mock()
+
+        with mock.patch("openquake.utils.config.flag_set") as flag_set:
+            flag_set.return_value = True
+            with mock.patch("openquake.utils.tasks.distribute") as dist:
+                self.calculator.do_means(
+                    self.sites, 1, curve_serializer=lambda _: True,
+                    curve_task=test_data_reflector, map_func=map_func,
+                    map_serializer=map_serializer)
+
+        tf_args = dist.call_args[1]["tf_args"]
+        self.assertEqual([0.6, 0.8], tf_args["map_poes"])
+        self.assertEqual(self.job_ctxt.imls, tf_args["imls"])
+        self.assertEqual(0, map_func.call_count)
+        map_serializer.assert_called_once_with(self.sites, [0.6, 0.8])
+
     def test_missing_map_serializer_assertion(self):
         """
         When the mean map serialization function is not set an `AssertionError`
@@ -461,9 +485,10 @@ class ClassicalExecuteTestCase(unittest.TestCase):
             self.methods[method] = getattr(self.calculator, method)
             setattr(self.calculator, method,
                     mock.mocksignature(self.methods[method]))
-        patcher = patch("openquake.utils.config.hazard_block_size")
-        patcher.start().return_value = 3
-        self.patchers.append(patcher)
+        self.calculator.block_size = 3
+        # The test job has no db record, the checkpoints are kept in memory.
+        self.calculator._completed_units = set()
+        self.calculator.record_unit = self.calculator._completed_units.add
 
     def tearDown(self):
         for patcher in self.patchers:
@@ -513,6 +538,61 @@ class ClassicalExecuteTestCase(unittest.TestCase):
                     args = m.call_args_list[idx][0]
                     self.assertEqual(data_slices[idx], args[1])
 
+    def test_compute_block_size(self):
+        """The block size is derived from the kvs memory budget."""
+        # 8 sites, 2 realizations plus the mean curve, no IMLs: a site
+        # costs 3 curve ordinates.
+        site_cost = 3 * general.CURVE_ORDINATE_BYTES
+        with mock.patch("openquake.utils.config.configured_block_size",
+                        return_value=None):
+            with mock.patch("openquake.utils.memory.block_memory",
+                            return_value=2 * site_cost):
+                self.calculator.compute_block_size()
+                self.assertEqual(2, self.calculator.block_size)
+            self.calculator.compute_block_size()
+            self.assertEqual(8, self.calculator.block_size)
+
+    def test_compute_block_size_configured(self):
+        with mock.patch("openquake.utils.config.configured_block_size",
+                        return_value=5):
+            self.calculator.compute_block_size()
+            self.assertEqual(5, self.calculator.block_size)
+
+    def test_initialize_computes_block_size(self):
+        with mock.patch("openquake.calculators.hazard.general"
+                        ".get_site_model", return_value=None):
+            with mock.patch("openquake.utils.config.configured_block_size",
+                            return_value=5):
+                self.calculator.initialize()
+        self.assertEqual(5, self.calculator.block_size)
+
+    def test_completed_blocks_are_recorded(self):
+        """execute() records a checkpoint for each block of sites."""
+        with patch("openquake.input.logictree.LogicTreeProcessor"):
+            self.calculator.execute()
+        self.assertEqual(
+            set(["hazard:block:0", "hazard:block:3", "hazard:block:6"]),
+            self.calculator._completed_units)
+
+    def test_completed_blocks_are_skipped(self):
+        """The blocks completed by an earlier run of the job are skipped
+        when the results are written to the database only."""
+        self.calculator._completed_units.add("hazard:block:3")
+        with patch("openquake.input.logictree.LogicTreeProcessor"):
+            self.calculator.execute()
+        mmock = self.calculator.do_curves.mock
+        self.assertEqual(2, mmock.call_count)
+        self.assertEqual(self.sites[:3], mmock.call_args_list[0][0][0])
+        self.assertEqual(self.sites[6:], mmock.call_args_list[1][0][0])
+
+    def test_completed_blocks_are_recomputed_for_xml_output(self):
+        """The XML artifacts need all the blocks, none is skipped."""
+        self.job_ctxt.serialize_results_to = ['db', 'xml']
+        self.calculator._completed_units.add("hazard:block:3")
+        with patch("openquake.input.logictree.LogicTreeProcessor"):
+            self.calculator.execute()
+        self.assertEqual(3, self.calculator.do_curves.mock.call_count)
+
 
 class ReleaseDataFromKvsTestCase(unittest.TestCase):
     """Tests the behaviour of classical.release_data_from_kvs()."""
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Unit tests for the event based hazard calculator.
+"""
+
+import mock
+import numpy
+import random
+import unittest
+
+from openquake import kvs
+from openquake import shapes
+from openquake.calculators.hazard.event_based import core as event_based
+
+
+class TaskSeedsTestCase(unittest.TestCase):
+    """Tests the behaviour of EventBasedHazardCalculator.task_seeds()."""
+
+    PARAMS = {'SOURCE_MODEL_LT_RANDOM_SEED': 23,
+              'GMPE_LT_RANDOM_SEED': 5,
+              'GMF_RANDOM_SEED': 3}
+
+    def setUp(self):
+        self.calculator = event_based.EventBasedHazardCalculator(
+            dict(self.PARAMS))
+
+    def test_seeds_are_drawn_in_submission_order(self):
+        # the seeds are the ones the history by history loop used to draw
+        generators = [random.Random(), random.Random(), random.Random()]
+        for generator, key in zip(generators, [
+                'SOURCE_MODEL_LT_RANDOM_SEED', 'GMPE_LT_RANDOM_SEED',
+                'GMF_RANDOM_SEED']):
+            generator.seed(self.PARAMS[key])
+
+        expected = []
+        for i in xrange(3):
+            for j in xrange(2):
+                expected.append(
+                    (i, j) + tuple(g.getrandbits(32) for g in generators))
+
+        self.assertEqual(expected, self.calculator.task_seeds(3, 2))
+
+    def test_seeds_are_deterministic(self):
+        self.assertEqual(self.calculator.task_seeds(4, 3),
+                         self.calculator.task_seeds(4, 3))
+
+    def test_submit_passes_a_site_block_reference(self):
+        # the sites are not part of the task message
+        self.calculator.job_ctxt = mock.MagicMock()
+        self.calculator.job_ctxt.job_id = 11
+        task = event_based.compute_ground_motion_fields
+        with mock.patch.object(self.calculator, "store_source_model"):
+            with mock.patch.object(self.calculator, "store_gmpe_map"):
+                with mock.patch.object(task, "delay") as delay:
+                    self.calculator._submit_gmf_task((0, 200), 1, 2, 3, 4, 5)
+        delay.assert_called_once_with(11, (0, 200), 1, 2, 5)
+        sites_to_compute = self.calculator.job_ctxt.sites_to_compute
+        self.assertEqual(0, sites_to_compute.call_count)
+
+
+class MaxPendingTasksTestCase(unittest.TestCase):
+    """Tests the behaviour of event_based.max_pending_tasks()."""
+
+    def test_configured_value(self):
+        with mock.patch("openquake.utils.config.get") as get:
+            get.return_value = " 12 "
+            self.assertEqual(12, event_based.max_pending_tasks())
+
+    def test_default_value(self):
+        with mock.patch("openquake.utils.config.get") as get:
+            get.return_value = None
+            self.assertEqual(event_based.DEFAULT_MAX_PENDING_TASKS,
+                             event_based.max_pending_tasks())
+
+
+class GMFMatrixStorageTestCase(unittest.TestCase):
+    """Tests the storage of the GMF matrices in the KVS."""
+
+    JOB_ID = 8642
+
+    def setUp(self):
+        self.client = kvs.get_client()
+        self.gmvs = numpy.arange(21, dtype=numpy.float32).reshape(7, 3) / 10
+
+    def tearDown(self):
+        keys = self.client.keys("%s!*" % self.JOB_ID)
+        if keys:
+            self.client.delete(*keys)
+
+    def test_matrix_round_trip(self):
+        event_based.store_gmf_matrix(self.JOB_ID, 1, 2, self.gmvs,
+                                     chunk_size=3)
+        gmvs = event_based.load_gmf_matrix(self.JOB_ID, 1, 2)
+        self.assertEqual(numpy.float32, gmvs.dtype)
+        self.assertTrue(numpy.array_equal(self.gmvs, gmvs))
+
+    def test_matrix_is_stored_in_chunks(self):
+        event_based.store_gmf_matrix(self.JOB_ID, 0, 0, self.gmvs,
+                                     chunk_size=3)
+        header = kvs.get_value_json_decoded(
+            kvs.tokens.stochastic_set_key(self.JOB_ID, 0, 0))
+        self.assertEqual(dict(ruptures=7, sites=3, chunks=3), header)
+        last_chunk = self.client.get(
+            kvs.tokens.gmf_chunk_key(self.JOB_ID, 0, 0, 2))
+        self.assertEqual(self.gmvs[6:].tostring(), last_chunk)
+
+    def test_matrix_without_ruptures(self):
+        event_based.store_gmf_matrix(
+            self.JOB_ID, 0, 0, numpy.zeros((0, 3), dtype=numpy.float32))
+        self.assertEqual((0, 3),
+                         event_based.load_gmf_matrix(self.JOB_ID, 0, 0).shape)
+
+    def test_chunks_are_stored_as_produced(self):
+        def chunks():
+            yield self.gmvs[:4]
+            # the first chunk is stored, the header is not
+            self.assertTrue(self.client.exists(
+                kvs.tokens.gmf_chunk_key(self.JOB_ID, 3, 3, 0)))
+            self.assertFalse(self.client.exists(
+                kvs.tokens.stochastic_set_key(self.JOB_ID, 3, 3)))
+            yield self.gmvs[4:]
+
+        self.assertEqual(7, event_based.store_gmf_chunks(
+            self.JOB_ID, 3, 3, 3, chunks()))
+        gmvs = event_based.load_gmf_matrix(self.JOB_ID, 3, 3)
+        self.assertTrue(numpy.array_equal(self.gmvs, gmvs))
+
+    def test_missing_matrix(self):
+        self.assertTrue(event_based.load_gmf_matrix(self.JOB_ID, 5, 5) is None)
+
+
+class SerializeGMFTestCase(unittest.TestCase):
+    """Tests the serialization of the GMFs from the matrix."""
+
+    def test_one_gmf_per_rupture(self):
+        calculator = event_based.EventBasedHazardCalculator(
+            mock.MagicMock())
+        calculator.job_ctxt.__getitem__.return_value = False
+        sites = [shapes.Site(10.0, 45.0), shapes.Site(10.1, 45.2)]
+        gmvs = numpy.log(numpy.array([[0.1, 0.2], [0.3, 0.4]]))
+
+        with mock.patch("openquake.output.hazard.create_gmf_writer") as cgw:
+            calculator.serialize_gmf(0, 1, gmvs, sites)
+
+        serialized = [args[0] for args, _ in
+                      cgw.return_value.serialize.call_args_list]
+        self.assertEqual(2, len(serialized))
+        self.assertAlmostEqual(
+            0.4, serialized[1][shapes.Site(10.1, 45.2)]['groundMotion'])
+        self.assertAlmostEqual(
+            0.1, serialized[0][shapes.Site(10.0, 45.0)]['groundMotion'])
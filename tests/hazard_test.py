@@ -853,6 +853,47 @@ class MeanQuantileHazardMapsComputationTestCase(unittest.TestCase):
             kvs.tokens.quantile_hazard_map_key(
                 self.job_id, sites[1], 0.10, 0.75)))
 
+    def test_mean_curve_tasks_compute_the_map_values(self):
+        # the mean map values derived by the curve computation are the
+        # same as the ones of the separate map pass
+        mean_curve = kvs.get_value_json_decoded(
+            kvs.tokens.mean_hazard_curve_key(self.job_id, self.site))
+        kvs.set_value_json_encoded(
+            kvs.tokens.hazard_curve_poes_key(self.job_id, 0, self.site),
+            mean_curve)
+
+        hazard_general.compute_mean_hazard_curves(
+            self.job_id, [self.site], 1, imls=self.imls,
+            map_poes=[0.10, 0.20])
+        from_curve_task = [self._get_iml_at(self.site, poe)
+                           for poe in (0.10, 0.20)]
+
+        self._run([0.10, 0.20])
+        from_map_pass = [self._get_iml_at(self.site, poe)
+                         for poe in (0.10, 0.20)]
+
+        self.assertTrue(numpy.allclose(from_map_pass, from_curve_task))
+
+    def test_quantile_curve_tasks_compute_the_map_values(self):
+        mean_curve = kvs.get_value_json_decoded(
+            kvs.tokens.mean_hazard_curve_key(self.job_id, self.site))
+        kvs.set_value_json_encoded(
+            kvs.tokens.hazard_curve_poes_key(self.job_id, 0, self.site),
+            mean_curve)
+
+        hazard_general.compute_quantile_hazard_curves(
+            self.job_id, [self.site], 1, [0.5], imls=self.imls,
+            map_poes=[0.10])
+        key = kvs.tokens.quantile_hazard_map_key(
+            self.job_id, self.site, 0.10, 0.5)
+        from_curve_task = kvs.get_value_json_decoded(key)
+
+        hazard_general.compute_quantile_hazard_maps(
+            self.job_id, [self.site], [0.5], self.imls, [0.10])
+
+        self.assertTrue(numpy.allclose(
+            kvs.get_value_json_decoded(key), from_curve_task))
+
     def _get_iml_at(self, site, poe):
         return kvs.get_value_json_decoded(
                 kvs.tokens.mean_hazard_map_key(self.job_id, site, poe))
@@ -958,6 +999,38 @@ class ParameterizeSitesTestCase(unittest.TestCase):
             closest_data_patch.stop()
 
 
+class SiteIndexTestCase(unittest.TestCase):
+    """Tests the storage of the site index of a job in the KVS."""
+
+    JOB_ID = 8643
+
+    def setUp(self):
+        self.sites = [shapes.Site(10.0, 45.0), shapes.Site(10.1, 45.2),
+                      shapes.Site(10.2, 45.4, 1.5)]
+        hazard_general.store_site_index(self.JOB_ID, self.sites)
+
+    def tearDown(self):
+        kvs.get_client().delete(tokens.site_index_key(self.JOB_ID))
+
+    def test_load_site_index(self):
+        self.assertTrue(numpy.array_equal(
+            [[10.0, 45.0, 0.0], [10.1, 45.2, 0.0], [10.2, 45.4, 1.5]],
+            hazard_general.load_site_index(self.JOB_ID)))
+
+    def test_load_site_block(self):
+        self.assertEqual(self.sites[1:],
+                         hazard_general.load_site_block(self.JOB_ID, 1, 2))
+
+    def test_site_index_is_cached(self):
+        hazard_general.load_site_index(self.JOB_ID)
+        kvs.get_client().delete(tokens.site_index_key(self.JOB_ID))
+        self.assertEqual(self.sites[:1],
+                         hazard_general.load_site_block(self.JOB_ID, 0, 1))
+
+    def test_missing_site_index(self):
+        self.assertTrue(hazard_general.load_site_index(-1) is None)
+
+
 class IMLTestCase(unittest.TestCase):
     """
     Tests that every Intensity Measure Type
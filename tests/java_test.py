@@ -86,6 +86,26 @@ class CeleryJavaExceptionTestCase(unittest.TestCase):
         self.assertEqual('123', res)
 
 
+class JclassTestCase(unittest.TestCase):
+    """Tests related to the resolution of java classes."""
+
+    def test_jclass_caches_classes(self):
+        klass = java.jclass("ArrayList")
+        with helpers.patch("jpype.JClass") as jclass_mock:
+            self.assertTrue(klass is java.jclass("ArrayList"))
+            self.assertEqual(0, jclass_mock.call_count)
+
+    def test_preload_classes(self):
+        # All the classes used for the logic tree type checks are resolved.
+        java.preload_classes()
+        for class_key in ("GutenbergRichterMagFreqDist", "GEMPointSourceData",
+                          "GEMFaultSourceData", "GEMAreaSourceData",
+                          "GEMSubductionFaultSourceData"):
+            with helpers.patch("jpype.JClass") as jclass_mock:
+                java.jclass(class_key)
+                self.assertEqual(0, jclass_mock.call_count)
+
+
 class JavaExceptionTestCase(unittest.TestCase):
     """Test that java stack trace is retrieved correctly"""
 
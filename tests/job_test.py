@@ -833,6 +833,35 @@ class RunJobTestCase(unittest.TestCase):
             finally:
                 engine._launch_job = before_launch
 
+    def test_resume_job(self):
+        self.job.status = 'failed'
+        self.job.save()
+        job, params, sections = engine.resume_job(
+            self.job.id, helpers.get_data_path(CONFIG_FILE))
+        self.assertEqual(self.job.id, job.id)
+        self.assertEqual(self.params, params)
+        self.assertEqual(self.sections, sections)
+
+    def test_resume_succeeded_job(self):
+        self.job.status = 'succeeded'
+        self.job.save()
+        self.assertRaises(RuntimeError, engine.resume_job, self.job.id,
+                          helpers.get_data_path(CONFIG_FILE))
+
+    def test_resume_uhs_job(self):
+        # UHS calculations do not record checkpoints, resuming one would
+        # store its outputs twice.
+        self.job.status = 'failed'
+        self.job.save()
+        self.assertRaises(RuntimeError, engine.resume_job, self.job.id,
+                          helpers.demo_file('uhs/config.gem'))
+
+    def test_checkpoints4job(self):
+        models.JobCheckpoint(oq_job=self.job, unit='hazard').save()
+        models.JobCheckpoint(oq_job=self.job, unit='hazard:block:0').save()
+        self.assertEqual(set(['hazard', 'hazard:block:0']),
+                         models.checkpoints4job(self.job.id))
+
 
 class JobsWithExposureTestCase(unittest.TestCase):
     '''Tests related to job with exposure.'''
@@ -18,6 +18,7 @@
 
 
 import json
+import mock
 import numpy
 import os
 
@@ -306,3 +307,129 @@ class GetClientTestCase(unittest.TestCase):
         obj1 = kvs.get_client()
         obj2 = kvs.get_client()
         self.assertIs(obj1.connection_pool, obj2.connection_pool)
+
+    def test_get_dedicated_client_own_conn(self):
+        """
+        get_dedicated_client() returns a client that does not share the
+        get_client() connection pool.
+        """
+        self.assertIsNot(kvs.get_client().connection_pool,
+                         kvs.get_dedicated_client().connection_pool)
+
+
+class MemoryClientTestCase(unittest.TestCase):
+    """
+    Tests for the in-memory kvs backend.
+    """
+
+    def setUp(self):
+        self.client = kvs.memory.get_client(db=99)
+        self.client.flushdb()
+
+    def test_same_data(self):
+        """The clients of a database share its data."""
+        self.client.set("a", 1)
+        self.assertEqual("1", kvs.memory.get_client(db=99).get("a"))
+        self.assertIs(None, kvs.memory.get_client(db=98).get("a"))
+
+    def test_strings(self):
+        self.client.set("a", "x")
+        self.client.set("b", 2)
+        self.assertEqual(["x", "2", None], self.client.mget(["a", "b", "c"]))
+        self.assertEqual(3, self.client.incr("b"))
+        self.assertEqual(["a"], self.client.keys("a*"))
+        self.assertEqual(2, self.client.delete("a", "b", "c"))
+        self.assertEqual([], self.client.keys())
+
+    def test_hashes(self):
+        self.assertEqual(1, self.client.hset("h", "f", 1))
+        self.assertEqual(3, self.client.hincrby("h", "f", 2))
+        self.assertEqual(1, self.client.hincrby("h", "g", 1))
+        self.assertEqual("3", self.client.hget("h", "f"))
+        self.assertEqual({"f": "3", "g": "1"}, self.client.hgetall("h"))
+
+    def test_lists_and_sets(self):
+        self.client.rpush("l", 1, 2)
+        self.client.lpush("l", 0)
+        self.assertEqual(["0", "1", "2"], self.client.lrange("l", 0, -1))
+        self.assertEqual(["0", "1"], self.client.lrange("l", 0, 1))
+        self.assertEqual(2, self.client.sadd("s", 1, 2))
+        self.assertTrue(self.client.sismember("s", 1))
+        self.assertEqual(1, self.client.srem("s", 1))
+        self.assertEqual(set(["2"]), self.client.smembers("s"))
+
+    def test_pipeline(self):
+        self.client.set("a", "x")
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get("a")
+        pipe.delete("a")
+        self.assertEqual(["x", 1], pipe.execute())
+        self.assertIs(None, self.client.get("a"))
+
+    def test_get_client_with_memory_backend(self):
+        """get_client() returns the in-memory client if so configured."""
+        with mock.patch("openquake.kvs.backend", return_value="memory"):
+            self.assertTrue(
+                isinstance(kvs.get_client(), kvs.memory.MemoryClient))
+            self.assertTrue(isinstance(kvs.get_dedicated_client(),
+                                       kvs.memory.MemoryClient))
+
+
+class DeleteKeysTestCase(unittest.TestCase):
+    """
+    Tests for delete_keys()
+    """
+
+    def setUp(self):
+        self.client = kvs.get_client()
+        self.keys = ["delete_keys_test_%s" % idx for idx in xrange(25)]
+        for key in self.keys:
+            self.client.set(key, 1)
+
+    def tearDown(self):
+        self.client.delete(*self.keys)
+
+    def test_delete_keys(self):
+        """All the keys are deleted, whatever the batch size."""
+        kvs.delete_keys(self.keys, batch_size=7)
+        self.assertEqual([None] * len(self.keys), self.client.mget(self.keys))
+
+    def test_delete_keys_in_batches(self):
+        """No command is issued with more keys than the batch size."""
+        client = mock.MagicMock()
+        client.info.return_value = {"redis_version": "2.4.10"}
+        pipe = client.pipeline.return_value
+
+        kvs.delete_keys(self.keys, client=client, batch_size=10)
+
+        self.assertEqual([10, 10, 5],
+                         [len(args) for args, _ in pipe.delete.call_args_list])
+        self.assertEqual(0, pipe.unlink.call_count)
+        client.pipeline.assert_called_once_with(transaction=False)
+
+    def test_delete_keys_uses_unlink_when_supported(self):
+        client = mock.MagicMock()
+        client.info.return_value = {"redis_version": "4.0.9"}
+        pipe = client.pipeline.return_value
+
+        kvs.delete_keys(self.keys, client=client)
+
+        pipe.unlink.assert_called_once_with(*self.keys)
+        self.assertEqual(0, pipe.delete.call_count)
+
+    def test_server_version_is_cached(self):
+        client = mock.MagicMock()
+        client.connection_pool.connection_kwargs = dict(
+            host="delete-keys-test", port=6379)
+        client.info.return_value = {"redis_version": "4.0.9"}
+
+        kvs.delete_keys(self.keys, client=client)
+        kvs.delete_keys(self.keys, client=client)
+
+        self.assertEqual(1, client.info.call_count)
+        self.assertEqual(2, client.pipeline.return_value.unlink.call_count)
+
+    def test_delete_no_keys(self):
+        client = mock.MagicMock()
+        kvs.delete_keys([], client=client)
+        self.assertEqual(0, client.pipeline.call_count)
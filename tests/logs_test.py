@@ -375,3 +375,59 @@ class InitLogsAmqpSendTestCase(unittest.TestCase):
 
             logs.init_logs_amqp_send("error", 324)
             self.assertEqual(logging.root.level, logging.ERROR)
+
+
+class AMQPHandlerQueueTestCase(unittest.TestCase):
+    """Exercises the buffered publishing of the AMQPHandler."""
+
+    def setUp(self):
+        self.producer = mock.MagicMock(spec=kombu.messaging.Producer)
+        with mock.patch.object(logs.AMQPHandler, "_initialize") as minit:
+            minit.return_value = self.producer
+            self.handler = logs.AMQPHandler(queue_size=5, queue_full="drop")
+        self.handler.set_job_id(11)
+
+        self.log = logging.getLogger("tests.AMQPHandlerQueueTestCase")
+        self.log.setLevel(logging.DEBUG)
+        self.log.propagate = False
+        self.log.addHandler(self.handler)
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+
+    def test_flush_publishes_all_records(self):
+        for i in xrange(3):
+            self.log.info("message %s", i)
+        self.handler.flush()
+
+        self.assertEqual(3, self.producer.publish.call_count)
+        messages = [c[0][0]["msg"]
+                    for c in self.producer.publish.call_args_list]
+        self.assertEqual(["message 0", "message 1", "message 2"], messages)
+        data, routing_key = self.producer.publish.call_args[0]
+        self.assertEqual(socket.getfqdn(), data["hostname"])
+        self.assertEqual(11, data["job_id"])
+        self.assertEqual(
+            "oq.job.11.tests.AMQPHandlerQueueTestCase", routing_key)
+
+    def test_records_are_dropped_when_the_queue_is_full(self):
+        blocker = threading.Event()
+        self.producer.publish.side_effect = lambda *args: blocker.wait()
+
+        for i in xrange(20):
+            self.log.info("message %s", i)
+        blocker.set()
+        self.handler.flush()
+
+        self.assertTrue(self.handler.dropped > 0)
+        self.assertEqual(20, self.handler.dropped +
+                         self.producer.publish.call_count)
+
+    def test_hostname_is_resolved_once(self):
+        with mock.patch("socket.getfqdn") as getfqdn:
+            getfqdn.return_value = "some.host"
+            with mock.patch("openquake.logs._HOSTNAME", None):
+                self.assertEqual("some.host", logs.hostname())
+                self.assertEqual("some.host", logs.hostname())
+            self.assertEqual(1, getfqdn.call_count)
@@ -292,3 +292,55 @@ class LossMapOutputTestCase(unittest.TestCase):
                 actual_event, actual_elem = actual_elems[i]
                 self.assertEqual(event, actual_event)
                 self.assertEqual(elem.items(), actual_elem.items())
+
+    def test_loss_map_with_split_site_data(self):
+        """
+        Data for the same site passed in separate items is written to a
+        single map node, the output is the same as with grouped data.
+        """
+        split_data = [
+            LOSS_MAP_METADATA,
+            (SITE_A, [(SITE_A_LOSS_ONE, SITE_A_ASSET_ONE)]),
+            (SITE_B, [(SITE_B_LOSS_ONE, SITE_B_ASSET_ONE)]),
+            (SITE_A, [(SITE_A_LOSS_TWO, SITE_A_ASSET_TWO)])]
+
+        self.xml_writer.serialize(split_data)
+
+        expected = etree.parse(EXPECTED_TEST_LOSS_MAP)
+        actual = etree.parse(TEST_LOSS_MAP_XML_OUTPUT_PATH)
+        self.assertEqual(
+            [(elem.tag, elem.items()) for elem in expected.iter()],
+            [(elem.tag, elem.items()) for elem in actual.iter()])
+
+    def test_loss_map_from_generator(self):
+        """
+        Data can be streamed to the writer, adjacent items for the same
+        site are written to a single map node.
+        """
+        def stream():
+            yield LOSS_MAP_METADATA
+            yield (SITE_A, [(SITE_A_LOSS_ONE, SITE_A_ASSET_ONE)])
+            yield (SITE_A, [(SITE_A_LOSS_TWO, SITE_A_ASSET_TWO)])
+            yield (SITE_B, [(SITE_B_LOSS_ONE, SITE_B_ASSET_ONE)])
+
+        self.xml_writer.serialize(stream())
+
+        expected = etree.parse(EXPECTED_TEST_LOSS_MAP)
+        actual = etree.parse(TEST_LOSS_MAP_XML_OUTPUT_PATH)
+        self.assertEqual(
+            [(elem.tag, elem.items()) for elem in expected.iter()],
+            [(elem.tag, elem.items()) for elem in actual.iter()])
+
+    def test_split_metadata(self):
+        metadata, items = risk_output.split_metadata(
+            [LOSS_MAP_METADATA, 1, 2])
+        self.assertEqual(LOSS_MAP_METADATA, metadata)
+        self.assertEqual([1, 2], list(items))
+
+        metadata, items = risk_output.split_metadata(iter([1, 2]))
+        self.assertEqual({}, metadata)
+        self.assertEqual([1, 2], list(items))
+
+        metadata, items = risk_output.split_metadata([])
+        self.assertEqual({}, metadata)
+        self.assertEqual([], list(items))
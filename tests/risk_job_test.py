@@ -365,7 +365,7 @@ class RiskCalculatorTestCase(unittest.TestCase):
 
     def test_asset_losses_per_site(self):
         mm = mock.MagicMock(spec=redis.Redis)
-        mm.get.return_value = 0.123
+        mm.mget.side_effect = lambda keys: [0.123] * len(keys)
         with helpers.patch('openquake.kvs.get_client') as mgc:
             mgc.return_value = mm
 
@@ -388,3 +388,30 @@ class RiskCalculatorTestCase(unittest.TestCase):
             actual = sorted(actual, key=coords)
 
             self.assertEqual(expected, actual)
+            # all the losses are read with a single round trip
+            self.assertEqual(1, mm.mget.call_count)
+            self.assertEqual(0, mm.get.call_count)
+
+    def test_block_loss_map(self):
+        # the loss map is assembled block by block and can be iterated
+        # once per writer
+        calculator = general.BaseRiskCalculator(self.job_ctxt)
+        calculator.job_ctxt.blocks_keys = [0, 1]
+        blocks = {0: self.grid_assets[:2], 1: self.grid_assets[2:]}
+        metadata = {"poE": 0.5}
+
+        def losses(loss_poe, assets):
+            return [(point.site, [({"value": loss_poe}, asset)])
+                    for point, asset in assets]
+
+        with mock.patch.object(calculator, "block_assets_iterator") as bai:
+            bai.side_effect = lambda block_id: iter(blocks[block_id])
+            with mock.patch.object(
+                    calculator, "asset_losses_per_site") as alps:
+                alps.side_effect = losses
+                loss_map = general.BlockLossMap(calculator, 0.5, metadata)
+
+                expected = [metadata] + losses(0.5, self.grid_assets)
+                self.assertEqual(expected, list(loss_map))
+                self.assertEqual(expected, list(loss_map))
+                self.assertEqual(4, alps.call_count)
@@ -19,6 +19,7 @@
 from django.contrib.gis.geos import GEOSGeometry
 from lxml import etree
 from StringIO import StringIO
+import mock
 import numpy
 import os
 import tempfile
@@ -31,6 +32,7 @@ from openquake.calculators.risk.general import AggregateLossCurve
 from openquake.calculators.risk.general import BaseRiskCalculator
 from openquake.calculators.risk.general import Block
 from openquake.calculators.risk.general import compute_bcr
+from openquake.calculators.risk.general import compute_bcr_for_block
 from openquake.calculators.risk.general import _compute_conditional_loss
 from openquake.calculators.risk.general import _compute_cumulative_histogram
 from openquake.calculators.risk.general import compute_loss_curve
@@ -43,6 +45,7 @@ from openquake.calculators.risk.general import _compute_mid_po
 from openquake.calculators.risk.general import _compute_probs_of_exceedance
 from openquake.calculators.risk.general import _compute_rates_of_exceedance
 from openquake.calculators.risk.general import ProbabilisticRiskCalculator
+from openquake.calculators.risk.general import store_partial_losses
 from openquake.calculators.risk.scenario import core as scenario
 from openquake import engine
 from openquake import kvs
@@ -601,6 +604,26 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase, helpers.DbTestCase):
 
         self.assertEqual(expected_curve, aggregate_curve.compute(200, 50, 6))
 
+    def test_aggregate_curve_from_partial_losses_in_kvs(self):
+        """
+        Partial losses stored in the kvs by the blocks are accumulated and
+        removed from the kvs.
+        """
+        partials = [numpy.array([1.0, 2.5, 0.0]),
+                    numpy.array([0.5, 0.5, 3.0])]
+        keys = [store_partial_losses(self.job_id, block_id, losses)
+                for block_id, losses in enumerate(partials)]
+        self.assertTrue(store_partial_losses(self.job_id, 2, None) is None)
+
+        aggregate_curve = AggregateLossCurve()
+        for key in keys + [None]:
+            aggregate_curve.append_from_kvs(key)
+
+        self.assertTrue(numpy.allclose([1.5, 3.0, 3.0],
+                                       aggregate_curve.losses))
+        for key in keys:
+            self.assertTrue(kvs.get_client().get(key) is None)
+
     def test_compute_bcr(self):
         cfg_path = helpers.demo_file(
             'probabilistic_event_based_risk/config.gem')
@@ -1318,6 +1341,57 @@ class RiskCommonTestCase(unittest.TestCase):
                              life_expectancy, retrofitting_cost)
         self.assertAlmostEqual(result, expected_result, delta=2e-5)
 
+    def test_compute_bcr_for_block(self):
+        # the original and the retrofitted vulnerability functions are
+        # evaluated asset by asset, in exposure order, and the EALs scale
+        # with the asset values
+        def asset(ref, taxonomy, value, cost):
+            return mock.Mock(asset_ref=ref, taxonomy=taxonomy, value=value,
+                             retrofitting_cost=cost,
+                             site=mock.Mock(x=1.0, y=2.0))
+
+        assets = [asset("a1", "RC", 10.0, 0.5), asset("a2", "W", 20.0, 1.0),
+                  asset("a3", "RC", 30.0, 2.0)]
+        point = mock.Mock(site="site")
+        vuln_model = {"RC": "rc", "W": "w"}
+        vuln_model_retrofitted = {"RC": "rc_r", "W": "w_r"}
+        mean_loss_ratios = {"rc": 0.4, "w": 0.2, "rc_r": 0.1, "w_r": 0.15}
+        calls = []
+
+        def get_mean_loss_ratio(_point, vuln_function, asset):
+            calls.append((vuln_function, asset.asset_ref))
+            return mean_loss_ratios[vuln_function]
+
+        with mock.patch("openquake.parser.vulnerability."
+                        "load_vuln_model_from_kvs") as load_vm:
+            load_vm.side_effect = lambda job_id, retrofitted=False: (
+                vuln_model_retrofitted if retrofitted else vuln_model)
+            with mock.patch("openquake.calculators.risk.general."
+                            "BaseRiskCalculator.assets_for_cell") as afc:
+                afc.return_value = assets
+                result = compute_bcr_for_block(
+                    1, [point], get_mean_loss_ratio, 0.05, 40)
+
+        self.assertEqual([("rc", "a1"), ("rc_r", "a1"), ("w", "a2"),
+                          ("w_r", "a2"), ("rc", "a3"), ("rc_r", "a3")],
+                         calls)
+
+        [(key, values)] = result
+        self.assertEqual((1.0, 2.0), key)
+        self.assertEqual(["a1", "a2", "a3"], [ref for _, ref in values])
+
+        expected = [(10.0 * 0.4, 10.0 * 0.1, 0.5),
+                    (20.0 * 0.2, 20.0 * 0.15, 1.0),
+                    (30.0 * 0.4, 30.0 * 0.1, 2.0)]
+
+        for (data, _), (eal_orig, eal_retrofitted, cost) in zip(
+                values, expected):
+            self.assertAlmostEqual(eal_orig, data["eal_original"])
+            self.assertAlmostEqual(eal_retrofitted, data["eal_retrofitted"])
+            self.assertAlmostEqual(
+                compute_bcr(eal_orig, eal_retrofitted, 0.05, 40, cost),
+                data["bcr"])
+
 
 class RiskJobGeneralTestCase(unittest.TestCase):
 
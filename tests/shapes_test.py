@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import cPickle
 import decimal
 import json
 import numpy
@@ -280,6 +281,23 @@ class CurveTestCase(unittest.TestCase):
 
         self.assertRaises(AssertionError, curve.abscissa_for, vals)
 
+    def test_ordinate_for_with_multiple_yvals(self):
+        """ordinate_for() interpolates whole arrays of x values."""
+        curve = shapes.Curve([(1, (1.0, 10.0)), (2, (2.0, 20.0))])
+
+        self.assertTrue(allclose([1.0, 1.5, 2.0],
+                                 curve.ordinate_for([0.5, 1.5, 2.5])))
+        self.assertTrue(allclose([10.0, 15.0, 20.0],
+                                 curve.ordinate_for(
+                                     numpy.array([0.5, 1.5, 2.5]), 1)))
+
+    def test_abscissa_for_decreasing_ordinates(self):
+        """abscissa_for() works for curves with decreasing ordinates."""
+        curve = shapes.Curve([(0.1, 0.9), (0.2, 0.5), (0.3, 0.1)])
+
+        self.assertTrue(allclose([0.3, 0.25, 0.1, 0.1],
+                                 curve.abscissa_for([0.05, 0.3, 0.9, 1.0])))
+
     def test_abscissa_for_with_multiple_yvals(self):
         """ tests the correctness of the abscissa method """
         self.assertEqual(
@@ -607,6 +625,26 @@ class VulnerabilityFunctionTestCase(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+    def test_arrays_are_read_only(self):
+        """
+        The values of a vulnerability function are computed once and
+        cannot be modified.
+        """
+        self.assertTrue(self.test_func.imls is self.test_func.imls)
+        for values in (self.test_func.imls, self.test_func.loss_ratios,
+                       self.test_func.covs, self.test_func.stddevs):
+            self.assertRaises(ValueError, values.__setitem__, 0, 0.5)
+
+    def test_stddevs(self):
+        expected = [cov * lr for cov, lr in zip(self.COVS_GOOD,
+                                                self.LOSS_RATIOS_GOOD)]
+        self.assertTrue(allclose(expected, self.test_func.stddevs))
+
+    def test_interp_needs_at_least_two_imls(self):
+        func = shapes.VulnerabilityFunction([0.1], [0.5], [0.2])
+        self.assertRaises(AssertionError, func.loss_ratio_for, 0.1)
+        self.assertRaises(AssertionError, func.cov_for, [0.1])
+
 
 class SiteTestCase(unittest.TestCase):
     """
@@ -698,6 +736,83 @@ class SiteTestCase(unittest.TestCase):
 
         self.assertEqual(site1.__hash__(), site2.__hash__())
 
+    def test_hash_only_depends_on_coordinates(self):
+        """
+        The hash value is used in KVS keys and must be the same in every
+        process.
+        """
+        self.assertEqual(
+            (((290000000 + 900000000) << 32) | (-1210000000 + 1800000000)),
+            hash(shapes.Site(-121.0, 29.0)))
+        self.assertNotEqual(hash(shapes.Site(-121.0, 29.0)),
+                            hash(shapes.Site(-121.0, 29.0, 10.0)))
+
+    def test_hash_with_neighbouring_sites(self):
+        """Sites that differ in the last decimal place do not collide."""
+        sites = [shapes.Site(10.0 + i * 1e-7, 45.0 + j * 1e-7)
+                 for i in xrange(-5, 5) for j in xrange(-5, 5)]
+        self.assertEqual(len(sites), len(set(hash(s) for s in sites)))
+
+    def test_point_is_created_lazily(self):
+        site = shapes.Site(-121.0, 29.0)
+        self.assertTrue(site._point is None)
+        self.assertEqual((-121.0, 29.0), site.point.coords[0])
+        self.assertTrue(site.point is site.point)
+
+    def test_pickle(self):
+        site = shapes.Site(-121.0, 29.0000001, 1.0)
+        hash(site)
+        site.point
+        unpickled = cPickle.loads(cPickle.dumps(site))
+        self.assertEqual(site, unpickled)
+        self.assertEqual(hash(site), hash(unpickled))
+
+
+class SiteArrayTestCase(unittest.TestCase):
+    """
+    Tests for the :py:class:`openquake.shapes.SiteArray` class.
+    """
+
+    LONS = [-121.00000004, -121.1, 0.0, 179.9999999]
+    LATS = [29.00000006, -29.5, 0.0, -89.9999999]
+
+    def setUp(self):
+        self.sites = [shapes.Site(lon, lat)
+                      for lon, lat in zip(self.LONS, self.LATS)]
+
+    def test_coordinates_are_rounded(self):
+        array = shapes.SiteArray(self.LONS, self.LATS)
+        self.assertEqual([s.longitude for s in self.sites], list(array.lons))
+        self.assertEqual([s.latitude for s in self.sites], list(array.lats))
+        self.assertEqual([0.0] * 4, list(array.depths))
+
+    def test_hashes_match_site_hashes(self):
+        expected = [hash(s) for s in self.sites]
+        self.assertEqual(expected,
+                         shapes.SiteArray(self.LONS, self.LATS).hashes)
+        self.assertEqual(expected,
+                         shapes.SiteArray.from_sites(self.sites).hashes)
+
+    def test_hashes_match_site_hashes_with_depth(self):
+        depths = [0.0, 1.5, 10.0, 0.0]
+        sites = [shapes.Site(lon, lat, depth)
+                 for lon, lat, depth in zip(self.LONS, self.LATS, depths)]
+        self.assertEqual(
+            [hash(s) for s in sites],
+            shapes.SiteArray(self.LONS, self.LATS, depths).hashes)
+
+    def test_keys(self):
+        template = "::JOB::1::!mean_hazard_curve!%s"
+        array = shapes.SiteArray.from_sites(self.sites)
+        self.assertEqual([template % hash(s) for s in self.sites],
+                         array.keys(template))
+
+    def test_sequence_protocol(self):
+        array = shapes.SiteArray(self.LONS, self.LATS)
+        self.assertEqual(4, len(array))
+        self.assertEqual(self.sites[1], array[1])
+        self.assertEqual(self.sites, list(array))
+
 
 class ShapesUtilsTestCase(unittest.TestCase):
     '''
@@ -797,24 +912,6 @@ class ShapesUtilsTestCase(unittest.TestCase):
         test(43.7518411, site5, site6)
 
 
-class FieldTestCase(unittest.TestCase):
-
-    def setUp(self):
-        self.gmf_string = open(helpers.get_data_path("gmfs.json")).readline()
-        region = shapes.Region.from_coordinates(
-                 [(-118.30, 34.12), (-118.18, 34.12),
-                 (-118.18, 34.00), (-118.30, 34.00)])
-        region.cell_size = 0.02
-        self.grid = region.grid
-
-    def test_can_serialize_field(self):
-        field_set = shapes.FieldSet.from_json(self.gmf_string, grid=self.grid)
-        for field in field_set:
-            print field.field
-            self.assertTrue(field)
-            print field.get(5, 5)
-
-
 class GridTestCase(unittest.TestCase):
 
     def _test_expected_points(self, grid):
@@ -839,6 +936,49 @@ class GridTestCase(unittest.TestCase):
         constraint.cell_size = 0.02
         self._test_expected_points(constraint.grid)
 
+    def _nshmp_grid(self):
+        constraint = shapes.RegionConstraint.from_simple(
+            (-118.3, 34.0), (-118.18, 34.12))
+        constraint.cell_size = 0.02
+        return constraint.grid
+
+    def test_centers_array(self):
+        grid = self._nshmp_grid()
+        centers = grid.centers_array()
+
+        self.assertEqual((grid.rows * grid.columns, 2), centers.shape)
+        self.assertEqual([(p.site.longitude, p.site.latitude) for p in grid],
+                         [(round_float(lon), round_float(lat))
+                          for lon, lat in centers.tolist()])
+        self.assertEqual([p.site for p in grid], grid.centers())
+
+    def test_points_at(self):
+        grid = self._nshmp_grid()
+        sites = [shapes.Site(-118.3, 34.0), shapes.Site(-118.259, 34.051),
+                 shapes.Site(-118.18, 34.12), shapes.Site(-118.31, 33.99)]
+
+        columns, rows = grid.points_at([s.longitude for s in sites],
+                                       [s.latitude for s in sites])
+        expected = [grid.point_at(s) for s in sites]
+        self.assertEqual([(p.column, p.row) for p in expected],
+                         zip(columns.tolist(), rows.tolist()))
+
+    def test_points_at_outside(self):
+        grid = self._nshmp_grid()
+        self.assertRaises(ValueError, grid.points_at,
+                          [-118.3, -118.5], [34.0, 34.0])
+
+    def test_site_inside_includes_borders(self):
+        grid = self._nshmp_grid()
+        (min_lon, min_lat, max_lon, max_lat) = grid.polygon.bounds
+
+        self.assertTrue(grid.site_inside(shapes.Site(min_lon, min_lat)))
+        self.assertTrue(grid.site_inside(shapes.Site(max_lon, max_lat)))
+        self.assertFalse(grid.site_inside(shapes.Site(min_lon - 0.001,
+                                                      min_lat)))
+        self.assertFalse(grid.site_inside(shapes.Site(max_lon,
+                                                      max_lat + 0.001)))
+
 
 class RegionTestCase(unittest.TestCase):
     INSIDE = [(50, 50),
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import mock
 import unittest
 import logging
 from datetime import datetime
@@ -56,6 +57,26 @@ class SupervisorHelpersTestCase(DbTestCase, unittest.TestCase):
         cstats = JobStats.objects.get(oq_job=self.job.id)
         self.assertTrue(cstats.stop_time is not None)
 
+    def test_record_job_progress(self):
+        """
+        Test that the progress of the current phase is recorded properly.
+        """
+        cstats = JobStats(
+            oq_job=self.job, start_time=datetime.utcnow(),
+            num_sites=10)
+        cstats.save(using='job_superv')
+
+        supervisor.record_job_progress(
+            self.job.id, stats.Progress("h", 4, 10, 2.0, 1000.0))
+
+        cstats = JobStats.objects.get(oq_job=self.job.id)
+        self.assertEqual("hazard", cstats.phase)
+        self.assertEqual(4, cstats.units_done)
+        self.assertEqual(10, cstats.units_total)
+        self.assertEqual(2.0, cstats.throughput)
+        self.assertEqual(datetime.utcfromtimestamp(1000.0),
+                         cstats.eta.replace(tzinfo=None))
+
     def test_cleanup_after_job(self):
         with patch('openquake.kvs.cache_gc') as cache_gc:
             supervisor.cleanup_after_job(123)
@@ -183,6 +204,26 @@ class SupervisorTestCase(unittest.TestCase):
         self.assertEqual(1, self.cleanup_after_job.call_count)
         self.assertEqual(((123,), {}), self.cleanup_after_job.call_args)
 
+    def test_progress_is_recorded(self):
+        self.get_job_status.return_value = 'succeeded'
+
+        stats.delete_job_counters(124)
+        stats.set_units_total(124, "h", 10)
+        stats.record_units(124, "h", 4)
+        with mock.patch.object(supervisor.SupervisorLogMessageConsumer,
+                               'PROGRESS_DELAY', 1):
+            # the job process is running, then terminates
+            with mock.patch('openquake.supervising.is_pid_running',
+                            side_effect=[True, False]):
+                with mock.patch('openquake.supervising.supervisor'
+                                '.record_job_progress') as record:
+                    supervisor.supervise(1, 124, timeout=0.1)
+
+        self.assertEqual(1, record.call_count)
+        job_id, progress = record.call_args[0]
+        self.assertEqual(124, job_id)
+        self.assertEqual(("h", 4, 10), progress[:3])
+
     def test_actions_after_job_process_crash(self):
         # the job process is *not* running
         self.is_pid_running.return_value = False
@@ -290,41 +290,53 @@ class IsReadableTestCase(unittest.TestCase):
         self.assertTrue(config.Config().is_readable())
 
 
-class HazardBlockSizeTestCase(unittest.TestCase):
-    """Tests the behaviour of utils.config.hazard_block_size()."""
+class PositiveIntTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.config.positive_int()."""
 
     def test_not_configured(self):
-        """
-        The hazard block size was not set in openquake.cfg, the default
-        is returned.
-        """
         with patch("openquake.utils.config.get") as mget:
             mget.return_value = None
-            self.assertEqual(8192, config.hazard_block_size())
+            self.assertIs(None, config.positive_int("tasks", "workers"))
+            self.assertEqual(
+                7, config.positive_int("tasks", "workers", default=7))
 
-    def test_not_configured_default_overriden(self):
-        """
-        The hazard block size was not set in openquake.cfg, the default
-        is specified by the caller is returned.
-        """
+    def test_not_positive(self):
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = "-1"
+            self.assertEqual(
+                7, config.positive_int("tasks", "workers", default=7))
+
+    def test_configured(self):
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = " 12 "
+            self.assertEqual(
+                12, config.positive_int("tasks", "workers", default=7))
+            mget.assert_called_once_with("tasks", "workers")
+
+
+class ConfiguredBlockSizeTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.config.configured_block_size()."""
+
+    def test_not_configured(self):
         with patch("openquake.utils.config.get") as mget:
             mget.return_value = None
-            self.assertEqual(333, config.hazard_block_size(333))
+            self.assertIs(None, config.configured_block_size("risk"))
+
+    def test_not_positive(self):
+        with patch("openquake.utils.config.get") as mget:
+            mget.return_value = "0"
+            self.assertIs(None, config.configured_block_size("risk"))
 
     def test_configured(self):
-        """The hazard block size *was* configured in openquake.cfg"""
         with patch("openquake.utils.config.get") as mget:
-            mget.return_value = "33"
-            self.assertEqual(33, config.hazard_block_size())
+            mget.return_value = " 50 "
+            self.assertEqual(50, config.configured_block_size("risk"))
 
     def test_configuration_invalid(self):
-        """
-        The hazard block size *was* configured in openquake.cfg but
-        the setting is not a valid number.
-        """
         with patch("openquake.utils.config.get") as mget:
             mget.return_value = "not a number"
-            self.assertRaises(ValueError, config.hazard_block_size)
+            self.assertRaises(ValueError, config.configured_block_size,
+                              "hazard")
 
 
 class FlagSetTestCase(ConfigTestCase, unittest.TestCase):
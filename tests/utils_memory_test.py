@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2012, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests related to code in openquake/utils/memory.py
+"""
+
+import mock
+import numpy
+import unittest
+
+from openquake.utils import memory
+
+
+class TaskMemoryTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.memory.task_memory()."""
+
+    def test_not_configured(self):
+        with mock.patch("openquake.utils.config.get", return_value=None):
+            self.assertEqual(memory.DEFAULT_TASK_MEMORY * memory.MB,
+                             memory.task_memory())
+
+    def test_configured(self):
+        with mock.patch("openquake.utils.config.get", return_value=" 64 "):
+            self.assertEqual(64 * memory.MB, memory.task_memory())
+
+
+class BlockMemoryTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.memory.block_memory()."""
+
+    def test_not_configured(self):
+        with mock.patch("openquake.utils.config.get", return_value=None):
+            self.assertEqual(memory.DEFAULT_BLOCK_MEMORY * memory.MB,
+                             memory.block_memory("risk"))
+
+    def test_configured(self):
+        with mock.patch("openquake.utils.config.get",
+                        return_value="32") as get:
+            self.assertEqual(32 * memory.MB, memory.block_memory("hazard"))
+        get.assert_called_once_with("hazard", "block_memory")
+
+
+class AllocateTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.memory.allocate() and load()."""
+
+    def test_rows_per_chunk(self):
+        with mock.patch("openquake.utils.memory.task_memory",
+                        return_value=100):
+            self.assertEqual(4, memory.rows_per_chunk(24))
+            # at least one row
+            self.assertEqual(1, memory.rows_per_chunk(1000))
+
+    def test_allocate_within_budget(self):
+        array = memory.allocate((3, 4))
+        self.assertFalse(isinstance(array, numpy.memmap))
+        self.assertEqual((3, 4), array.shape)
+        self.assertFalse(array.any())
+
+    def test_allocate_exceeding_budget(self):
+        with mock.patch("openquake.utils.memory.task_memory",
+                        return_value=64):
+            array = memory.allocate((3, 4))
+        self.assertTrue(isinstance(array, numpy.memmap))
+        self.assertEqual((3, 4), array.shape)
+        self.assertFalse(array.any())
+
+    def test_load_exceeding_budget(self):
+        data = numpy.arange(24, dtype=numpy.float32).reshape(6, 2, 2)
+        with mock.patch("openquake.utils.memory.task_memory",
+                        return_value=32):
+            array = memory.load(data)
+        self.assertTrue(isinstance(array, numpy.memmap))
+        self.assertEqual(numpy.float32, array.dtype)
+        self.assertTrue((data == array).all())
+
+    def test_load_empty(self):
+        array = memory.load(numpy.zeros((0, 3)))
+        self.assertEqual((0, 3), array.shape)
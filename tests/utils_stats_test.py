@@ -22,10 +22,13 @@ Unit tests for the utils.stats module.
 """
 
 import itertools
+import mock
 import string
 import sys
 import unittest
 
+from celery.exceptions import RetryTaskError
+
 from openquake.utils import stats
 
 from tests.utils import helpers
@@ -47,15 +50,34 @@ class ProgressIndicatorTestCase(helpers.RedisTestCase, unittest.TestCase):
 
         kvs = self.connect()
         key = stats.key_name(11, area, no_exception.__name__, "i")
-        previous_value = kvs.get(key)
+        previous_value = kvs.hget(stats.counters_key(11), key)
         previous_value = int(previous_value) if previous_value else 0
 
         # Call the wrapped function.
         self.assertEqual(999, no_exception(11))
 
-        value = int(kvs.get(key))
+        value = int(kvs.hget(stats.counters_key(11), key))
         self.assertEqual(1, (value - previous_value))
 
+    def test_time_stats(self):
+        """
+        The time spent in successful invocations is accumulated in
+        milliseconds.
+        """
+        area = "aab"
+
+        @stats.progress_indicator(area)
+        def no_exception(job_id):
+            return 999
+
+        stats.delete_job_counters(12)
+        with mock.patch("openquake.utils.stats.time") as mtime:
+            mtime.time.side_effect = [100.0, 100.0, 102.5, 102.5]
+            no_exception(12)
+
+        self.assertEqual(2500, stats.get_counter(
+            12, area, no_exception.__name__ + "-ms", "i"))
+
     def test_failure_stats(self):
         """
         The failure counter is incremented when the wrapped function
@@ -70,15 +92,41 @@ class ProgressIndicatorTestCase(helpers.RedisTestCase, unittest.TestCase):
         kvs = self.connect()
         key = stats.key_name(
             22, area, raise_exception.__name__ + "-failures", "i")
-        previous_value = kvs.get(key)
+        previous_value = kvs.hget(stats.counters_key(22), key)
         previous_value = int(previous_value) if previous_value else 0
 
         # Call the wrapped function.
         self.assertRaises(NotImplementedError, raise_exception, 22)
 
-        value = int(kvs.get(key))
+        value = int(kvs.hget(stats.counters_key(22), key))
         self.assertEqual(1, (value - previous_value))
 
+    def test_retry_stats(self):
+        """
+        The retry counter (and not the failure counter) is incremented when
+        the wrapped function is going to be retried.
+        """
+        area = "ccc"
+
+        @stats.progress_indicator(area)
+        def retry(job_id):
+            raise RetryTaskError("retrying", NotImplementedError())
+
+        kvs = self.connect()
+        retries_key = stats.key_name(23, area, retry.__name__ + "-retries",
+                                     "i")
+        previous_value = kvs.hget(stats.counters_key(23), retries_key)
+        previous_value = int(previous_value) if previous_value else 0
+
+        # Call the wrapped function.
+        self.assertRaises(RetryTaskError, retry, 23)
+
+        value = int(kvs.hget(stats.counters_key(23), retries_key))
+        self.assertEqual(1, (value - previous_value))
+        failures_key = stats.key_name(
+            23, area, retry.__name__ + "-failures", "i")
+        self.assertEqual(None, kvs.hget(stats.counters_key(23), failures_key))
+
 
 class SetTotalTestCase(helpers.RedisTestCase, unittest.TestCase):
     """Tests the behaviour of utils.stats.set_total()."""
@@ -91,7 +139,7 @@ class SetTotalTestCase(helpers.RedisTestCase, unittest.TestCase):
         # Specify a 'totals' counter type.
         key = stats.key_name(33, "h", "a/b/c", "t")
         stats.set_total(33, "h", "a/b/c", 123)
-        self.assertEqual("123", kvs.get(key))
+        self.assertEqual("123", kvs.hget(stats.counters_key(33), key))
 
 
 class IncrCounterTestCase(helpers.RedisTestCase, unittest.TestCase):
@@ -104,10 +152,10 @@ class IncrCounterTestCase(helpers.RedisTestCase, unittest.TestCase):
         args = (44, "h", "d/x/z", "i")
         kvs = self.connect()
         key = stats.key_name(*args)
-        previous_value = kvs.get(key)
+        previous_value = kvs.hget(stats.counters_key(44), key)
         previous_value = int(previous_value) if previous_value else 0
         stats.incr_counter(*args[:-1])
-        value = int(kvs.get(key))
+        value = int(kvs.hget(stats.counters_key(44), key))
         self.assertEqual(1, (value - previous_value))
 
 
@@ -119,7 +167,7 @@ class GetCounterTestCase(helpers.RedisTestCase, unittest.TestCase):
         args = (55, "h", "d/a/z", "i")
         key = stats.key_name(*args)
         kvs = self.connect()
-        self.assertIs(None, kvs.get(key))
+        self.assertIs(None, kvs.hget(stats.counters_key(55), key))
         self.assertIs(None, stats.get_counter(*args))
 
     def test_get_value_with_existent_incremental(self):
@@ -130,7 +178,7 @@ class GetCounterTestCase(helpers.RedisTestCase, unittest.TestCase):
         args = (56, "h", "d/b/z", "i")
         key = stats.key_name(*args)
         kvs = self.connect()
-        kvs.set(key, value)
+        kvs.hset(stats.counters_key(56), key, value)
         self.assertEqual(int(value), stats.get_counter(*args))
 
     def test_get_value_with_non_existent_total(self):
@@ -138,7 +186,7 @@ class GetCounterTestCase(helpers.RedisTestCase, unittest.TestCase):
         args = (57, "h", "d/c/z", "t")
         key = stats.key_name(*args)
         kvs = self.connect()
-        self.assertIs(None, kvs.get(key))
+        self.assertIs(None, kvs.hget(stats.counters_key(57), key))
         self.assertIs(None, stats.get_counter(*args))
 
     def test_get_value_with_existent_total(self):
@@ -147,7 +195,7 @@ class GetCounterTestCase(helpers.RedisTestCase, unittest.TestCase):
         args = (58, "h", "d/d/z", "t")
         key = stats.key_name(*args)
         kvs = self.connect()
-        kvs.set(key, value)
+        kvs.hset(stats.counters_key(58), key, value)
         self.assertEqual(int(value), stats.get_counter(*args))
 
     def test_get_value_with_debug_stats_disabled(self):
@@ -198,7 +246,7 @@ class DeleteJobCountersTestCase(helpers.RedisTestCase, unittest.TestCase):
         for data in args:
             stats.incr_counter(*data)
         stats.delete_job_counters(55)
-        self.assertEqual(0, len(kvs.keys("oqs:55:*")))
+        self.assertEqual(0, len(kvs.keys("oqs/55/*")))
 
     def test_delete_job_counters_resets_counters(self):
         """
@@ -213,7 +261,8 @@ class DeleteJobCountersTestCase(helpers.RedisTestCase, unittest.TestCase):
         # to have a value of "1".
         for data in args:
             stats.incr_counter(*data[:-1])
-            self.assertEqual("1", kvs.get(stats.key_name(*data)))
+            self.assertEqual(
+                "1", kvs.hget(stats.counters_key(66), stats.key_name(*data)))
 
     def test_delete_job_counters_copes_with_nonexistent_counters(self):
         """
@@ -235,7 +284,7 @@ class PkSetTestCase(helpers.RedisTestCase, unittest.TestCase):
         stats.delete_job_counters(job_id)
         kvs = self.connect()
         stats.pk_set(job_id, pkey, 717)
-        self.assertEqual("717", kvs.get(key))
+        self.assertEqual("717", kvs.hget(stats.counters_key(job_id), key))
 
     def test_pk_set_with_existing_incremental(self):
         """The value is set correctly for an existing predefined key."""
@@ -246,7 +295,7 @@ class PkSetTestCase(helpers.RedisTestCase, unittest.TestCase):
         stats.delete_job_counters(job_id)
         kvs = self.connect()
         stats.pk_set(job_id, pkey, 727)
-        self.assertEqual("727", kvs.get(key))
+        self.assertEqual("727", kvs.hget(stats.counters_key(job_id), key))
 
     def test_pk_set_with_non_existent_predef_key(self):
         """`KeyError` is raised for keys that do not exist in `STATS_KEYS`."""
@@ -302,7 +351,7 @@ class PkIncTestCase(helpers.RedisTestCase, unittest.TestCase):
         stats.delete_job_counters(job_id)
         kvs = self.connect()
         stats.pk_inc(job_id, pkey)
-        self.assertEqual("1", kvs.get(key))
+        self.assertEqual("1", kvs.hget(stats.counters_key(job_id), key))
 
     def test_pk_inc_with_existing_incremental(self):
         """The value is incremented for an existing predefined key."""
@@ -313,7 +362,7 @@ class PkIncTestCase(helpers.RedisTestCase, unittest.TestCase):
         stats.delete_job_counters(job_id)
         kvs = self.connect()
         stats.pk_inc(job_id, pkey)
-        self.assertEqual("1", kvs.get(key))
+        self.assertEqual("1", kvs.hget(stats.counters_key(job_id), key))
 
     def test_pk_inc_with_non_existent_predef_key(self):
         """`KeyError` is raised for keys that do not exist in `STATS_KEYS`."""
@@ -370,9 +419,8 @@ class PkGetTestCase(helpers.RedisTestCase, unittest.TestCase):
 
         stats.delete_job_counters(job_id)
         kvs = self.connect()
-        kvs.set(key, 919)
-        stats.pk_get(job_id, pkey)
-        self.assertEqual("919", kvs.get(key))
+        kvs.hset(stats.counters_key(job_id), key, 919)
+        self.assertEqual(919, stats.pk_get(job_id, pkey))
 
     def test_pk_get_with_existing_incremental(self):
         """The correct value is obtained for an existing predefined key."""
@@ -382,9 +430,8 @@ class PkGetTestCase(helpers.RedisTestCase, unittest.TestCase):
 
         stats.delete_job_counters(job_id)
         kvs = self.connect()
-        kvs.set(key, 929)
-        stats.pk_get(job_id, pkey)
-        self.assertEqual("929", kvs.get(key))
+        kvs.hset(stats.counters_key(job_id), key, 929)
+        self.assertEqual(929, stats.pk_get(job_id, pkey))
 
     def test_pk_get_with_non_existent_predef_key(self):
         """`KeyError` is raised for keys that do not exist in `STATS_KEYS`."""
@@ -426,6 +473,107 @@ class PkGetTestCase(helpers.RedisTestCase, unittest.TestCase):
             self.assertRaises(KeyError, stats.pk_get, job_id, pkey)
 
 
+class CounterBufferingTestCase(helpers.RedisTestCase, unittest.TestCase):
+    """Tests the buffering of counter increments performed by tasks."""
+
+    def test_increments_are_buffered_until_the_task_ends(self):
+        job_id = 101
+        stats.delete_job_counters(job_id)
+
+        @stats.progress_indicator("h")
+        def task(job_id):
+            for _ in xrange(3):
+                stats.incr_counter(job_id, "h", "units")
+            # Nothing was written to the kvs so far.
+            return stats.get_counter(job_id, "h", "units", "i")
+
+        self.assertIs(None, task(job_id))
+        self.assertEqual(3, stats.get_counter(job_id, "h", "units", "i"))
+        self.assertEqual(1, stats.get_counter(job_id, "h", "task", "i"))
+
+    def test_buffered_increments_are_flushed_on_timer(self):
+        job_id = 102
+        stats.delete_job_counters(job_id)
+
+        @stats.progress_indicator("h")
+        def task(job_id):
+            stats.incr_counter(job_id, "h", "units")
+            return stats.get_counter(job_id, "h", "units", "i")
+
+        with mock.patch("openquake.utils.stats.FLUSH_INTERVAL", -1):
+            self.assertEqual(1, task(job_id))
+
+    def test_increments_are_flushed_with_one_pipeline(self):
+        job_id = 103
+        stats.delete_job_counters(job_id)
+
+        @stats.progress_indicator("h")
+        def task(job_id):
+            for fragment in "abc":
+                stats.incr_counter(job_id, "h", fragment)
+
+        with mock.patch("openquake.utils.stats._redis") as mredis:
+            task(job_id)
+            self.assertEqual(1, mredis.call_count)
+            pipe = mredis.return_value.pipeline.return_value
+            # The three counters, the task count and the task time.
+            self.assertEqual(5, pipe.hincrby.call_count)
+            self.assertEqual(1, pipe.execute.call_count)
+
+
+class UnitsTestCase(helpers.RedisTestCase, unittest.TestCase):
+    """Tests the behaviour of the units of work counters."""
+
+    def setUp(self):
+        stats.delete_job_counters(104)
+
+    def test_units(self):
+        self.assertEqual((0, None), stats.units(104, "h"))
+        stats.set_units_total(104, "h", 10)
+        stats.record_units(104, "h", 3)
+        stats.record_units(104, "h", 4)
+        self.assertEqual((7, 10), stats.units(104, "h"))
+
+    def test_current_area(self):
+        self.assertIs(None, stats.current_area(104))
+        stats.set_units_total(104, "h", 10)
+        self.assertEqual("h", stats.current_area(104))
+        stats.set_units_total(104, "r", 5)
+        self.assertEqual("r", stats.current_area(104))
+
+
+class ProgressEstimatorTestCase(helpers.RedisTestCase, unittest.TestCase):
+    """Tests the behaviour of utils.stats.ProgressEstimator."""
+
+    def setUp(self):
+        stats.delete_job_counters(105)
+        self.estimator = stats.ProgressEstimator(105, smoothing=0.5)
+
+    def test_no_units_announced(self):
+        self.assertIs(None, self.estimator.sample())
+
+    def test_throughput_and_eta(self):
+        stats.set_units_total(105, "h", 100)
+        progress = self.estimator.sample(now=1000)
+        self.assertEqual(("h", 0, 100, None, None), progress)
+
+        # 10 units/s
+        stats.record_units(105, "h", 20)
+        progress = self.estimator.sample(now=1002)
+        self.assertEqual(("h", 20, 100, 10.0, 1010.0), progress)
+
+        # 20 units/s, averaged to 15 units/s
+        stats.record_units(105, "h", 40)
+        progress = self.estimator.sample(now=1004)
+        self.assertEqual(("h", 60, 100, 15.0, 1004 + 40 / 15.0), progress)
+
+    def test_completed_phase(self):
+        stats.set_units_total(105, "r", 10)
+        stats.record_units(105, "r", 10)
+        progress = self.estimator.sample(now=1000)
+        self.assertEqual(("r", 10, 10, None, 1000), progress)
+
+
 class KvsOpTestCase(helpers.RedisTestCase, unittest.TestCase):
     """Tests the behaviour of utils.stats.pk_kvs_op()."""
 
@@ -27,6 +27,7 @@ import time
 import uuid
 
 from openquake import engine
+from openquake import kvs
 from openquake.utils import tasks
 from openquake.db.models import model_equals
 
@@ -200,6 +201,35 @@ class GetRunningCalculationTestCase(unittest.TestCase):
         else:
             self.fail("JobCompletedError wasn't raised")
 
+    def test_get_running_job_is_cached(self):
+        self.job.status = 'running'
+        self.job.save()
+        kvs.bump_job_status_generation(self.job.id)
+        tasks.clear_job_cache()
+
+        job_ctxt = tasks.get_running_job(self.job.id)
+        with patch('openquake.engine.JobContext.from_kvs') as from_kvs:
+            with patch('openquake.engine.JobContext.is_job_completed') as ijc:
+                self.assertTrue(
+                    job_ctxt is tasks.get_running_job(self.job.id))
+                self.assertEqual(0, from_kvs.call_count)
+                self.assertEqual(0, ijc.call_count)
+
+    def test_status_change_invalidates_cached_job(self):
+        self.job.status = 'running'
+        self.job.save()
+        kvs.bump_job_status_generation(self.job.id)
+        tasks.clear_job_cache()
+
+        tasks.get_running_job(self.job.id)
+
+        self.job.status = 'failed'
+        self.job.save()
+        kvs.bump_job_status_generation(self.job.id)
+
+        self.assertRaises(tasks.JobCompletedError,
+                          tasks.get_running_job, self.job.id)
+
 
 class IgnoreResultsTestCase(unittest.TestCase):
     """
@@ -314,3 +344,309 @@ class CalculatorForTaskTestCase(unittest.TestCase):
 
             self.assertTrue(isinstance(calculator, ClassicalHazardCalculator))
             self.assertEqual(1, grc_mock.call_count)
+
+
+class AsCompletedTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.as_completed()."""
+
+    @staticmethod
+    def _result(name, ready_after):
+        """A fake task result that becomes ready after `ready_after` polls."""
+        result = mock.Mock()
+        result.task_id = name
+        result.submitted = time.time()
+        polls = dict(count=0)
+
+        def ready():
+            polls["count"] += 1
+            return polls["count"] > ready_after
+
+        result.ready.side_effect = ready
+        return result
+
+    def test_as_completed_yields_results_in_completion_order(self):
+        results = [self._result("slow", 3), self._result("fast", 0),
+                   self._result("medium", 1)]
+        completed = tasks.as_completed(results, poll_interval=0)
+        self.assertEqual(["fast", "medium", "slow"],
+                         [r.task_id for r in completed])
+
+    def test_as_completed_with_small_batches(self):
+        results = [self._result(i, i % 3) for i in xrange(10)]
+        completed = tasks.as_completed(results, poll_interval=0,
+                                       batch_size=2)
+        self.assertEqual(range(10), sorted(r.task_id for r in completed))
+
+    def test_as_completed_with_no_results(self):
+        self.assertEqual([], list(tasks.as_completed([])))
+
+    def test_as_completed_times_out(self):
+        from celery.exceptions import TimeoutError
+        results = [self._result("done", 0), self._result("stuck", 10 ** 6)]
+        completed = tasks.as_completed(results, timeout=0.05,
+                                       poll_interval=0.01)
+        self.assertEqual("done", completed.next().task_id)
+        self.assertRaises(TimeoutError, completed.next)
+
+    def test_timeout_applies_to_each_task(self):
+        # A task submitted long ago times out although other tasks keep
+        # completing.
+        from celery.exceptions import TimeoutError
+        stuck = self._result("stuck", 10 ** 6)
+        stuck.submitted -= 60
+        results = [self._result(i, 1) for i in xrange(3)] + [stuck]
+        completed = tasks.as_completed(results, timeout=30, poll_interval=0)
+        self.assertRaises(TimeoutError, list, completed)
+
+    def test_backend_is_polled_in_batches(self):
+        from celery.result import AsyncResult
+        backend = mock.Mock()
+        backend.get_many.side_effect = [
+            iter([("b", {}), ("c", {})]), iter([("a", {})])]
+        results = [AsyncResult(name, backend=backend) for name in "abc"]
+        completed = tasks.as_completed(results, poll_interval=0)
+        self.assertEqual(["b", "c", "a"], [r.task_id for r in completed])
+        self.assertEqual(2, backend.get_many.call_count)
+        self.assertEqual(set("abc"),
+                         set(backend.get_many.call_args_list[0][0][0]))
+
+    def test_task_timeout(self):
+        with mock.patch("openquake.utils.config.get", return_value=None):
+            self.assertIs(None, tasks.task_timeout())
+        with mock.patch("openquake.utils.config.get", return_value="600"):
+            self.assertEqual(600, tasks.task_timeout())
+
+
+class AsCompletedBoundedTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.as_completed_bounded()."""
+
+    def setUp(self):
+        self.submitted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _submit(self, name, ready_after):
+        """Submit a fake task that becomes ready after `ready_after` polls.
+        """
+        self.submitted.append(name)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return AsCompletedTestCase._result(name, ready_after)
+
+    def _consume(self, completed):
+        names = []
+        for args, result in completed:
+            self.assertEqual(args[0], result.task_id)
+            self.in_flight -= 1
+            names.append(result.task_id)
+        return names
+
+    def test_window_is_bounded(self):
+        args = [(i, i % 4) for i in xrange(10)]
+        completed = tasks.as_completed_bounded(self._submit, args, 3,
+                                               poll_interval=0)
+        self.assertEqual(range(10), sorted(self._consume(completed)))
+        self.assertEqual(3, self.max_in_flight)
+        self.assertEqual(range(10), self.submitted)
+
+    def test_fast_tasks_do_not_wait_for_slow_ones(self):
+        args = [("slow", 10), ("fast1", 0), ("fast2", 0)]
+        completed = tasks.as_completed_bounded(self._submit, args, 2,
+                                               poll_interval=0)
+        self.assertEqual(["fast1", "fast2", "slow"], self._consume(completed))
+
+    def test_submission_is_lazy(self):
+        completed = tasks.as_completed_bounded(
+            self._submit, [(i, 0) for i in xrange(5)], 2, poll_interval=0)
+        self.assertEqual([], self.submitted)
+        completed.next()
+        self.assertEqual([0, 1], self.submitted)
+
+    def test_no_tasks(self):
+        self.assertEqual(
+            [], list(tasks.as_completed_bounded(self._submit, [], 2)))
+
+
+class RetryingTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.retrying()."""
+
+    JOB_ID = 8644
+
+    def setUp(self):
+        self.calls = []
+        self.failures = 0
+        self.request = mock.Mock(id="task-id", retries=0)
+
+        def work(job_id, block_id):
+            self.calls.append(block_id)
+            if self.failures:
+                self.failures -= 1
+                raise ValueError("transient failure")
+            return {"block": block_id}
+
+        self.task = mock.Mock(ignore_result=False)
+        self.task.request = self.request
+        self.work = tasks.retrying(work)
+        self.patcher = mock.patch("openquake.utils.tasks.task_registry",
+                                  {"%s.work" % __name__: self.task})
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        kvs.get_client().delete(
+            kvs.tokens.completed_tasks_key(self.JOB_ID, "work"))
+
+    def test_completed_invocations_are_not_repeated(self):
+        self.assertEqual({"block": 1}, self.work(self.JOB_ID, 1))
+        self.assertEqual({"block": 1}, self.work(self.JOB_ID, 1))
+        self.assertEqual({"block": 2}, self.work(self.JOB_ID, 2))
+        self.assertEqual([1, 2], self.calls)
+
+    def test_ignored_results_are_not_recorded(self):
+        self.task.ignore_result = True
+        key = kvs.tokens.completed_tasks_key(self.JOB_ID, "work")
+        self.assertEqual({"block": 1}, self.work(self.JOB_ID, 1))
+        self.assertIs(None, self.work(self.JOB_ID, 1))
+        self.assertEqual([1], self.calls)
+        # only a completion marker is kept
+        self.assertEqual(1, len(kvs.get_client().smembers(key)))
+
+    def test_forget_completed(self):
+        self.work(self.JOB_ID, 1)
+        tasks.forget_completed(self.JOB_ID, ["work"])
+        self.work(self.JOB_ID, 1)
+        self.assertEqual([1, 1], self.calls)
+
+    def test_failure_is_retried_with_back_off(self):
+        self.failures = 1
+        self.request.retries = 1
+        self.task.retry.side_effect = RuntimeError("retry")
+        with mock.patch("openquake.utils.tasks.max_attempts") as attempts:
+            attempts.return_value = 3
+            self.assertRaises(RuntimeError, self.work, self.JOB_ID, 1)
+        [(_, kwargs)] = self.task.retry.call_args_list
+        self.assertEqual(tasks.retry_delay(1), kwargs["countdown"])
+        self.assertEqual(2, kwargs["max_retries"])
+        self.assertTrue(isinstance(kwargs["exc"], ValueError))
+
+    def test_failure_is_raised_when_attempts_are_exhausted(self):
+        self.failures = 1
+        self.request.retries = 2
+        with mock.patch("openquake.utils.tasks.max_attempts") as attempts:
+            attempts.return_value = 3
+            self.assertRaises(ValueError, self.work, self.JOB_ID, 1)
+        self.assertEqual(0, self.task.retry.call_count)
+
+    def test_retry_delay_is_doubled(self):
+        with mock.patch("openquake.utils.config.get") as get:
+            get.return_value = "5"
+            self.assertEqual([5, 10, 20],
+                             [tasks.retry_delay(i) for i in xrange(3)])
+
+    def test_failed_invocations_are_not_recorded(self):
+        self.failures = 1
+        self.request.retries = tasks.max_attempts() - 1
+        self.assertRaises(ValueError, self.work, self.JOB_ID, 1)
+        self.assertEqual({"block": 1}, self.work(self.JOB_ID, 1))
+        self.assertEqual([1, 1], self.calls)
+
+    def test_direct_invocations_are_neither_recorded_nor_retried(self):
+        self.request.id = None
+        self.work(self.JOB_ID, 1)
+        self.work(self.JOB_ID, 1)
+        self.assertEqual([1, 1], self.calls)
+        self.failures = 1
+        self.assertRaises(ValueError, self.work, self.JOB_ID, 1)
+        self.assertEqual(0, self.task.retry.call_count)
+
+
+class LocalExecutorTestCase(unittest.TestCase):
+    """Tests the behaviour of the local executor."""
+
+    def setUp(self):
+        self.patchers = [
+            mock.patch("openquake.utils.tasks.executor",
+                       return_value="local"),
+            # The workers are threads with the in-memory kvs.
+            mock.patch("openquake.kvs.backend", return_value="memory")]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        tasks.stop_local_pool()
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def test_submit(self):
+        result = tasks.submit(reflect_args, 1, 2, a=3)
+        self.assertTrue(isinstance(result, tasks.LocalResult))
+        self.assertEqual(((1, 2), {"a": 3}), result.get())
+        self.assertTrue(result.ready())
+        self.assertTrue(result.successful())
+        self.assertEqual("SUCCESS", result.status)
+
+    def test_submit_failing_task(self):
+        result = tasks.submit(failing_task, 7)
+        self.assertRaises(NotImplementedError, result.wait)
+        self.assertFalse(result.successful())
+        self.assertEqual("FAILURE", result.status)
+        self.assertTrue(isinstance(result.result, NotImplementedError))
+
+    def test_distribute(self):
+        result = tasks.distribute(reflect_data_to_be_processed,
+                                  ("data", range(7)), flatten_results=True)
+        self.assertEqual(range(7), result)
+
+    def test_distribute_with_failing_subtask(self):
+        self.assertRaises(NotImplementedError, tasks.distribute,
+                          failing_task, ("data", range(5)))
+
+    def test_as_completed(self):
+        results = [tasks.submit(just_say_1) for _ in xrange(5)]
+        self.assertEqual(set(results), set(tasks.as_completed(results)))
+
+
+class AdaptiveBlockSizeTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.adaptive_block_size()."""
+
+    def test_min_blocks(self):
+        """The units are spread over the requested number of blocks."""
+        self.assertEqual(25, tasks.adaptive_block_size(100, 1, 1000,
+                                                       min_blocks=4))
+        self.assertEqual(34, tasks.adaptive_block_size(100, 1, 1000,
+                                                       min_blocks=3))
+
+    def test_cost_limit(self):
+        """Blocks do not exceed their cost budget."""
+        self.assertEqual(10, tasks.adaptive_block_size(100, 10, 105))
+        self.assertEqual(100, tasks.adaptive_block_size(100, 0, 105))
+
+    def test_at_least_one_unit(self):
+        self.assertEqual(1, tasks.adaptive_block_size(100, 1000, 1))
+        self.assertEqual(1, tasks.adaptive_block_size(2, 1, 1000,
+                                                      min_blocks=8))
+
+
+class ActiveWorkersTestCase(unittest.TestCase):
+    """Tests the behaviour of utils.tasks.active_workers()."""
+
+    def test_configured(self):
+        with mock.patch("openquake.utils.config.get", return_value="12"):
+            self.assertEqual(12, tasks.active_workers())
+
+    def test_local_executor(self):
+        with mock.patch("openquake.utils.config.get", return_value=None):
+            with mock.patch("openquake.utils.tasks.executor",
+                            return_value="local"):
+                with mock.patch("openquake.utils.tasks.local_workers",
+                                return_value=3):
+                    self.assertEqual(3, tasks.active_workers())
+
+    def test_celery_workers(self):
+        replies = {"w1": {"pool": {"max-concurrency": 4}},
+                   "w2": {"pool": {"max-concurrency": 2}}}
+        with mock.patch("openquake.utils.tasks.inspect") as minspect:
+            minspect.return_value.stats.return_value = replies
+            self.assertEqual(6, tasks._celery_workers())
+            minspect.return_value.stats.return_value = None
+            self.assertIs(None, tasks._celery_workers())